@@ -0,0 +1,512 @@
+# benchmark.py
+"""
+Benchmarks for the converter pipelines.
+
+Run from the repository root:
+
+    python benchmark.py suite --json results.json
+    python benchmark.py compare before.json results.json
+    python benchmark.py parallel --pages 120 --workers 1 2 4 8
+    python benchmark.py presets --formats jpg webp avif
+
+`suite` builds synthetic inputs (photos, screenshots, alpha PNGs, animated
+GIFs, text and scan PDFs) and times convert_image_to,
+compress_to_target_size, compress_pdf and the /convert request path. Every
+case runs in a fresh subprocess so its peak RSS is its own, with the result
+cache disabled. Each case reports p50/p95 latency, throughput, peak RSS,
+encode count and output/target size ratio; `--json` saves them for
+`compare`, which flags cases that got slower, bigger or hungrier.
+
+`parallel` builds a synthetic scanned PDF and times
+_render_pdf_to_compressed_pdf at each worker count, checking that every
+parallel run produces exactly the same PDF as the serial one.
+
+`presets` encodes the photo, screenshot and alpha inputs in each output
+format under every encoder preset (fast, balanced, max-compression) and
+reports encode time against output size, with sizes relative to a
+balanced JPEG of the same input.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+import PIL
+from PIL import Image, ImageDraw
+from reportlab import rl_config
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+import image_converter_flask as converter
+
+
+def make_scan_pdf(n_pages: int, seed: int = 0) -> bytes:
+    """Build an *n_pages* PDF where every page is a noisy 150 DPI A4 "scan"."""
+    rng = random.Random(seed)
+    pdf_io = io.BytesIO()
+    c = canvas.Canvas(pdf_io)
+    width_pt, height_pt = 595, 842
+
+    for page_index in range(n_pages):
+        scan = Image.effect_noise((1240, 1754), 12).point(lambda v: min(255, v + 110)).convert("RGB")
+        draw = ImageDraw.Draw(scan)
+        for line in range(60):
+            y = 80 + line * 26
+            draw.rectangle((100, y, 100 + rng.randint(400, 1040), y + 12), fill=(30, 30, 30))
+        draw.text((100, 30), f"Page {page_index + 1}", fill=(0, 0, 0))
+
+        img_io = io.BytesIO()
+        scan.save(img_io, format="JPEG", quality=85)
+        img_io.seek(0)
+        c.setPageSize((width_pt, height_pt))
+        c.drawImage(ImageReader(img_io), 0, 0, width=width_pt, height=height_pt)
+        c.showPage()
+
+    c.save()
+    return pdf_io.getvalue()
+
+
+def make_text_pdf(n_pages: int, seed: int = 0) -> bytes:
+    """Build an *n_pages* A4 PDF of plain vector text, like a typical report."""
+    rng = random.Random(seed)
+    words = ("image converter budget quality page render encode target size batch "
+             "stream archive proxy curve pixel resolution").split()
+    pdf_io = io.BytesIO()
+    c = canvas.Canvas(pdf_io, pagesize=(595, 842))
+
+    for page_index in range(n_pages):
+        c.setFont("Helvetica-Bold", 16)
+        c.drawString(60, 790, f"Section {page_index + 1}")
+        c.setFont("Helvetica", 10)
+        for line in range(55):
+            c.drawString(60, 760 - line * 13, " ".join(rng.choice(words) for _ in range(14)))
+        c.showPage()
+
+    c.save()
+    return pdf_io.getvalue()
+
+
+def make_photo(width: int, height: int, seed: int = 0):
+    """A photo-like RGB image: smooth gradients, soft colour blobs and sensor noise."""
+    rng = random.Random(seed)
+    gradient = Image.merge("RGB", (
+        Image.linear_gradient("L").resize((width, height)),
+        Image.linear_gradient("L").rotate(90).resize((width, height)),
+        Image.radial_gradient("L").resize((width, height)),
+    ))
+    # Seeded noise (unlike Image.effect_noise) keeps inputs identical between runs
+    blob_size = (max(1, width // 40), max(1, height // 40))
+    blobs = Image.frombytes("RGB", blob_size, rng.randbytes(blob_size[0] * blob_size[1] * 3))
+    blobs = blobs.resize((width, height), Image.BICUBIC)
+    noise = Image.frombytes("L", (width, height), rng.randbytes(width * height)).convert("RGB")
+    return Image.blend(Image.blend(gradient, blobs, 0.6), noise, 0.06)
+
+
+def make_screenshot(width: int, height: int, seed: int = 0):
+    """A UI screenshot: flat panels, buttons and lines of text."""
+    rng = random.Random(seed)
+    shot = Image.new("RGB", (width, height), (245, 246, 248))
+    draw = ImageDraw.Draw(shot)
+    draw.rectangle((0, 0, width, 56), fill=(33, 37, 41))
+    draw.rectangle((0, 56, 240, height), fill=(222, 226, 230))
+    for y in range(80, height - 40, 22):
+        draw.text((260, y), "Lorem ipsum dolor sit amet " * rng.randint(1, 4), fill=(40, 40, 40))
+        if rng.random() < 0.1:
+            x = rng.randint(260, width - 200)
+            draw.rounded_rectangle((x, y, x + 140, y + 18), 4, fill=(13, 110, 253))
+    return shot
+
+
+def make_alpha_png(size: int, seed: int = 0):
+    """An RGBA logo-style image: coloured shapes on a transparent background."""
+    rng = random.Random(seed)
+    image = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randint(0, size), rng.randint(0, size)
+        r = rng.randint(size // 20, size // 5)
+        colour = (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255), rng.randint(120, 255))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=colour)
+    return image
+
+
+def make_animated_gif(width: int, height: int, n_frames: int, seed: int = 0) -> bytes:
+    """A looping GIF of a ball moving over a static background."""
+    background = make_photo(width, height, seed).quantize(64).convert("RGB")
+    frames = []
+    for i in range(n_frames):
+        frame = background.copy()
+        x = int((width - 60) * i / max(1, n_frames - 1))
+        ImageDraw.Draw(frame).ellipse((x, height // 2 - 30, x + 60, height // 2 + 30), fill=(220, 30, 30))
+        frames.append(frame)
+    out = io.BytesIO()
+    frames[0].save(out, format="GIF", save_all=True, append_images=frames[1:], duration=80, loop=0)
+    return out.getvalue()
+
+
+def _image_bytes(image, fmt: str, **params) -> bytes:
+    out = io.BytesIO()
+    image.save(out, format=fmt, **params)
+    return out.getvalue()
+
+
+def build_inputs() -> dict:
+    """Name -> bytes of every synthetic input the suite uses (deterministic)."""
+    return {
+        "photo.jpg": _image_bytes(make_photo(3000, 2000, 1), "JPEG", quality=92),
+        "screenshot.png": _image_bytes(make_screenshot(1920, 1080, 2), "PNG"),
+        "alpha.png": _image_bytes(make_alpha_png(1024, 3), "PNG"),
+        "animation.gif": make_animated_gif(480, 270, 24, 4),
+        "text.pdf": make_text_pdf(20, 5),
+        "scan.pdf": make_scan_pdf(8, 6),
+    }
+
+
+# name -> (pipeline, inputs, params). Target sizes are in KB.
+SUITE_CASES = {
+    "image-photo-webp": ("convert_image_to", ["photo.jpg"], {"format": "webp", "quality": 80}),
+    "image-photo-jpg-passthrough": ("convert_image_to", ["photo.jpg"], {"format": "jpg", "quality": 95}),
+    "image-photo-jpg-target": ("compress_to_target_size", ["photo.jpg"], {"format": "jpg", "target_kb": 400}),
+    "image-photo-webp-thumb": ("convert_image_to", ["photo.jpg"],
+                               {"format": "webp", "quality": 80, "max_dimension": 800}),
+    "image-screenshot-webp": ("convert_image_to", ["screenshot.png"], {"format": "webp", "quality": 85}),
+    "image-screenshot-webp-target": ("compress_to_target_size", ["screenshot.png"],
+                                     {"format": "webp", "target_kb": 60}),
+    "image-alpha-jpg": ("convert_image_to", ["alpha.png"], {"format": "jpg", "quality": 85}),
+    "image-alpha-webp-target": ("compress_to_target_size", ["alpha.png"], {"format": "webp", "target_kb": 40}),
+    "image-gif-webp": ("convert_image_to", ["animation.gif"], {"format": "webp", "quality": 80}),
+    "image-gif-gif": ("convert_image_to", ["animation.gif"], {"format": "gif", "quality": 80}),
+    "image-gif-webp-target": ("compress_to_target_size", ["animation.gif"], {"format": "webp", "target_kb": 150}),
+    "pdf-text": ("compress_pdf", ["text.pdf"], {"target_kb": 0}),
+    "pdf-text-target": ("compress_pdf", ["text.pdf"], {"target_kb": 300}),
+    "pdf-scan-target": ("compress_pdf", ["scan.pdf"], {"target_kb": 400}),
+    "request-mixed": ("convert_request", ["photo.jpg", "screenshot.png", "alpha.png", "text.pdf"],
+                      {"img_format": "webp", "img_target_size": 500, "pdf_target_size": 300}),
+}
+
+
+def _peak_rss_mb() -> float:
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _run_pipeline(pipeline: str, inputs: dict, params: dict, client) -> tuple:
+    """Run one iteration of *pipeline*; returns (output_bytes, encodes)."""
+    if pipeline == "convert_image_to":
+        data = next(iter(inputs.values()))
+        stats = {}
+        output = converter.convert_image_to(io.BytesIO(data), params["format"], params["quality"], 0,
+                                            params.get("max_dimension", 0),
+                                            params.get("preset", converter.DEFAULT_PRESET), stats)
+        return len(output), stats["encodes"]
+
+    if pipeline == "compress_to_target_size":
+        # Decoded the way the app does, so animations keep their frames
+        image = converter._open_image(io.BytesIO(next(iter(inputs.values()))),
+                                      keep_frames=params["format"] in converter.ANIMATION_FORMATS)
+        stats = {}
+        output = converter.compress_to_target_size(image, params["format"], params["target_kb"], stats=stats)
+        return len(output), stats["encodes"]
+
+    if pipeline == "compress_pdf":
+        stats = {}
+        output = converter.compress_pdf(next(iter(inputs.values())), params["target_kb"], stats=stats)
+        return len(output), stats["encodes"]
+
+    if pipeline == "convert_request":
+        form = {key: str(value) for key, value in params.items()}
+        form["images"] = [(io.BytesIO(data), name) for name, data in inputs.items() if not name.endswith(".pdf")]
+        form["pdfs"] = [(io.BytesIO(data), name) for name, data in inputs.items() if name.endswith(".pdf")]
+        response = client.post("/convert", data=form, content_type="multipart/form-data")
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        info = archive.read("conversion_info.txt").decode()
+        encodes = sum(int(line.split(":")[1]) for line in info.splitlines()
+                      if line.startswith("Image encodes:"))
+        output_size = sum(entry.file_size for entry in archive.infolist()
+                          if entry.filename != "conversion_info.txt")
+        return output_size, encodes
+
+    raise ValueError(f"Unknown pipeline: {pipeline}")
+
+
+def run_case(name: str, input_dir: str, repeats: int) -> dict:
+    """Time one suite case in this process (called in a fresh subprocess)."""
+    pipeline, input_names, params = SUITE_CASES[name]
+    inputs = {}
+    for input_name in input_names:
+        with open(os.path.join(input_dir, input_name), "rb") as f:
+            inputs[input_name] = f.read()
+    client = converter.app.test_client() if pipeline == "convert_request" else None
+    baseline_rss = _peak_rss_mb()
+
+    # Warm-up run also gives the (deterministic) output size and encode count
+    output_size, encodes = _run_pipeline(pipeline, inputs, params, client)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        _run_pipeline(pipeline, inputs, params, client)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    input_bytes = sum(len(data) for data in inputs.values())
+    target_kb = params.get("target_kb") or (params.get("img_target_size", 0) + params.get("pdf_target_size", 0))
+    p50 = statistics.median(timings)
+    return {
+        "pipeline": pipeline,
+        "repeats": repeats,
+        "p50_s": p50,
+        "p95_s": timings[min(len(timings) - 1, math.ceil(0.95 * len(timings)) - 1)],
+        "throughput_mb_s": input_bytes / (1024 * 1024) / p50,
+        "files_per_s": len(inputs) / p50,
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": _peak_rss_mb(),
+        "encodes": encodes,
+        "input_bytes": input_bytes,
+        "output_bytes": output_size,
+        "output_target_ratio": output_size / (target_kb * 1024) if target_kb else None,
+    }
+
+
+def run_suite(case_names: list, repeats: int) -> dict:
+    """Run *case_names*, each in its own subprocess, and collect the results."""
+    results = {}
+    env = dict(os.environ, RESULT_CACHE_MB="0", RESULT_CACHE_DIR="")
+    with tempfile.TemporaryDirectory() as input_dir:
+        for input_name, data in build_inputs().items():
+            with open(os.path.join(input_dir, input_name), "wb") as f:
+                f.write(data)
+        for name in case_names:
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "_case", name, input_dir, str(repeats)],
+                env=env, capture_output=True, text=True)
+            if proc.returncode != 0:
+                results[name] = {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "failed"}
+            else:
+                results[name] = json.loads(proc.stdout.strip().splitlines()[-1])
+            _print_row(name, results[name])
+    return results
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def _print_header():
+    print(f"{'case':<30} {'p50 s':>7} {'p95 s':>7} {'MB/s':>7} {'RSS MB':>7} {'encodes':>7} "
+          f"{'out KB':>8} {'out/tgt':>7}")
+
+
+def _print_row(name: str, row: dict):
+    if "error" in row:
+        print(f"{name:<30} ERROR {row['error']}")
+        return
+    ratio = f"{row['output_target_ratio']:.2f}" if row["output_target_ratio"] is not None else "-"
+    print(f"{name:<30} {row['p50_s']:>7.3f} {row['p95_s']:>7.3f} {row['throughput_mb_s']:>7.2f} "
+          f"{row['peak_rss_mb']:>7.0f} {row['encodes']:>7} {row['output_bytes'] / 1024:>8.0f} {ratio:>7}")
+
+
+def compare_results(before: dict, after: dict, threshold: float) -> tuple:
+    """
+    Lines comparing two suite JSON files, and whether any case regressed:
+    p50 latency or peak RSS up by more than *threshold* percent, or an
+    output that now misses its target.
+    """
+    lines = [f"{'case':<30} {'p50 before':>10} {'p50 after':>10} {'change':>8} {'RSS change':>10} "
+             f"{'out change':>10}"]
+    regressed = False
+    for name in sorted(set(before["results"]) & set(after["results"])):
+        old, new = before["results"][name], after["results"][name]
+        if "error" in old or "error" in new:
+            lines.append(f"{name:<30} error in {'before' if 'error' in old else 'after'}")
+            regressed = regressed or "error" in new
+            continue
+        time_change = (new["p50_s"] / old["p50_s"] - 1) * 100
+        rss_change = (new["peak_rss_mb"] / old["peak_rss_mb"] - 1) * 100
+        out_change = (new["output_bytes"] / old["output_bytes"] - 1) * 100 if old["output_bytes"] else 0.0
+        flags = []
+        if time_change > threshold:
+            flags.append("SLOWER")
+        if rss_change > threshold:
+            flags.append("MORE MEMORY")
+        if (new["output_target_ratio"] or 0) > 1 >= (old["output_target_ratio"] or 0):
+            flags.append("MISSES TARGET")
+        regressed = regressed or bool(flags)
+        lines.append(f"{name:<30} {old['p50_s']:>10.3f} {new['p50_s']:>10.3f} {time_change:>+7.1f}% "
+                     f"{rss_change:>+9.1f}% {out_change:>+9.1f}%  {' '.join(flags)}")
+    return lines, regressed
+
+
+def bench_pdf_parallel(pdf_bytes: bytes, worker_counts: list, dpi: int, quality: int,
+                       chunk_size: int, repeats: int) -> list:
+    """Time page-parallel rendering at each worker count against the serial path."""
+    # Fixed timestamps and document IDs so outputs can be compared byte for byte
+    rl_config.invariant = 1
+
+    results = []
+    baseline = None
+    for workers in worker_counts:
+        # Warm the pool so process start-up isn't counted
+        converter._render_pdf_to_compressed_pdf(pdf_bytes, dpi, quality, workers, chunk_size).close()
+
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            with converter._render_pdf_to_compressed_pdf(pdf_bytes, dpi, quality, workers, chunk_size) as pdf_file:
+                output = pdf_file.read()
+            timings.append(time.perf_counter() - start)
+
+        best = min(timings)
+        if baseline is None:
+            baseline = (best, output)
+        results.append({
+            "workers": workers,
+            "seconds": best,
+            "speedup": baseline[0] / best,
+            "identical": output == baseline[1],
+        })
+    return results
+
+
+def bench_encoder_presets(inputs: dict, formats: list, quality: int, repeats: int) -> list:
+    """Best encode time and output size of every input x format x preset."""
+    results = []
+    for name, data in inputs.items():
+        image = converter._open_image(io.BytesIO(data))
+        reference = len(converter._encode_image(converter._prepare_image_for_format(image, "jpg"), "jpg",
+                                                quality, "balanced"))
+        for fmt in formats:
+            prepared = converter._prepare_image_for_format(image, fmt)
+            for preset in converter.ENCODER_PRESETS:
+                timings = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    output = converter._encode_image(prepared, fmt, quality, preset)
+                    timings.append(time.perf_counter() - start)
+                results.append({
+                    "input": name,
+                    "format": fmt,
+                    "preset": preset,
+                    "seconds": min(timings),
+                    "bytes": len(output),
+                    "vs_jpg": len(output) / reference,
+                })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    suite = commands.add_parser("suite", help="time every pipeline on synthetic inputs")
+    suite.add_argument("--cases", nargs="+", default=list(SUITE_CASES), choices=list(SUITE_CASES),
+                       metavar="CASE")
+    suite.add_argument("--repeats", type=int, default=5)
+    suite.add_argument("--json", help="write the results to this file")
+
+    compare = commands.add_parser("compare", help="diff two suite JSON files")
+    compare.add_argument("before")
+    compare.add_argument("after")
+    compare.add_argument("--threshold", type=float, default=10.0,
+                         help="percent change counted as a regression (default 10)")
+
+    parallel = commands.add_parser("parallel", help="time page-parallel PDF rendering")
+    parallel.add_argument("--pages", type=int, default=120)
+    parallel.add_argument("--workers", type=int, nargs="+",
+                          default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parallel.add_argument("--chunk", type=int, default=converter.PDF_RENDER_CHUNK_PAGES)
+    parallel.add_argument("--dpi", type=int, default=150)
+    parallel.add_argument("--quality", type=int, default=75)
+    parallel.add_argument("--repeats", type=int, default=3)
+
+    presets = commands.add_parser("presets", help="time each encoder preset against output size")
+    presets.add_argument("--formats", nargs="+", default=[f for f in converter.IMAGE_OUTPUT_FORMATS if f != "gif"],
+                         choices=converter.IMAGE_OUTPUT_FORMATS)
+    presets.add_argument("--inputs", nargs="+", default=["photo.jpg", "screenshot.png", "alpha.png"])
+    presets.add_argument("--quality", type=int, default=75)
+    presets.add_argument("--repeats", type=int, default=1)
+    presets.add_argument("--json", help="write the results to this file")
+
+    case = commands.add_parser("_case")  # Internal: one suite case in a fresh process
+    case.add_argument("name")
+    case.add_argument("input_dir")
+    case.add_argument("repeats", type=int)
+
+    args = parser.parse_args()
+
+    if args.command == "_case":
+        print(json.dumps(run_case(args.name, args.input_dir, args.repeats)))
+
+    elif args.command == "suite":
+        print(f"{os.cpu_count()} CPUs, {args.repeats} repeats per case\n")
+        _print_header()
+        report = {
+            "meta": {
+                "revision": _git_revision(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "pillow": PIL.__version__,
+                "cpu_count": os.cpu_count(),
+                "repeats": args.repeats,
+            },
+            "results": run_suite(args.cases, args.repeats),
+        }
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"\nWrote {args.json}")
+
+    elif args.command == "compare":
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        print(f"before: {before['meta'].get('revision') or args.before}  "
+              f"after: {after['meta'].get('revision') or args.after}\n")
+        lines, regressed = compare_results(before, after, args.threshold)
+        print("\n".join(lines))
+        sys.exit(1 if regressed else 0)
+
+    elif args.command == "presets":
+        all_inputs = build_inputs()
+        inputs = {name: all_inputs[name] for name in args.inputs}
+        print(f"{os.cpu_count()} CPUs, quality {args.quality}, best of {args.repeats}\n")
+        print(f"{'input':<16} {'format':<6} {'preset':<16} {'seconds':>8} {'KB':>9} {'vs jpg':>7}")
+        rows = bench_encoder_presets(inputs, args.formats, args.quality, args.repeats)
+        for row in rows:
+            print(f"{row['input']:<16} {row['format']:<6} {row['preset']:<16} {row['seconds']:>8.2f} "
+                  f"{row['bytes'] / 1024:>9.1f} {row['vs_jpg']:>7.2f}")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"meta": {"revision": _git_revision(), "pillow": PIL.__version__,
+                                    "cpu_count": os.cpu_count(), "quality": args.quality},
+                           "results": rows}, f, indent=2)
+            print(f"\nWrote {args.json}")
+
+    else:
+        print(f"Building {args.pages}-page scan PDF...")
+        pdf_bytes = make_scan_pdf(args.pages)
+        print(f"Source: {len(pdf_bytes) / 1024:.0f} KB, {os.cpu_count()} CPUs, chunk {args.chunk} pages\n")
+
+        print(f"{'workers':>7}  {'seconds':>8}  {'pages/s':>8}  {'speedup':>7}  identical")
+        for row in bench_pdf_parallel(pdf_bytes, args.workers, args.dpi, args.quality, args.chunk, args.repeats):
+            print(f"{row['workers']:>7}  {row['seconds']:>8.2f}  {args.pages / row['seconds']:>8.1f}  "
+                  f"{row['speedup']:>6.2f}x  {row['identical']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,246 @@
 # image_converter_flask.py
 import os
 import io
+import math
+import heapq
 import zipfile
+import shutil
 import tempfile
+import threading
+import time
+import uuid
+import hashlib
+import json
+import contextlib
+import contextvars
+import multiprocessing
+import subprocess
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import itertools
+import collections
+from itertools import repeat
 from datetime import datetime
-from PIL import Image, UnidentifiedImageError
+import numpy as np
+from PIL import Image, ImageSequence, TiffImagePlugin, TiffTags, UnidentifiedImageError
 from flask import (
-    Flask, request, render_template_string, send_file, redirect, url_for, flash
+    Flask, Response, request, render_template_string, send_file, redirect, url_for, flash,
+    jsonify
 )
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 import pypdfium2 as pdfium
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
+import pypdfium2.raw as pdfium_c
+import pikepdf
+try:
+    import pillow_jxl  # noqa: F401 - registers a JPEG XL plugin with Pillow
+except ImportError:
+    pillow_jxl = None
+
+try:
+    import resource  # Peak RSS for the /metrics endpoint; not available on Windows
+except ImportError:
+    resource = None
 
 app = Flask(__name__)
 app.secret_key = "replace-this-with-a-random-secret"  # for flash messages
 
 # Allowed input extensions
-ALLOWED_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff", ".gif", ".pdf"}
+ALLOWED_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff", ".gif", ".avif", ".jxl", ".pdf"}
+IMAGE_EXTS = ALLOWED_EXTS - {".pdf"}
+
+# Output formats (extension -> Pillow format). AVIF and JPEG XL are offered
+# only when this Pillow build can write them.
+Image.init()
+_PIL_OUTPUT_FORMATS = {"webp": "WEBP", "jpg": "JPEG", "png": "PNG", "gif": "GIF", "avif": "AVIF", "jxl": "JXL"}
+IMAGE_OUTPUT_FORMATS = [ext for ext, fmt in _PIL_OUTPUT_FORMATS.items() if fmt in Image.SAVE]
+
+# Encoder speed/effort presets: extra save options per output format.
+# "fast" spends the least CPU, "max-compression" the most for the smallest
+# files; "balanced" matches the encoders' usual defaults (for PNG, Pillow's
+# zlib level 6 without optimize, as plain PNG conversion always used).
+ENCODER_PRESETS = {
+    "fast": {
+        "jpg": {"optimize": False},
+        "webp": {"method": 0},
+        "png": {"compress_level": 1},
+        "avif": {"speed": 8},
+        "jxl": {"effort": 3},
+    },
+    "balanced": {
+        "jpg": {"optimize": True},
+        "webp": {"method": 4},
+        "png": {"compress_level": 6},
+        "avif": {"speed": 6},
+        "jxl": {"effort": 7},
+    },
+    "max-compression": {
+        "jpg": {"optimize": True, "progressive": True},
+        "webp": {"method": 6},
+        "png": {"optimize": True},
+        "avif": {"speed": 4},
+        "jxl": {"effort": 9},
+    },
+}
+DEFAULT_PRESET = "balanced"
+
+# JPEG fast path: a JPEG going out as JPEG at no higher quality is only
+# stripped of metadata, never decoded. With jpegtran installed its Huffman
+# tables are also re-optimised losslessly, per preset.
+JPEGTRAN = os.environ.get("JPEGTRAN", shutil.which("jpegtran") or "")
+JPEGTRAN_PRESET_ARGS = {
+    "fast": [],
+    "balanced": ["-optimize"],
+    "max-compression": ["-optimize", "-progressive"],
+}
+# APPn segments the fast path keeps: JFIF, ICC profile and Adobe colour transform
+JPEG_KEPT_SEGMENTS = ((0xE0, b"JFIF\0"), (0xE2, b"ICC_PROFILE\0"), (0xEE, b"Adobe"))
+# IJG's quality-50 luminance quantization table, which libjpeg scales for
+# every other quality; used to estimate the quality a JPEG was saved at
+JPEG_STD_LUMINANCE_TABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99,
+)
+
+# Uploads are copied to private temp files that stay in memory up to this size
+UPLOAD_SPOOL_BYTES = 2 * 1024 * 1024
+
+# Upload limits, checked before anything is decoded: the whole request (413
+# beyond it), each file, pixels per image (frame) and pages per PDF
+MAX_REQUEST_MB = int(os.environ.get("MAX_REQUEST_MB", 512))
+MAX_FILE_MB = int(os.environ.get("MAX_FILE_MB", 200))
+MAX_IMAGE_MEGAPIXELS = int(os.environ.get("MAX_IMAGE_MEGAPIXELS", 150))
+MAX_PDF_PAGES = int(os.environ.get("MAX_PDF_PAGES", 2000))
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_MB * 1024 * 1024
+# Pillow refuses to open anything over twice this, whichever path decodes it
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_MEGAPIXELS * 1_000_000
+# Bytes read to sniff an upload's type
+UPLOAD_SNIFF_BYTES = 4096
+
+# Threads converting images, shared by all batches
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", os.cpu_count() or 1))
+_image_pool = ThreadPoolExecutor(max_workers=max(1, IMAGE_WORKERS), thread_name_prefix="image")
+
+# Uploads of LARGE_IMAGE_MEGAPIXELS or more (all frames) convert on their
+# own pool of LARGE_IMAGE_WORKERS threads instead, so a few huge images
+# can't run the process out of memory together while ordinary images
+# carry on at full parallelism
+LARGE_IMAGE_MEGAPIXELS = int(os.environ.get("LARGE_IMAGE_MEGAPIXELS", 32))
+LARGE_IMAGE_WORKERS = int(os.environ.get("LARGE_IMAGE_WORKERS", 1))
+_large_image_pool = ThreadPoolExecutor(max_workers=max(1, LARGE_IMAGE_WORKERS), thread_name_prefix="large-image")
+
+# Shrinking an image over TILED_DECODE_MEGAPIXELS decodes it a strip of
+# about STRIP_DECODE_MEGAPIXELS at a time when it is a non-interlaced 8-bit
+# PNG or a striped TIFF, so memory follows the output size, not the input's
+TILED_DECODE_MEGAPIXELS = int(os.environ.get("TILED_DECODE_MEGAPIXELS", 32))
+STRIP_DECODE_MEGAPIXELS = int(os.environ.get("STRIP_DECODE_MEGAPIXELS", 4))
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Baseline TIFF tags describing the pixel data, copied into each strip's file
+TIFF_STRIP_TAGS = (256, 258, 259, 262, 266, 277, 278, 284, 317, 320, 338, 339, 347, 529, 530, 531, 532)
+
+# Output formats that keep every frame of an animated upload (GIF, animated
+# WebP or APNG); other formats take the first frame. Per-frame work (resizing,
+# duplicate detection, GIF palettes) runs on a separate pool of FRAME_WORKERS
+# threads, since the image pool's threads wait on it. The distinct frames
+# kept after resizing may add up to MAX_ANIMATION_MEGAPIXELS at most.
+ANIMATION_FORMATS = {"webp", "gif"}
+FRAME_WORKERS = int(os.environ.get("FRAME_WORKERS", os.cpu_count() or 1))
+MAX_ANIMATION_MEGAPIXELS = int(os.environ.get("MAX_ANIMATION_MEGAPIXELS", 100))
+_frame_pool = ThreadPoolExecutor(max_workers=max(1, FRAME_WORKERS), thread_name_prefix="frame")
+
+# Background jobs (POST /jobs): worker threads, and how long finished jobs
+# and their ZIPs are kept. Jobs live in this process's memory, so the app
+# must run as a single gunicorn worker (threads are fine).
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", 3600))
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+
+# Admission control: image and PDF work run in separate lanes, each with a
+# number of batches converting at once and a bounded queue behind them
+# (by count and by total cost: megapixels for images, pages for PDFs).
+# Requests that would overflow a queue get 503 with Retry-After.
+IMAGE_LANE_SLOTS = int(os.environ.get("IMAGE_LANE_SLOTS", os.cpu_count() or 1))
+IMAGE_LANE_QUEUE = int(os.environ.get("IMAGE_LANE_QUEUE", 4 * IMAGE_LANE_SLOTS))
+IMAGE_LANE_QUEUE_MEGAPIXELS = int(os.environ.get("IMAGE_LANE_QUEUE_MEGAPIXELS", 1000))
+PDF_LANE_SLOTS = int(os.environ.get("PDF_LANE_SLOTS", max(1, (os.cpu_count() or 1) // 2)))
+PDF_LANE_QUEUE = int(os.environ.get("PDF_LANE_QUEUE", 4 * PDF_LANE_SLOTS))
+PDF_LANE_QUEUE_PAGES = int(os.environ.get("PDF_LANE_QUEUE_PAGES", 2000))
+
+# Page-parallel PDF rendering: number of worker processes and pages per task
+PDF_RENDER_WORKERS = int(os.environ.get("PDF_RENDER_WORKERS", os.cpu_count() or 1))
+PDF_RENDER_CHUNK_PAGES = int(os.environ.get("PDF_RENDER_CHUNK_PAGES", 8))
+
+# Quality ladder tried when the first PDF pass misses its target, and the
+# memory cap for the page bitmaps it shares before spilling them to disk
+PDF_FALLBACK_LADDER = [(100, 35), (72, 25), (72, 15), (72, 10)]
+PDF_BITMAP_CACHE_MB = int(os.environ.get("PDF_BITMAP_CACHE_MB", 256))
+
+# (dpi, quality) rungs the per-page budget allocator picks from, lowest first
+PDF_PAGE_SETTINGS = [(72, 15), (72, 25), (100, 30), (100, 45), (120, 55), (150, 65), (150, 75)]
+# Resolution of the cheap page probe behind the allocator's size predictions
+PDF_PROBE_DPI = 36
+# Page JPEGs are embedded as-is; this factor covers each page's objects,
+# plus a fixed overhead for the file structure
+PDF_IMAGE_OVERHEAD = 1.01
+PDF_FILE_OVERHEAD = 2048
+# Rasterized PDFs are written page by page to a temp file that stays in
+# memory up to this size and moves to disk beyond it
+PDF_OUTPUT_SPOOL_MB = int(os.environ.get("PDF_OUTPUT_SPOOL_MB", 16))
+
+# Structural (non-rasterizing) PDF optimization: (max image DPI, JPEG
+# quality) rungs for embedded images, tried in order until a target fits
+PDF_STRUCTURAL_LADDER = [(150, 80), (120, 60), (100, 45), (72, 30)]
+# In "auto" mode a page counts as a scan when it has no text and images
+# cover at least this share of it; documents made only of scans are rasterized
+PDF_SCAN_COVERAGE = 0.85
+
+# Exporting PDF pages as images (pdf_export_format): formats and resolution
+PDF_EXPORT_FORMATS = [ext for ext in ("webp", "png", "jpg") if ext in IMAGE_OUTPUT_FORMATS]
+PDF_EXPORT_DPI = 150
+PDF_EXPORT_DPI_RANGE = (36, 600)
+
+# Combining images into one PDF: pages are sized from each image's DPI,
+# assumed to be this when the file doesn't say, and kept within the
+# largest page size viewers accept
+IMAGE_PDF_DEFAULT_DPI = 96
+PDF_MAX_PAGE_POINTS = 14400
+# The EXIF Orientation tag, and the transpose that turns each of its values
+# upright (the same mapping as ImageOps.exif_transpose); 5-8 swap the sides
+EXIF_ORIENTATION = 0x0112
+ORIENTATION_TRANSPOSES = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+_render_pool = None
+_render_pool_workers = 0
+_render_pool_lock = threading.Lock()
+
+# Converted results keyed on input bytes + settings: an in-memory LRU of
+# RESULT_CACHE_MB, backed by up to RESULT_CACHE_DISK_MB under
+# RESULT_CACHE_DIR when that is set
+RESULT_CACHE_MB = int(os.environ.get("RESULT_CACHE_MB", 128))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_MB = int(os.environ.get("RESULT_CACHE_DISK_MB", 1024))
+# Part of every cache key: bump it when the output for the same input and
+# settings changes, so the disk tier doesn't serve results from older code
+RESULT_CACHE_VERSION = 2
 
 def validate_pdf_input(pdf_bytes: bytes) -> bool:
-    """Check if input bytes look like a valid PDF."""
-    return pdf_bytes[:5].startswith(b'%PDF-')
+    """Check if input bytes look like a valid PDF (readers allow the header anywhere in the first 1 KB)."""
+    return b'%PDF-' in pdf_bytes[:1024]
 
 # Modern Template with separate Image and PDF sections
 INDEX_HTML = """
@@ -198,23 +417,53 @@ INDEX_HTML = """
           <div class="mb-4">
             <label class="form-label"><i class="fas fa-file-upload"></i> Select Images</label>
             <input class="form-control" type="file" name="images" accept="image/*" multiple>
-            <div class="form-text"><i class="fas fa-info-circle"></i> Supported: JPG, JPEG, PNG, WEBP, BMP, TIFF, GIF</div>
+            <div class="form-text"><i class="fas fa-info-circle"></i> Supported: JPG, JPEG, PNG, WEBP, BMP, TIFF, GIF, AVIF, JXL</div>
           </div>
 
           <div class="row mb-4">
-            <div class="col-md-6">
+            <div class="col-md-4">
               <label class="form-label"><i class="fas fa-exchange-alt"></i> Output Format</label>
               <select class="form-select" name="img_format">
                 <option value="">Keep Original</option>
                 <option value="webp">WEBP (Modern & Small)</option>
                 <option value="jpg" selected>JPG (Universal)</option>
                 <option value="png">PNG (Lossless)</option>
+                <option value="gif">GIF (Animated)</option>
+                {% if "avif" in output_formats %}<option value="avif">AVIF (Smallest)</option>{% endif %}
+                {% if "jxl" in output_formats %}<option value="jxl">JPEG XL</option>{% endif %}
               </select>
             </div>
-            <div class="col-md-6">
+            <div class="col-md-4">
               <label class="form-label"><i class="fas fa-sliders-h"></i> Quality (1-100)</label>
               <input type="number" name="img_quality" class="form-control" value="85" min="1" max="100">
             </div>
+            <div class="col-md-4">
+              <label class="form-label"><i class="fas fa-expand-arrows-alt"></i> Max Width/Height (px)</label>
+              <input type="number" name="img_max_dimension" class="form-control" placeholder="Original size" min="16" max="20000">
+            </div>
+          </div>
+
+          <div class="row mb-4">
+            <div class="col-md-4">
+              <label class="form-label"><i class="fas fa-tachometer-alt"></i> Encoder Effort</label>
+              <select class="form-select" name="img_preset">
+                <option value="fast">Fast</option>
+                <option value="balanced" selected>Balanced</option>
+                <option value="max-compression">Max compression (slow)</option>
+              </select>
+            </div>
+            <div class="col-md-4">
+              <label class="form-label"><i class="fas fa-eye"></i> Target SSIM (0.5-0.999)</label>
+              <input type="number" name="img_target_ssim" class="form-control" placeholder="Off (use quality)" min="0.5" max="0.999" step="0.001">
+            </div>
+            <div class="col-md-4 d-flex align-items-end">
+              <div class="form-check">
+                <input class="form-check-input" type="checkbox" name="img_combine_pdf" id="imgCombinePdf" value="1">
+                <label class="form-check-label" for="imgCombinePdf">
+                  <i class="fas fa-layer-group"></i> Combine into one PDF
+                </label>
+              </div>
+            </div>
           </div>
 
           <div class="slider-container">
@@ -262,9 +511,44 @@ INDEX_HTML = """
               <small class="text-muted">10000 KB</small>
             </div>
             <small class="text-muted d-block mt-2" style="color: #6c757d; font-style: italic;">
-              <i class="fas fa-info-circle"></i> PDFs are re-rendered and recompressed. Combined target for ALL selected PDFs.
+              <i class="fas fa-info-circle"></i> Combined target for ALL selected PDFs.
             </small>
           </div>
+
+          <div class="mt-3">
+            <label class="form-label"><i class="fas fa-cogs"></i> Compression Mode</label>
+            <select name="pdf_mode" class="form-select">
+              <option value="auto" selected>Auto (keep text, rasterize scans)</option>
+              <option value="lossless">Lossless (restructure only)</option>
+              <option value="raster">Rasterize every page</option>
+            </select>
+          </div>
+
+          <div class="row mt-3">
+            <div class="col-md-8">
+              <label class="form-label"><i class="fas fa-images"></i> Output</label>
+              <select name="pdf_export_format" class="form-select">
+                <option value="" selected>Compressed PDF</option>
+                <option value="webp">Pages as WEBP images</option>
+                <option value="png">Pages as PNG images</option>
+                <option value="jpg">Pages as JPG images</option>
+              </select>
+            </div>
+            <div class="col-md-4">
+              <label class="form-label"><i class="fas fa-ruler-combined"></i> Page DPI</label>
+              <input type="number" name="pdf_export_dpi" class="form-control" value="150" min="36" max="600">
+            </div>
+          </div>
+          <small class="text-muted d-block mt-2" style="color: #6c757d; font-style: italic;">
+            <i class="fas fa-info-circle"></i> Page images use the image quality and encoder effort above.
+          </small>
+        </div>
+
+        <div class="form-check mb-3">
+          <input class="form-check-input" type="checkbox" name="stage_breakdown" id="stageBreakdown" value="1">
+          <label class="form-check-label text-white" for="stageBreakdown">
+            Add a timing breakdown to conversion_info.txt
+          </label>
         </div>
 
         <!-- SUBMIT BUTTON -->
@@ -314,446 +598,3604 @@ def allowed_filename(filename: str) -> bool:
     _, ext = os.path.splitext(filename.lower())
     return ext in ALLOWED_EXTS
 
-def compress_to_target_size(image, target_format: str, target_size_kb: int, initial_quality: int = 90) -> bytes:
+def _check_upload(storage, kind: str):
     """
-    Compress an image to meet target file size in KB.
+    Cheap checks on an upload before anything decodes it: its size, magic
+    bytes, and the dimensions, frame count or page count from its header.
+    Returns the reason to reject it, or None.
     """
-    target_bytes = target_size_kb * 1024
-    quality = initial_quality
-    
-    # For formats like JPEG that don't support alpha, convert RGBA->RGB
-    if target_format in ("jpg", "jpeg"):
-        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
-            background = Image.new("RGB", image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1])
-            image = background
-        else:
-            image = image.convert("RGB")
-    
-    # Try to compress to target size
-    for attempt in range(15):  # Max 15 attempts for better compression
-        out_io = io.BytesIO()
-        save_kwargs = {}
-        
-        if target_format in ("jpg", "jpeg"):
-            save_kwargs["format"] = "JPEG"
-            save_kwargs["quality"] = max(5, quality)  # Minimum quality of 5
-            save_kwargs["optimize"] = True
-        elif target_format == "webp":
-            save_kwargs["format"] = "WEBP"
-            save_kwargs["quality"] = max(5, quality)
-        elif target_format == "png":
-            save_kwargs["format"] = "PNG"
-            save_kwargs["optimize"] = True
-        
-        image.save(out_io, **save_kwargs)
-        current_size = out_io.tell()
-        
-        if current_size <= target_bytes or quality <= 5:
-            out_io.seek(0)
-            return out_io.read()
-        
-        # Reduce quality for next attempt (more aggressive)
-        quality -= 7
-    
-    out_io.seek(0)
-    return out_io.read()
+    stream = storage.stream
+    size = stream.seek(0, os.SEEK_END)
+    try:
+        if size > MAX_FILE_MB * 1024 * 1024:
+            return f"larger than {MAX_FILE_MB} MB"
+        stream.seek(0)
+        head = stream.read(UPLOAD_SNIFF_BYTES)
+        if not head:
+            return "empty file"
+        if kind == "pdf":
+            if not validate_pdf_input(head):
+                return "not a PDF (no %PDF- header)"
+            # PDFium reads just the trailer and cross-reference table here
+            stream.seek(0)
+            try:
+                src_pdf = pdfium.PdfDocument(stream)
+                try:
+                    pages = len(src_pdf)
+                finally:
+                    src_pdf.close()
+            except pdfium.PdfiumError as e:
+                return f"not a readable PDF ({e})"
+            if pages > MAX_PDF_PAGES:
+                return f"{pages} pages, more than the {MAX_PDF_PAGES} allowed"
+            return None
 
-def convert_image_to(img_stream, target_format: str, quality: int, target_size_kb: int = 0) -> bytes:
-    """
-    Convert an image (file-like stream) to target_format and return bytes.
-    target_format: 'webp', 'jpg' or 'png'
-    target_size_kb: If > 0, compress to this size in KB
-    """
-    img_stream.seek(0)
-    image = Image.open(img_stream)
-    
-    # If target size specified, use compression algorithm
-    if target_size_kb > 10:
-        return compress_to_target_size(image, target_format, target_size_kb, quality)
-    
-    # For formats like JPEG that don't support alpha, convert RGBA->RGB
-    if target_format in ("jpg", "jpeg") or target_format == "jpg":
-        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
-            background = Image.new("RGB", image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1])  # paste using alpha channel as mask
-            image = background
+        # Image.open only parses the header; pixels are decoded later
+        stream.seek(0)
+        try:
+            with Image.open(stream) as image:
+                width, height = image.size
+                # Counting GIF/APNG/WebP frames walks their headers, not pixels
+                frames = getattr(image, "n_frames", 1)
+        except Image.DecompressionBombError:
+            return f"more than {MAX_IMAGE_MEGAPIXELS} megapixels"
+        except Exception:
+            return "not a recognised image"
+        if width * height * frames > MAX_IMAGE_MEGAPIXELS * 1_000_000:
+            if frames > 1:
+                return (f"{frames} frames of {width}x{height} is more than "
+                        f"{MAX_IMAGE_MEGAPIXELS} megapixels")
+            return f"{width}x{height} is more than {MAX_IMAGE_MEGAPIXELS} megapixels"
+        return None
+    finally:
+        stream.seek(0)
+
+def _screen_uploads(files: list, kind: str, notes: list) -> list:
+    """Return the *files* that pass _check_upload, noting each rejection in *notes*."""
+    accepted = []
+    for storage in files:
+        reason = _check_upload(storage, kind)
+        if reason:
+            notes.append(f"Rejected {secure_filename(storage.filename) or 'upload'}: {reason}")
         else:
-            image = image.convert("RGB")
-    # For PNG preserve transparency, for WEBP can preserve alpha.
-    out_io = io.BytesIO()
-    save_kwargs = {}
-    if target_format in ("jpg", "jpeg"):
-        save_kwargs["format"] = "JPEG"
-        save_kwargs["quality"] = int(quality)
-        save_kwargs["optimize"] = True
-    elif target_format == "webp":
-        save_kwargs["format"] = "WEBP"
-        save_kwargs["quality"] = int(quality)
-        # allow alpha in webp if present
-    elif target_format == "png":
-        save_kwargs["format"] = "PNG"
-        # PNG is lossless; quality param ignored
-    else:
-        raise ValueError("Unsupported target format")
+            accepted.append(storage)
+    return accepted
 
-    image.save(out_io, **save_kwargs)
-    out_io.seek(0)
-    return out_io.read()
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    message = f"Upload too large: requests are limited to {MAX_REQUEST_MB} MB."
+    if request.path.startswith("/api/"):
+        return _api_error(413, "too_large", message)
+    if request.path.startswith("/jobs"):
+        return jsonify(error=message), 413
+    flash(message)
+    return redirect(url_for("index"))
+
+class _LaneSaturated(Exception):
+    """Raised when a request can't even be queued in an admission lane."""
+
+    def __init__(self, lane: str, retry_after: int):
+        super().__init__(f"The {lane} queue is full; retry in {retry_after} s")
+        self.lane = lane
+        self.retry_after = retry_after
+
+class _LaneTicket:
+    """A request's place in an _AdmissionLane: wait() for a slot, then release()."""
+
+    def __init__(self, lane, cost: float):
+        self.lane = lane
+        self.cost = cost
+        self.started = None
+        self.released = False
+        self.waiting = False
+
+    def wait(self) -> None:
+        self.lane._start(self)
+
+    def release(self) -> None:
+        self.lane._finish(self)
 
-def compress_pdf(pdf_bytes: bytes, target_size_kb: int = 0, quality: int = 80) -> bytes:
+class _AdmissionLane:
     """
-    Compress a PDF by rasterizing each page to an image, compressing it,
-    and rebuilding a new PDF from the compressed images.
-    
-    This is how real PDF compressors (iLovePDF, SmallPDF, etc.) work for
-    image-heavy / scanned PDFs.
-    
-    Args:
-        pdf_bytes: Raw bytes of the source PDF.
-        target_size_kb: If > 0, try to get total size under this (KB).
-        quality: JPEG quality to use (1-95). Lower = smaller file.
-    Returns:
-        Compressed PDF bytes.
+    Bounded FIFO admission for one kind of work. At most *slots* tickets run
+    at once; behind them at most *max_queued* tickets with a total cost of
+    *max_queued_cost* may wait (a lone request is always queued, however
+    big). enqueue() raises _LaneSaturated past that, with a Retry-After
+    estimate from the cost throughput seen so far.
+
+    Queue order only counts among tickets that have called wait(): a ticket
+    admitted for a later phase (the PDF half of a mixed batch, or a /jobs
+    batch still behind the job executor) keeps its place in the queue bounds
+    but doesn't hold back the tickets behind it.
     """
-    # Determine the rendering DPI. Higher DPI = better quality but bigger.
-    # Default 150 DPI is a good balance; drop to 100 or 72 for extreme compression.
-    dpi = 150
-    
-    # If we have a very aggressive target, start with lower DPI and quality
-    if target_size_kb > 0:
-        # Rough heuristic: open the PDF to count pages
-        src_pdf = pdfium.PdfDocument(pdf_bytes)
-        n_pages = len(src_pdf)
-        per_page_kb = target_size_kb / max(n_pages, 1)
-        
-        # Adjust DPI and quality based on per-page budget
-        if per_page_kb < 30:
-            dpi, quality = 72, 15
-        elif per_page_kb < 60:
-            dpi, quality = 72, 25
-        elif per_page_kb < 100:
-            dpi, quality = 100, 30
-        elif per_page_kb < 200:
-            dpi, quality = 100, 45
-        elif per_page_kb < 400:
-            dpi, quality = 120, 55
-        elif per_page_kb < 600:
-            dpi, quality = 150, 65
-        else:
-            dpi, quality = 150, 75
-        src_pdf.close()
-    
-    compressed = _render_pdf_to_compressed_pdf(pdf_bytes, dpi, quality)
-    
-    # If we have a target and we're still over, do a second pass with lower settings
-    if target_size_kb > 0 and len(compressed) > target_size_kb * 1024:
-        for fallback_dpi, fallback_q in [(100, 35), (72, 25), (72, 15), (72, 10)]:
-            compressed = _render_pdf_to_compressed_pdf(pdf_bytes, fallback_dpi, fallback_q)
-            if len(compressed) <= target_size_kb * 1024:
-                break
-    
-    return compressed
 
+    def __init__(self, name: str, slots: int, max_queued: int, max_queued_cost: float):
+        self.name = name
+        self.slots = max(1, slots)
+        self.max_queued = max_queued
+        self.max_queued_cost = max_queued_cost
+        self._cond = threading.Condition()
+        self._waiting = collections.deque()
+        self._active = set()
+        self._rate = None  # Cost units per second of one slot, smoothed
+        self.counters = {"admitted": 0, "rejected": 0}
+
+    def enqueue(self, cost: float) -> _LaneTicket:
+        cost = max(cost, 1)
+        with self._cond:
+            queued_cost = sum(t.cost for t in self._waiting)
+            must_queue = self._waiting or len(self._active) >= self.slots
+            if must_queue and (len(self._waiting) >= self.max_queued
+                               or (self._waiting and queued_cost + cost > self.max_queued_cost)):
+                self.counters["rejected"] += 1
+                raise _LaneSaturated(self.name, self._retry_after(queued_cost + cost))
+            ticket = _LaneTicket(self, cost)
+            self._waiting.append(ticket)
+            self.counters["admitted"] += 1
+            return ticket
+
+    def _retry_after(self, queued_cost: float) -> int:
+        # Caller holds the lock
+        if not self._rate:
+            return min(300, 5 * (len(self._waiting) + 1))
+        backlog = queued_cost + sum(t.cost for t in self._active) / 2
+        return max(1, min(300, math.ceil(backlog / (self._rate * self.slots))))
+
+    def _start(self, ticket: _LaneTicket) -> None:
+        with self._cond:
+            ticket.waiting = True
+            while not (self._next_waiting() is ticket and len(self._active) < self.slots):
+                if ticket.released:
+                    return
+                self._cond.wait()
+            self._waiting.remove(ticket)
+            self._active.add(ticket)
+            ticket.started = time.monotonic()
+            self._cond.notify_all()
+
+    def _next_waiting(self):
+        # Caller holds the lock
+        return next((t for t in self._waiting if t.waiting), None)
+
+    def _finish(self, ticket: _LaneTicket) -> None:
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket in self._active:
+                self._active.discard(ticket)
+                seconds = time.monotonic() - ticket.started
+                if seconds > 0:
+                    rate = ticket.cost / seconds
+                    self._rate = rate if self._rate is None else 0.8 * self._rate + 0.2 * rate
+            elif ticket in self._waiting:
+                self._waiting.remove(ticket)
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(
+                self.counters,
+                slots=self.slots,
+                active=len(self._active),
+                queued=len(self._waiting),
+                queued_cost=sum(t.cost for t in self._waiting),
+                max_queued=self.max_queued,
+                max_queued_cost=self.max_queued_cost,
+                cost_per_second=self._rate,
+            )
+
+_admission_lanes = {
+    "image": _AdmissionLane("image", IMAGE_LANE_SLOTS, IMAGE_LANE_QUEUE, IMAGE_LANE_QUEUE_MEGAPIXELS),
+    "pdf": _AdmissionLane("pdf", PDF_LANE_SLOTS, PDF_LANE_QUEUE, PDF_LANE_QUEUE_PAGES),
+}
+
+def _estimate_image_cost(storage) -> float:
+    """Megapixels of an upload (counting every frame), from its header; 0 if unreadable."""
+    try:
+        storage.stream.seek(0)
+        with Image.open(storage.stream) as image:
+            width, height = image.size
+            frames = getattr(image, "n_frames", 1)
+        return width * height * frames / 1e6
+    except Exception:
+        return 0.0
+    finally:
+        storage.stream.seek(0)
+
+def _estimate_pdf_cost(storage) -> int:
+    """Page count of an uploaded PDF; 0 if it can't be read."""
+    try:
+        storage.stream.seek(0)
+        src_pdf = pdfium.PdfDocument(storage.stream)
+        try:
+            return len(src_pdf)
+        finally:
+            src_pdf.close()
+    except Exception:
+        return 0
+    finally:
+        storage.stream.seek(0)
 
-def _render_pdf_to_compressed_pdf(pdf_bytes: bytes, dpi: int = 150, quality: int = 75) -> bytes:
+def _admit_batch(image_files: list, pdf_files: list) -> dict:
     """
-    Core routine: render every page of *pdf_bytes* at *dpi*, compress each
-    page image as JPEG at *quality*, and assemble a new PDF with ReportLab.
+    Queue a batch in the lanes it needs, returning {lane: ticket}. Raises
+    _LaneSaturated (holding no tickets) if any lane is full.
     """
-    src_pdf = pdfium.PdfDocument(pdf_bytes)
-    page_images = []
-    
+    tickets = {}
     try:
-        for page_index in range(len(src_pdf)):
-            page = src_pdf[page_index]
-            
-            # Get the page size in points (1 point = 1/72 inch)
-            width_pt = page.get_width()
-            height_pt = page.get_height()
-            
-            # Render to bitmap
-            scale = dpi / 72.0
-            bitmap = page.render(scale=scale, rotation=0)
-            pil_image = bitmap.to_pil()
-            
-            # Convert to RGB if needed (drop alpha)
-            if pil_image.mode != "RGB":
-                background = Image.new("RGB", pil_image.size, (255, 255, 255))
-                if pil_image.mode == "RGBA":
-                    background.paste(pil_image, mask=pil_image.split()[-1])
-                else:
-                    background.paste(pil_image)
-                pil_image = background
-            
-            # Compress to JPEG in memory
-            img_io = io.BytesIO()
-            pil_image.save(img_io, format="JPEG", quality=quality, optimize=True)
-            img_io.seek(0)
-            
-            page_images.append((img_io, width_pt, height_pt))
-    finally:
-        src_pdf.close()
-    
-    # Build a new PDF with ReportLab
-    pdf_io = io.BytesIO()
-    c = canvas.Canvas(pdf_io)
-    
-    for img_io, w_pt, h_pt in page_images:
-        c.setPageSize((w_pt, h_pt))
-        c.drawImage(ImageReader(img_io), 0, 0, width=w_pt, height=h_pt)
-        c.showPage()
-    
-    c.save()
-    pdf_io.seek(0)
-    return pdf_io.getvalue()
+        if image_files:
+            tickets["image"] = _admission_lanes["image"].enqueue(
+                sum(_estimate_image_cost(f) for f in image_files))
+        if pdf_files:
+            tickets["pdf"] = _admission_lanes["pdf"].enqueue(
+                sum(_estimate_pdf_cost(f) for f in pdf_files))
+    except _LaneSaturated:
+        _release_tickets(tickets)
+        raise
+    return tickets
 
-@app.route("/", methods=["GET"])
-def index():
-    return render_template_string(INDEX_HTML)
+def _release_tickets(tickets: dict) -> None:
+    for ticket in tickets.values():
+        ticket.release()
 
-@app.route("/convert", methods=["POST"])
-def convert():
-    # Get files from both sections
-    image_files = request.files.getlist("images")
-    pdf_files = request.files.getlist("pdfs")
-    
-    # Get image parameters
-    img_format = request.form.get("img_format", "").lower()
-    img_quality = request.form.get("img_quality", 85)
-    img_target_size = request.form.get("img_target_size", 0)
-    
-    # Get PDF parameters
-    pdf_target_size = request.form.get("pdf_target_size", 0)
-    
-    # Parse image quality
+def _run_in_lane(ticket, entries):
+    """Yield from *entries* once *ticket* gets a slot, releasing it when done."""
+    if ticket is None:
+        yield from entries
+        return
     try:
-        img_quality = int(img_quality)
-        if img_quality < 1 or img_quality > 100:
-            img_quality = 85
-    except Exception:
-        img_quality = 85
-    
-    # Parse image target size
+        ticket.wait()
+        yield from entries
+    finally:
+        ticket.release()
+
+# Histogram buckets for the per-stage metrics on /metrics
+STAGE_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGE_BYTES_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2, 100 * 1024 ** 2)
+
+# Per-request stage breakdown being collected on this thread, if any
+_active_stages = contextvars.ContextVar("active_stages", default=None)
+
+def _peak_rss_bytes() -> int:
+    if resource is None:
+        return 0
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class _StageMetrics:
+    """
+    Process-wide totals per pipeline stage, rendered in the Prometheus text
+    format by GET /metrics. Stages nest (a quality search includes its
+    encodes), so their times don't add up to the request time.
+    """
+
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, record: dict, rss_growth: int) -> None:
+        with self._lock:
+            totals = self._stages.get(stage)
+            if totals is None:
+                totals = self._stages[stage] = {
+                    "count": 0, "seconds": 0.0, "bytes_in": 0, "bytes_out": 0, "encodes": 0,
+                    "rss_growth": 0,
+                    "seconds_buckets": [0] * len(STAGE_SECONDS_BUCKETS),
+                    "bytes_buckets": [0] * len(STAGE_BYTES_BUCKETS),
+                }
+            totals["count"] += 1
+            totals["seconds"] += seconds
+            totals["bytes_in"] += record["bytes_in"]
+            totals["bytes_out"] += record["bytes_out"]
+            totals["encodes"] += record["encodes"]
+            totals["rss_growth"] += rss_growth
+            for i, bound in enumerate(STAGE_SECONDS_BUCKETS):
+                if seconds <= bound:
+                    totals["seconds_buckets"][i] += 1
+            for i, bound in enumerate(STAGE_BYTES_BUCKETS):
+                if record["bytes_out"] <= bound:
+                    totals["bytes_buckets"][i] += 1
+
+            breakdown = _active_stages.get()
+            if breakdown is not None:
+                entry = breakdown.setdefault(stage, {"calls": 0, "seconds": 0.0, "bytes_in": 0,
+                                                     "bytes_out": 0, "encodes": 0})
+                entry["calls"] += 1
+                entry["seconds"] += seconds
+                entry["bytes_in"] += record["bytes_in"]
+                entry["bytes_out"] += record["bytes_out"]
+                entry["encodes"] += record["encodes"]
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        with self._lock:
+            stages = {name: dict(totals) for name, totals in sorted(self._stages.items())}
+
+        lines = []
+
+        def histogram(name, help_text, buckets, key, total_key):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for stage, totals in stages.items():
+                for bound, count in zip(buckets, totals[key]):
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {totals["count"]}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {totals[total_key]}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {totals["count"]}')
+
+        def counter(name, help_text, key):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for stage, totals in stages.items():
+                lines.append(f'{name}{{stage="{stage}"}} {totals[key]}')
+
+        histogram("converter_stage_seconds", "Wall time of each pipeline stage.",
+                  STAGE_SECONDS_BUCKETS, "seconds_buckets", "seconds")
+        histogram("converter_stage_output_bytes", "Bytes produced by each pipeline stage.",
+                  STAGE_BYTES_BUCKETS, "bytes_buckets", "bytes_out")
+        counter("converter_stage_input_bytes_total", "Bytes consumed by each pipeline stage.", "bytes_in")
+        counter("converter_stage_encodes_total", "Full encode attempts made by each pipeline stage.", "encodes")
+        counter("converter_stage_peak_rss_growth_bytes_total",
+                "How far each stage pushed the process peak RSS up (approximate with concurrent requests).",
+                "rss_growth")
+
+        lines.append("# HELP converter_peak_rss_bytes Peak resident set size of this process.")
+        lines.append("# TYPE converter_peak_rss_bytes gauge")
+        lines.append(f"converter_peak_rss_bytes {_peak_rss_bytes()}")
+
+        cache = _result_cache.stats()
+        for key in ("hits", "disk_hits", "misses", "evictions"):
+            lines.append(f"# HELP converter_result_cache_{key}_total Result cache {key.replace('_', ' ')}.")
+            lines.append(f"# TYPE converter_result_cache_{key}_total counter")
+            lines.append(f"converter_result_cache_{key}_total {cache[key]}")
+        lanes = {name: lane.stats() for name, lane in _admission_lanes.items()}
+        for name, help_text, key, kind in (
+                ("converter_lane_active", "Batches converting in each admission lane.", "active", "gauge"),
+                ("converter_lane_queued", "Batches waiting in each admission lane.", "queued", "gauge"),
+                ("converter_lane_queued_cost", "Cost (megapixels or pages) waiting in each lane.",
+                 "queued_cost", "gauge"),
+                ("converter_lane_admitted_total", "Batches accepted by each lane.", "admitted", "counter"),
+                ("converter_lane_rejected_total", "Batches turned away with 503.", "rejected", "counter")):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for lane, lane_stats in lanes.items():
+                lines.append(f'{name}{{lane="{lane}"}} {lane_stats[key]}')
+
+        lines.append("# HELP converter_result_cache_bytes Bytes held in the in-memory result cache.")
+        lines.append("# TYPE converter_result_cache_bytes gauge")
+        lines.append(f"converter_result_cache_bytes {cache['bytes']}")
+        return "\n".join(lines) + "\n"
+
+_stage_metrics = _StageMetrics()
+
+@contextlib.contextmanager
+def _stage(name: str, bytes_in: int = 0):
+    """
+    Time a pipeline stage for /metrics (and the current request's
+    breakdown, if one is being collected). The block may fill in the
+    yielded record's "bytes_out" and "encodes".
+    """
+    record = {"bytes_in": bytes_in, "bytes_out": 0, "encodes": 0}
+    rss_before = _peak_rss_bytes()
+    start = time.perf_counter()
     try:
-        img_target_size = int(img_target_size)
-        if img_target_size < 50:
-            img_target_size = 0  # Disable target size
-    except Exception:
-        img_target_size = 0
-    
-    # Parse PDF target size
+        yield record
+    finally:
+        _stage_metrics.observe(name, time.perf_counter() - start, record, _peak_rss_bytes() - rss_before)
+
+@contextlib.contextmanager
+def _collect_stages(breakdown):
+    """Attribute the stages run in this block to *breakdown* (a dict, or None)."""
+    token = _active_stages.set(breakdown)
     try:
-        pdf_target_size = int(pdf_target_size)
-        if pdf_target_size < 100:
-            pdf_target_size = 0  # Disable target size
-    except Exception:
-        pdf_target_size = 0
+        yield
+    finally:
+        _active_stages.reset(token)
 
-    # Check if any files were uploaded
-    if not image_files and not pdf_files:
-        flash("No files uploaded. Please select at least one image or PDF.")
-        return redirect(url_for("index"))
-    
-    # Check if all uploaded files are empty
-    has_valid_files = False
-    for f in image_files:
-        if f and f.filename:
-            has_valid_files = True
+def _run_collecting_stages(breakdown, func, *args):
+    """Pool entry point: run func(*args) with its stages attributed to *breakdown*."""
+    with _collect_stages(breakdown):
+        return func(*args)
+
+def _pixel_bytes(image) -> int:
+    if isinstance(image, _Animation):
+        return sum(_pixel_bytes(frame) for frame in image.frames)
+    return image.width * image.height * len(image.getbands())
+
+# Floor used by every quality search; below this JPEG/WebP output is unusable.
+MIN_QUALITY = 5
+
+# Size predictions encode a proxy: a SIDE x SIDE mosaic of GRID x GRID tiles
+# cut from the full-resolution image.
+SIZE_MODEL_PROXY_SIDE = 512
+SIZE_MODEL_PROXY_GRID = 4
+
+# Qualities at which each image's size curve is sampled for a combined budget,
+# and the share of that budget the allocator plans for (the rest absorbs
+# prediction error so files rarely need a second encode)
+IMAGE_CURVE_QUALITIES = (5, 25, 50, 75, 95)
+IMAGE_BUDGET_HEADROOM = 0.97
+
+# Perceptual target mode: the lowest quality whose SSIM against the original
+# luma reaches the target is searched on the size proxy. SSIM uses a uniform
+# SSIM_WINDOW x SSIM_WINDOW window; targets outside SSIM_TARGET_RANGE are off.
+SSIM_WINDOW = 7
+SSIM_TARGET_RANGE = (0.5, 0.999)
+
+# Shape of the size-vs-quality curve used by the search: for JPEG and WebP,
+# log(size) is close to linear in log(q) - 0.5 * log(100.5 - q) with this slope.
+SIZE_MODEL_SLOPE = 0.95
+
+def _encoder_options(target_format: str, quality: int, preset: str = DEFAULT_PRESET) -> dict:
+    """Pillow save() options for *target_format* at *quality* under the encoder *preset*."""
+    if target_format == "jpeg":
+        target_format = "jpg"
+    if target_format not in IMAGE_OUTPUT_FORMATS:
+        raise ValueError("Unsupported target format")
+    save_kwargs = {"format": _PIL_OUTPUT_FORMATS[target_format]}
+    # PNG is lossless and GIF's palette is chosen before saving
+    if target_format not in ("png", "gif"):
+        save_kwargs["quality"] = int(quality)
+    save_kwargs.update(ENCODER_PRESETS[preset].get(target_format, {}))
+    return save_kwargs
+
+def _encode_image(image, target_format: str, quality: int, preset: str = DEFAULT_PRESET) -> bytes:
+    """
+    Encode *image* once as *target_format* (any of IMAGE_OUTPUT_FORMATS) with
+    the encoder *preset* and return the bytes. An _Animation is saved with
+    all its frames; for GIF, *quality* sets the palette size.
+    """
+    out_io = io.BytesIO()
+    save_kwargs = _encoder_options(target_format, quality, preset)
+
+    with _stage("image_encode", _pixel_bytes(image)) as record:
+        if isinstance(image, _Animation):
+            _save_animation(image, out_io, target_format, quality, save_kwargs)
+        else:
+            if target_format == "gif":
+                image = _gif_palette_image(image, quality)
+            image.save(out_io, **save_kwargs)
+        record["bytes_out"] = out_io.tell()
+        record["encodes"] = 1
+    return out_io.getvalue()
+
+def _jpeg_source_quality(image):
+    """Estimated IJG quality (1-100) a JPEG *image* was saved at, or None."""
+    tables = getattr(image, "quantization", None)
+    if not tables or 0 not in tables:
+        return None
+    scale = 100.0 * sum(tables[0]) / sum(JPEG_STD_LUMINANCE_TABLE)
+    quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+    return max(1, min(100, round(quality)))
+
+def _strip_jpeg_metadata(jpeg_bytes: bytes) -> bytes:
+    """
+    Drop EXIF, XMP, comments and other metadata segments from a JPEG
+    without touching the compressed data; JPEG_KEPT_SEGMENTS stay.
+    """
+    out = [jpeg_bytes[:2]]
+    pos = 2
+    while pos + 4 <= len(jpeg_bytes):
+        if jpeg_bytes[pos] != 0xFF:
+            raise ValueError("Corrupt JPEG marker")
+        marker = jpeg_bytes[pos + 1]
+        if marker == 0xFF:  # Fill byte
+            pos += 1
+            continue
+        if marker == 0xDA:  # Start of scan: the rest is image data
             break
-    if not has_valid_files:
-        for f in pdf_files:
-            if f and f.filename:
-                has_valid_files = True
-                break
-    
-    if not has_valid_files:
-        flash("No valid files uploaded.")
-        return redirect(url_for("index"))
+        end = pos + 2 + int.from_bytes(jpeg_bytes[pos + 2:pos + 4], "big")
+        payload = jpeg_bytes[pos + 4:end]
+        metadata = marker == 0xFE or 0xE0 <= marker <= 0xEF
+        if not metadata or any(marker == m and payload.startswith(tag) for m, tag in JPEG_KEPT_SEGMENTS):
+            out.append(jpeg_bytes[pos:end])
+        pos = end
+    out.append(jpeg_bytes[pos:])
+    return b"".join(out)
 
-    # create temporary directory to store converted files before zipping
-    with tempfile.TemporaryDirectory(prefix="converter_") as tmpdir:
-        converted_files = []
-        errors = []
-        
-        # PROCESS IMAGES with total size tracking
-        total_image_size = 0
-        img_target_bytes = img_target_size * 1024 if img_target_size > 50 else 0
-        image_quality_reduction = 0  # Track cumulative quality reduction
-        
-        for storage in image_files:
-            if not storage or not storage.filename:
-                continue
-                
-            filename = secure_filename(storage.filename)
-            if not filename:
-                continue
-            
-            base, ext = os.path.splitext(filename)
-            
-            # Check if it's a valid image extension
-            if ext.lower() not in {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff", ".gif"}:
-                errors.append(f"Skipped invalid image: {filename}")
-                continue
-            
-            # Determine output format
-            if img_format and img_format in ["webp", "jpg", "png"]:
-                out_ext = img_format
-            else:
-                out_ext = ext.lstrip('.').lower()
-                if out_ext == "jpeg":
-                    out_ext = "jpg"
-            
-            out_name = f"{base}.{out_ext}"
+def _jpegtran(jpeg_bytes: bytes, args: list) -> bytes:
+    """Losslessly re-optimise a JPEG with jpegtran; the input if that fails or is no smaller."""
+    try:
+        result = subprocess.run([JPEGTRAN, "-copy", "all", *args], input=jpeg_bytes,
+                                capture_output=True, timeout=60, check=True)
+    except (OSError, subprocess.SubprocessError):
+        return jpeg_bytes
+    return result.stdout if 0 < len(result.stdout) < len(jpeg_bytes) else jpeg_bytes
 
-            try:
-                storage.stream.seek(0)
-                
-                # Adjust quality based on cumulative size
-                adjusted_quality = max(5, img_quality - image_quality_reduction)
-                
-                # If we have a target size, calculate per-file budget
-                if img_target_bytes > 0:
-                    # Estimate number of remaining images
-                    remaining_images = sum(1 for f in image_files if f and f.filename and 
-                                         os.path.splitext(f.filename)[1].lower() in 
-                                         {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff", ".gif"})
-                    per_file_budget = (img_target_bytes - total_image_size) / max(remaining_images, 1)
-                    
-                    # Load image and compress to budget
-                    storage.stream.seek(0)
-                    img = Image.open(storage.stream)
-                    # Load image data before closing stream
-                    img.load()
-                    file_bytes = compress_to_target_size(img, out_ext, 
-                                                        max(50, int(per_file_budget / 1024)), adjusted_quality)
-                else:
-                    file_bytes = convert_image_to(storage.stream, out_ext, adjusted_quality, 0)
-                
-                file_size = len(file_bytes)
-                
-                # Check if adding this file exceeds total target
-                if img_target_bytes > 0 and (total_image_size + file_size) > img_target_bytes:
-                    # Apply more aggressive compression
-                    image_quality_reduction += 15
-                    adjusted_quality = max(5, img_quality - image_quality_reduction)
-                    storage.stream.seek(0)
-                    file_bytes = convert_image_to(storage.stream, out_ext, adjusted_quality, 0)
-                    file_size = len(file_bytes)
-                
-                total_image_size += file_size
-                out_path = os.path.join(tmpdir, out_name)
-                with open(out_path, "wb") as f:
-                    f.write(file_bytes)
-                converted_files.append((out_name, out_path))
-                
-            except UnidentifiedImageError:
-                errors.append(f"Cannot identify image file: {filename}")
-            except Exception as e:
-                errors.append(f"Error converting {filename}: {str(e)}")
+def _jpeg_passthrough(img_stream, quality: int, max_dimension: int = 0, preset: str = DEFAULT_PRESET):
+    """
+    JPEG fast path, decided from headers alone: if *img_stream* is an RGB or
+    greyscale JPEG that needs no shrinking, is stored upright (stripping
+    EXIF would drop any Orientation tag) and was saved at or below
+    *quality*, re-encoding it would only add generation loss, so return its
+    own bytes with metadata stripped (and Huffman tables re-optimised when
+    jpegtran is available). Returns None when it has to be re-encoded.
+    """
+    img_stream.seek(0)
+    with Image.open(img_stream) as probe:  # Header only
+        if probe.format != "JPEG" or probe.mode not in ("L", "RGB"):
+            return None
+        if max_dimension and max(probe.size) > max_dimension:
+            return None
+        if probe.getexif().get(EXIF_ORIENTATION, 1) != 1:
+            return None
+        source_quality = _jpeg_source_quality(probe)
+    if source_quality is None or source_quality > quality:
+        return None
+
+    bytes_in = img_stream.seek(0, os.SEEK_END)
+    with _stage("jpeg_passthrough", bytes_in) as record:
+        img_stream.seek(0)
+        data = _strip_jpeg_metadata(img_stream.read())
+        if JPEGTRAN and JPEGTRAN_PRESET_ARGS[preset]:
+            data = _jpegtran(data, JPEGTRAN_PRESET_ARGS[preset])
+        record["bytes_out"] = len(data)
+    return data
+
+class _Animation:
+    """
+    The frames of an animated upload, ready to encode: RGBA *frames* with
+    their display *durations* in ms, and the *loop* count (0 loops forever;
+    None plays once, as a GIF without a loop extension does).
+    """
+
+    def __init__(self, frames: list, durations: list, loop):
+        self.frames = frames
+        self.durations = durations
+        self.loop = loop
+
+    @property
+    def size(self) -> tuple:
+        return self.frames[0].size
+
+def _read_animation(image, max_dimension: int = 0):
+    """
+    Decode every frame of the animated *image*, shrink them to fit
+    *max_dimension* and merge runs of identical frames (adding up their
+    durations). Decoding is sequential, as frames build on each other;
+    resizing and hashing run on the frame pool, at most FRAME_WORKERS frames
+    ahead, and only the distinct frames are kept. Raises ValueError once
+    those pass MAX_ANIMATION_MEGAPIXELS. Returns an _Animation, or a single
+    RGBA image when only one distinct frame is left.
+    """
+    loop = image.info.get("loop")
+    budget = MAX_ANIMATION_MEGAPIXELS * 1_000_000
+
+    def finish_frame(frame):
+        if max_dimension and max(frame.size) > max_dimension:
+            frame.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        return frame, hashlib.sha1(frame.tobytes()).digest()
+
+    kept, kept_durations, last_digest, pixels = [], [], None, 0
+
+    def keep(pending_frame):
+        nonlocal last_digest, pixels
+        future, duration = pending_frame
+        frame, digest = future.result()
+        if digest == last_digest:
+            kept_durations[-1] += duration
+            return
+        pixels += frame.width * frame.height
+        if pixels > budget:
+            raise ValueError(f"Animation has more than {MAX_ANIMATION_MEGAPIXELS} megapixels "
+                             f"of distinct frames after resizing")
+        kept.append(frame)
+        kept_durations.append(duration)
+        last_digest = digest
+
+    pending = collections.deque()
+    try:
+        for frame in ImageSequence.Iterator(image):
+            rgba = frame.convert("RGBA")
+            # Read after decoding: WebP only fills in a frame's duration on load
+            pending.append((_frame_pool.submit(finish_frame, rgba), frame.info.get("duration", 100)))
+            if len(pending) > max(1, FRAME_WORKERS):
+                keep(pending.popleft())
+        while pending:
+            keep(pending.popleft())
+    finally:
+        for future, _ in pending:
+            future.cancel()
+    if len(kept) == 1:
+        return kept[0]
+    return _Animation(kept, kept_durations, loop)
+
+def _gif_palette_image(image, quality: int):
+    """
+    Reduce *image* to a palette for GIF: *quality* 100 keeps 256 colours and
+    lower qualities proportionally fewer. Fully transparent pixels share one
+    transparent palette entry, as Pillow's own GIF conversion does.
+    """
+    colors = max(2, min(256, round(256 * quality / 100)))
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    image = image.convert("P", palette=Image.Palette.ADAPTIVE, colors=colors)
+    transparent = [index for rgba, index in image.palette.colors.items() if len(rgba) == 4 and rgba[3] == 0]
+    if image.palette.mode == "RGBA":
+        image.putpalette(image.getpalette("RGB"))
+    if transparent:
+        image.info["transparency"] = transparent[0]
+    return image
+
+def _save_animation(animation: _Animation, out_io, target_format: str, quality: int, save_kwargs: dict) -> None:
+    """Save every frame of *animation* to *out_io* with its timing and loop count."""
+    frames = animation.frames
+    save_kwargs = dict(save_kwargs, save_all=True, duration=animation.durations)
+    if target_format == "gif":
+        frames = list(_frame_pool.map(_gif_palette_image, frames, repeat(quality)))
+        # Every frame is a full canvas, so clear it before drawing the next
+        save_kwargs["disposal"] = 2
+        if animation.loop is not None:
+            save_kwargs["loop"] = animation.loop
+    else:
+        # WebP has no "play once" marker; a single loop is the same thing
+        save_kwargs["loop"] = 1 if animation.loop is None else animation.loop
+    frames[0].save(out_io, append_images=frames[1:], **save_kwargs)
+
+def _size_model_x(quality: float) -> float:
+    """Map a quality onto the axis where log(encoded size) is ~linear."""
+    return math.log(quality) - 0.5 * math.log(100.5 - quality)
+
+def _quality_from_model_x(x: float) -> float:
+    """Inverse of _size_model_x, clamped to qualities 1-100."""
+    lo, hi = 1.0, 100.0
+    for _ in range(30):
+        mid = (lo + hi) / 2
+        if _size_model_x(mid) < x:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+def _quality_for_size(q0: int, size0: float, target_bytes: int) -> float:
+    """
+    Invert the size model around a measured point (*q0*, *size0*) to guess the
+    quality whose output is *target_bytes*.
+    """
+    x = _size_model_x(q0) + math.log(max(target_bytes, 1) / size0) / SIZE_MODEL_SLOPE
+    return _quality_from_model_x(x)
+
+def _flatten_to_rgb(image):
+    """
+    The one colour normalisation stage: *image* as RGB, composited over
+    white where it is transparent. RGB input is returned as is; palette
+    transparency is expanded to RGBA first.
+
+    The white canvas is the output itself, and paste() reads the mask
+    straight from the RGBA/LA image's own alpha band, so compositing makes
+    no full-frame copy beyond the result. On a 24 MP RGBA image that takes
+    0.11-0.13 s, against 0.14-0.15 s for copying out the alpha band to
+    check it for opacity first, so opaque alpha isn't special-cased.
+    """
+    if image.mode == "RGB":
+        return image
+    if image.mode == "PA" or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+    if image.mode in ("RGBA", "LA"):
+        flattened = Image.new("RGB", image.size, (255, 255, 255))
+        flattened.paste(image, mask=image)
+        return flattened
+    return image.convert("RGB")
+
+def _prepare_image_for_format(image, target_format: str):
+    """Return *image* ready to encode as *target_format* (alpha flattened for JPEG)."""
+    if isinstance(image, _Animation):
+        return image  # Only decoded for formats that take RGBA frames as they are
+    # For formats like JPEG that don't support alpha, flatten to RGB
+    if target_format in ("jpg", "jpeg"):
+        image = _flatten_to_rgb(image)
+    return image
+
+def _size_proxy(image):
+    """
+    Return (proxy, pixel_ratio): a SIZE_MODEL_PROXY_SIDE square mosaic of
+    full-resolution tiles spread evenly over *image*, and how many
+    full-size pixels each proxy pixel stands for. Sampling at native
+    resolution keeps fine detail and noise, which downscaling would smooth
+    away. Small images are their own proxy (ratio 1).
+    """
+    if isinstance(image, _Animation):
+        # Frames compress against each other, so a mosaic says little; measure the real thing
+        return image, 1.0
+    width, height = image.size
+    grid = SIZE_MODEL_PROXY_GRID
+    tile = SIZE_MODEL_PROXY_SIDE // grid
+    if width * height <= SIZE_MODEL_PROXY_SIDE ** 2 or width < tile or height < tile:
+        return image, 1.0
+
+    proxy = Image.new(image.mode, (tile * grid, tile * grid))
+    if image.palette is not None:
+        # A fresh "P" image has a greyscale palette; without the real one the proxy encodes as near-black
+        proxy.putpalette(image.getpalette(image.palette.mode), image.palette.mode)
+    if "transparency" in image.info:
+        proxy.info["transparency"] = image.info["transparency"]
+    for row in range(grid):
+        for col in range(grid):
+            x = int((width - tile) * (col + 0.5) / grid)
+            y = int((height - tile) * (row + 0.5) / grid)
+            proxy.paste(image.crop((x, y, x + tile, y + tile)), (col * tile, row * tile))
+    return proxy, (width * height) / (proxy.size[0] * proxy.size[1])
+
+def _proxy_to_full_size(proxy_size: float, pixel_ratio: float) -> float:
+    """Predict the full-size encoded size from a proxy encode."""
+    return proxy_size * pixel_ratio
+
+def _estimate_quality_for_size(image, target_format: str, target_bytes: int, quality: int,
+                               preset: str = DEFAULT_PRESET):
+    """
+    Encode a proxy of *image* once and use the size model to guess
+    the quality that lands on *target_bytes* at full resolution.
+
+    Returns (estimated_quality, measurement) where measurement is
+    (quality, size, data) when the proxy was the full image itself, else None.
+    """
+    proxy, pixel_ratio = _size_proxy(image)
+    if proxy is image:
+        # Small image: the "proxy" encode is a real encode, keep it
+        data = _encode_image(image, target_format, quality, preset)
+        return _quality_for_size(quality, len(data), target_bytes), (quality, len(data), data)
+
+    proxy_size = len(_encode_image(proxy, target_format, quality, preset))
+    estimated_size = _proxy_to_full_size(proxy_size, pixel_ratio)
+    return _quality_for_size(quality, estimated_size, target_bytes), None
+
+def compress_to_target_size(image, target_format: str, target_size_kb: int, initial_quality: int = 90,
+                            stats: dict = None, preset: str = DEFAULT_PRESET) -> bytes:
+    """
+    Compress an image to meet target file size in KB.
+
+    Searches for the highest quality (up to *initial_quality*) whose output
+    fits the target. The first guess comes from a size model seeded by one
+    encode of a small proxy; later guesses interpolate between the
+    measured sizes that bracket the target, so a typical image needs 3-4
+    full encodes. If even the minimum quality is too big, that smallest
+    output is returned.
+
+    If *stats* is a dict it is filled with the number of full encodes used
+    ("encodes") and the quality that was picked ("quality"). Every encode
+    uses the encoder *preset*.
+    """
+    search_stats = {} if stats is None else stats
+    with _stage("image_quality_search", _pixel_bytes(image)) as record:
+        data = _compress_to_target_size(image, target_format, target_size_kb, initial_quality, search_stats,
+                                        preset)
+        record["bytes_out"] = len(data)
+        record["encodes"] = search_stats["encodes"]
+    return data
+
+def _compress_to_target_size(image, target_format: str, target_size_kb: int, initial_quality: int,
+                             stats: dict, preset: str) -> bytes:
+    target_bytes = target_size_kb * 1024
+    image = _prepare_image_for_format(image, target_format)
+
+    # PNG is lossless: quality has no effect, so a single encode is all we can do
+    if target_format == "png":
+        data = _encode_image(image, target_format, 0, preset)
+        stats.update(encodes=1, quality=None)
+        return data
+
+    hi_q = max(MIN_QUALITY, min(100, int(initial_quality)))
+    estimate, measured = _estimate_quality_for_size(image, target_format, target_bytes, hi_q, preset)
+
+    sizes = {}      # quality -> encoded size, for interpolation
+    fit = None      # (quality, data) of the highest quality known to fit
+    miss = None     # (quality, data) of the lowest quality known not to fit
+    encodes = 0
+
+    def record(q, data):
+        nonlocal fit, miss
+        sizes[q] = len(data)
+        if len(data) <= target_bytes:
+            if fit is None or q > fit[0]:
+                fit = (q, data)
+        elif miss is None or q < miss[0]:
+            miss = (q, data)
+
+    if measured is not None:
+        record(measured[0], measured[2])
+        encodes += 1
+    q = min(hi_q, max(MIN_QUALITY, int(estimate)))
+
+    while True:
+        lo = fit[0] if fit else MIN_QUALITY - 1
+        hi = miss[0] if miss else hi_q + 1
+        if hi - lo <= 1:
+            break
+        if q is None or q in sizes or not lo < q < hi:
+            q = _next_quality_probe(sizes, lo, hi, target_bytes)
+        data = _encode_image(image, target_format, q, preset)
+        encodes += 1
+        record(q, data)
+        q = None
+
+    chosen = fit if fit else miss
+    stats.update(encodes=encodes, quality=chosen[0])
+    return chosen[1]
+
+def _next_quality_probe(sizes: dict, lo: int, hi: int, target_bytes: int) -> int:
+    """
+    Pick the next quality to try strictly between *lo* (fits, or untested
+    floor) and *hi* (too big, or untested ceiling).
+
+    Interpolates between the measured bracket ends in the size model's linear
+    space; with only one side measured, falls back to the model's slope.
+    """
+    guess = None
+    if lo in sizes and hi in sizes:
+        x_lo, x_hi = _size_model_x(lo), _size_model_x(hi)
+        s_lo, s_hi = math.log(sizes[lo]), math.log(sizes[hi])
+        if s_hi > s_lo:
+            x = x_lo + (math.log(target_bytes) - s_lo) * (x_hi - x_lo) / (s_hi - s_lo)
+            guess = _quality_from_model_x(x)
+    elif hi in sizes:
+        guess = _quality_for_size(hi, sizes[hi], target_bytes)
+    elif lo in sizes:
+        guess = _quality_for_size(lo, sizes[lo], target_bytes)
+
+    if guess is None:
+        return (lo + hi) // 2
+    # Round down: the guess is the quality expected to land just under the target
+    return min(hi - 1, max(lo + 1, int(guess)))
+
+def _luma_array(image) -> np.ndarray:
+    """The luma plane of *image* as a float array (alpha is ignored)."""
+    return np.asarray(image.convert("L"), dtype=np.float64)
+
+def _box_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """Mean over every window x window block that fits, via a summed-area table."""
+    table = np.pad(values, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+    return (table[window:, window:] - table[:-window, window:]
+            - table[window:, :-window] + table[:-window, :-window]) / (window * window)
+
+def _ssim(reference: np.ndarray, distorted: np.ndarray, window: int = SSIM_WINDOW) -> float:
+    """Mean SSIM of two equally sized 8-bit luma arrays."""
+    window = min(window, *reference.shape)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mu_x, mu_y = _box_mean(reference, window), _box_mean(distorted, window)
+    var_x = _box_mean(reference * reference, window) - mu_x * mu_x
+    var_y = _box_mean(distorted * distorted, window) - mu_y * mu_y
+    cov = _box_mean(reference * distorted, window) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2))
+    return float(ssim_map.mean())
+
+def compress_to_target_ssim(image, target_format: str, target_ssim: float, stats: dict = None,
+                            preset: str = DEFAULT_PRESET) -> bytes:
+    """
+    Encode *image* at the lowest quality whose SSIM reaches *target_ssim*.
+
+    The search runs on the size proxy: full-resolution tiles rather than a
+    downscaled copy, which would hide the compression artefacts being
+    measured. Each probe encodes and decodes the proxy and compares luma;
+    a bisection over qualities MIN_QUALITY-100 takes about 7 probes, then
+    the full image is encoded once. Animations are searched on their first
+    frame. If even quality 100 misses the target, that is what is used.
+
+    If *stats* is a dict it is filled with the chosen "quality", its proxy
+    "ssim", and the "encodes" and "probe_encodes" spent.
+    """
+    search_stats = {} if stats is None else stats
+    image = _prepare_image_for_format(image, target_format)
+    still = image.frames[0] if isinstance(image, _Animation) else image
+
+    with _stage("image_ssim_search", _pixel_bytes(still)) as record:
+        if target_format == "png":
+            quality, score, probes = 0, 1.0, 0  # Lossless
+        else:
+            proxy, _ = _size_proxy(still)
+            reference = _luma_array(proxy)
+            scores = {}
+
+            def proxy_ssim(q):
+                decoded = Image.open(io.BytesIO(_encode_image(proxy, target_format, q, preset)))
+                scores[q] = _ssim(reference, _luma_array(decoded))
+                return scores[q]
+
+            lo, hi = MIN_QUALITY - 1, 101  # Known (or assumed) to miss / to meet the target
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if proxy_ssim(mid) >= target_ssim:
+                    hi = mid
+                else:
+                    lo = mid
+            quality = min(hi, 100)
+            score = scores[quality] if quality in scores else proxy_ssim(quality)
+            probes = len(scores)
+        record["encodes"] = probes
+
+    data = _encode_image(image, target_format, quality, preset)
+    search_stats.update(quality=quality if target_format != "png" else None, ssim=score,
+                        encodes=1, probe_encodes=probes)
+    return data
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return len(data).to_bytes(4, "big") + kind + data + zlib.crc32(kind + data).to_bytes(4, "big")
+
+def _png_strip_reader(img_stream, rows_per_strip: int):
+    """
+    Iterator of (y, strip) decoding a non-interlaced 8-bit PNG
+    *rows_per_strip* rows at a time, or None for any other PNG.
+
+    The IDAT stream is inflated incrementally and each strip is decoded by
+    Pillow from a small PNG of just its rows, led by the previous strip's
+    last row (unfiltered), so filters that refer to the row above still work.
+    """
+    img_stream.seek(0)
+    if img_stream.read(8) != PNG_SIGNATURE:
+        return None
+
+    def next_chunk_header():
+        header = img_stream.read(8)
+        if len(header) < 8:
+            raise ValueError("Truncated PNG")
+        return int.from_bytes(header[:4], "big"), header[4:]
+
+    length, kind = next_chunk_header()
+    if kind != b"IHDR":
+        return None
+    ihdr = img_stream.read(length)
+    img_stream.read(4)  # CRC
+    width, height = int.from_bytes(ihdr[0:4], "big"), int.from_bytes(ihdr[4:8], "big")
+    bit_depth, color_type, interlace = ihdr[8], ihdr[9], ihdr[12]
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}.get(color_type)
+    if bit_depth != 8 or interlace or channels is None:
+        return None
+    stride = width * channels
+
+    # Palette and transparency go into every strip; the rest is not needed
+    extra = []
+    length, kind = next_chunk_header()
+    while kind != b"IDAT":
+        data = img_stream.read(length)
+        img_stream.read(4)
+        if kind in (b"PLTE", b"tRNS"):
+            extra.append(_png_chunk(kind, data))
+        length, kind = next_chunk_header()
+
+    def idat_blocks(length):
+        while True:
+            while length:
+                block = img_stream.read(min(length, 1024 * 1024))
+                if not block:
+                    return
+                length -= len(block)
+                yield block
+            img_stream.read(4)
+            length, kind = next_chunk_header()
+            if kind != b"IDAT":
+                return
+
+    def strips():
+        inflater = zlib.decompressobj()
+        blocks = idat_blocks(length)
+        pending = bytearray()
+        previous = None  # Last unfiltered row of the previous strip
+        for y in range(0, height, rows_per_strip):
+            n_rows = min(rows_per_strip, height - y)
+            needed = n_rows * (stride + 1)
+            while len(pending) < needed:
+                source = inflater.unconsumed_tail or next(blocks, b"")
+                if not source:
+                    raise ValueError("Truncated PNG image data")
+                try:
+                    pending.extend(inflater.decompress(source, needed - len(pending)))
+                except zlib.error as e:
+                    raise ValueError(f"Corrupt PNG image data ({e})") from e
+            lead = b"" if previous is None else b"\0" + previous
+            strip_ihdr = width.to_bytes(4, "big") + (n_rows + bool(lead)).to_bytes(4, "big") + ihdr[8:]
+            png = (PNG_SIGNATURE + _png_chunk(b"IHDR", strip_ihdr) + b"".join(extra)
+                   + _png_chunk(b"IDAT", zlib.compress(lead + bytes(pending[:needed]), 0))
+                   + _png_chunk(b"IEND", b""))
+            del pending[:needed]
+            strip = Image.open(io.BytesIO(png))
+            strip.load()
+            if lead:
+                strip = strip.crop((0, 1, width, n_rows + 1))
+            previous = strip.crop((0, n_rows - 1, width, n_rows)).tobytes()
+            yield y, strip
+
+    return strips()
+
+def _tiff_strip_reader(img_stream, image, rows_per_strip: int):
+    """
+    Iterator of (y, strip) decoding a striped TIFF about *rows_per_strip*
+    rows at a time, or None for a tiled or planar one. Each group of strips
+    is decoded by Pillow from a small TIFF holding just those strips.
+    """
+    tags = image.tag_v2
+    if 273 not in tags or 324 in tags or tags.get(284, 1) != 1:
+        return None
+    offsets, counts = tags[273], tags.get(279)
+    if not counts or len(offsets) != len(counts):
+        return None
+    strip_rows = min(tags.get(278, image.height), image.height)
+    group = max(1, rows_per_strip // strip_rows)
+    byteorder = "little" if tags.prefix == b"II" else "big"
+    header = tags.prefix + (42).to_bytes(2, byteorder) + (8).to_bytes(4, byteorder)
+
+    def strips():
+        for first in range(0, len(offsets), group):
+            chunks = []
+            for offset, count in zip(offsets[first:first + group], counts[first:first + group]):
+                img_stream.seek(offset)
+                chunks.append(img_stream.read(count))
+            y = first * strip_rows
+            ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix=tags.prefix)
+            for tag in TIFF_STRIP_TAGS:
+                if tag in tags:
+                    ifd[tag] = tags[tag]
+                    ifd.tagtype[tag] = tags.tagtype[tag]
+            ifd[257] = min(image.height - y, len(chunks) * strip_rows)
+            ifd[279] = tuple(len(chunk) for chunk in chunks)
+            # Relative to the end of the IFD; tobytes() makes them absolute
+            ifd[273] = tuple(itertools.accumulate((len(chunk) for chunk in chunks[:-1]), initial=0))
+            ifd.tagtype[273] = ifd.tagtype[279] = TiffTags.LONG
+            strip = Image.open(io.BytesIO(header + ifd.tobytes(8) + b"".join(chunks)))
+            strip.load()
+            yield y, strip
+
+    return strips()
+
+def _reducible(image):
+    """*image*, converted first if its mode (bilevel, palette) can't be box-reduced."""
+    if image.mode == "1":
+        return image.convert("L")
+    if image.mode == "P":
+        return image.convert("RGBA" if "transparency" in image.info else "RGB")
+    return image
+
+def _decode_in_strips(img_stream, image, max_dimension: int):
+    """
+    Shrink a huge PNG or TIFF to fit *max_dimension* without ever holding it
+    whole: strips are decoded one at a time and box-reduced into a canvas
+    of at most four times the output size, which is then resampled like
+    _open_image does. Returns the loaded image, or None when the file's
+    layout can't be read in strips (the caller then decodes it whole).
+    """
+    factor = int(max(image.size) / max_dimension)
+    if factor < 2 or getattr(image, "n_frames", 1) > 1:
+        return None
+    if image.mode not in ("1", "L", "LA", "P", "RGB", "RGBA", "CMYK"):
+        return None
+    rows = max(1, STRIP_DECODE_MEGAPIXELS * 1_000_000 // (image.width * factor)) * factor
+    if image.format == "PNG":
+        strips = _png_strip_reader(img_stream, rows)
+    elif image.format == "TIFF":
+        strips = _tiff_strip_reader(img_stream, image, rows)
+    else:
+        strips = None
+    if strips is None:
+        return None
+
+    reduced = None
+    out_y = 0
+    carry = None  # Rows left over from the previous strip, fewer than factor
+    for _, strip in strips:
+        strip = _reducible(strip)
+        if carry is not None:
+            joined = Image.new(strip.mode, (strip.width, carry.height + strip.height))
+            joined.paste(carry, (0, 0))
+            joined.paste(strip, (0, carry.height))
+            strip = joined
+        if reduced is None:
+            reduced = Image.new(strip.mode, (math.ceil(image.width / factor), math.ceil(image.height / factor)))
+        whole = strip.height // factor * factor
+        if whole:
+            reduced.paste(strip.reduce(factor, box=(0, 0, strip.width, whole)), (0, out_y))
+            out_y += whole // factor
+        carry = strip.crop((0, whole, strip.width, strip.height)) if whole < strip.height else None
+    if carry is not None:
+        reduced.paste(carry.reduce(factor), (0, out_y))
+    reduced.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    return reduced
+
+def _open_image(img_stream, max_dimension: int = 0, keep_frames: bool = False):
+    """
+    Open an image from *img_stream*. With *max_dimension*, large images are
+    shrunk to fit within max_dimension x max_dimension, decoding as little
+    as possible: JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale in the
+    DCT domain (draft mode), other formats are box-reduced by an integer
+    factor before the final resample. Huge PNGs and TIFFs are decoded strip
+    by strip instead (see _decode_in_strips). The image is returned loaded.
+
+    With *keep_frames*, an animated upload comes back as an _Animation of
+    all its distinct frames (see _read_animation) instead of its first frame.
+    """
+    bytes_in = img_stream.seek(0, os.SEEK_END)
+    with _stage("image_decode", bytes_in) as record:
+        img_stream.seek(0)
+        image = Image.open(img_stream)
+        if keep_frames and getattr(image, "n_frames", 1) > 1:
+            image = _read_animation(image, max_dimension)
+            record["bytes_out"] = _pixel_bytes(image)
+            return image
+        if (max_dimension and max(image.size) > max_dimension and image.format in ("PNG", "TIFF")
+                and image.width * image.height > TILED_DECODE_MEGAPIXELS * 1_000_000):
+            shrunk = _decode_in_strips(img_stream, image, max_dimension)
+            if shrunk is not None:
+                image.close()
+                record["bytes_out"] = _pixel_bytes(shrunk)
+                return shrunk
+        if max_dimension and max(image.size) > max_dimension:
+            scale = max_dimension / max(image.size)
+            if image.format == "JPEG":
+                # Never drafts below the requested size, so the resample below still has work
+                image.draft(image.mode, (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+            else:
+                factor = int(1 / scale)
+                if factor >= 2:
+                    image = _reducible(image).reduce(factor)
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        image.load()
+        record["bytes_out"] = _pixel_bytes(image)
+    return image
+
+def convert_image_to(img_stream, target_format: str, quality: int, target_size_kb: int = 0,
+                     max_dimension: int = 0, preset: str = DEFAULT_PRESET, stats: dict = None) -> bytes:
+    """
+    Convert an image (file-like stream) to target_format and return bytes.
+    target_format: 'webp', 'jpg', 'png', 'gif', 'avif' or 'jxl' (see
+        IMAGE_OUTPUT_FORMATS; animations keep all their frames as WebP or GIF)
+    target_size_kb: If > 0, compress to this size in KB
+    max_dimension: If > 0, shrink the image to fit within this many pixels
+        on each side, decoding it at reduced size where possible
+    preset: encoder speed/effort, one of ENCODER_PRESETS
+    stats: optional dict, filled with "encodes" and "passed_through" (True
+        when a JPEG was kept as it is, see _jpeg_passthrough)
+    """
+    if stats is None:
+        stats = {}
+    stats["passed_through"] = False
+    if target_format in ("jpg", "jpeg"):
+        data = _jpeg_passthrough(img_stream, quality, max_dimension, preset)
+        if data is not None and (target_size_kb <= 10 or len(data) <= target_size_kb * 1024):
+            stats.update(encodes=0, passed_through=True)
+            return data
+
+    image = _open_image(img_stream, max_dimension, keep_frames=target_format in ANIMATION_FORMATS)
+    
+    # If target size specified, use compression algorithm
+    if target_size_kb > 10:
+        return compress_to_target_size(image, target_format, target_size_kb, quality, stats=stats, preset=preset)
+    
+    stats["encodes"] = 1
+    if isinstance(image, _Animation):
+        return _encode_image(image, target_format, quality, preset)
+    
+    # For formats like JPEG that don't support alpha, flatten to RGB;
+    # PNG, WEBP, AVIF and JXL preserve transparency as they are
+    image = _prepare_image_for_format(image, target_format)
+    out_io = io.BytesIO()
+    save_kwargs = _encoder_options(target_format, quality, preset)
+    if target_format == "gif":
+        image = _gif_palette_image(image, quality)
+
+    with _stage("image_encode", _pixel_bytes(image)) as record:
+        image.save(out_io, **save_kwargs)
+        record["bytes_out"] = out_io.tell()
+        record["encodes"] = 1
+    out_io.seek(0)
+    return out_io.read()
+
+def compress_pdf(pdf_source, target_size_kb: int = 0, quality: int = 80, stats: dict = None,
+                 mode: str = "auto") -> bytes:
+    """
+    Compress a PDF, keeping its text and vector content where possible.
+
+    Modes:
+        "lossless": only restructure the file (merge duplicate images and
+            fonts, recompress streams with maximum Flate); every page and
+            image is kept exactly.
+        "raster": re-render every page to a JPEG (see _compress_pdf_raster).
+        "auto": look at the page objects first. Documents made only of
+            scans are rasterized; anything with text or vector content is
+            optimized structurally, with embedded images downsampled and
+            recompressed. Rasterization is the fallback when a target
+            can't be met that way.
+
+    Args:
+        pdf_source: Raw bytes of the source PDF, or the path of a PDF file
+            (read as needed instead of loaded whole).
+        target_size_kb: If > 0, try to get total size under this (KB).
+        quality: JPEG quality to use (1-95). Lower = smaller file.
+        stats: Optional dict, filled with the method used ("mode":
+            "lossless", "structural" or "raster"), the number of full-size
+            JPEG encodes ("encodes"), and either the (dpi, quality) used for
+            each page ("page_settings", raster) or the image settings and
+            merge counts (structural).
+        mode: "auto", "lossless" or "raster".
+    Returns:
+        Compressed PDF bytes. _compress_pdf_file returns the same PDF as a
+        spooled file instead, for callers that shouldn't hold it whole.
+    """
+    with _compress_pdf_file(pdf_source, target_size_kb, quality, stats, mode) as pdf_file:
+        return pdf_file.read()
+
+
+def _compress_pdf_file(pdf_source, target_size_kb: int = 0, quality: int = 80, stats: dict = None,
+                       mode: str = "auto"):
+    """
+    compress_pdf, returning the PDF as a file object at its start for the
+    caller to close. Every candidate is written to a temp file that moves
+    to disk past PDF_OUTPUT_SPOOL_MB and compared by size, so memory use
+    doesn't grow with the output.
+    """
+    stats = {} if stats is None else stats
+    target_bytes = target_size_kb * 1024
+
+    if mode == "raster":
+        return _compress_pdf_raster(pdf_source, target_size_kb, quality, stats)
+
+    if mode == "auto":
+        try:
+            with _stage("pdf_analyze", _pdf_source_size(pdf_source)):
+                analysis = _map_page_ranges(pdf_source, _analyze_page_range, [None] * _pdf_page_count(pdf_source))
+        except Exception:
+            # Rasterizing needs only pdfium's renderer, not its page objects
+            app.logger.warning("PDF page analysis failed; rasterizing instead", exc_info=True)
+            return _compress_pdf_raster(pdf_source, target_size_kb, quality, stats)
+        if analysis and all(page["scan"] for page in analysis):
+            return _compress_pdf_raster(pdf_source, target_size_kb, quality, stats)
+        ladder = [(dpi, min(q, quality)) for dpi, q in PDF_STRUCTURAL_LADDER]
+    else:
+        analysis = None
+        ladder = [(None, None)]  # Images untouched
+
+    compressed, compressed_size = None, 0
+    try:
+        for image_dpi, image_quality in ladder:
+            structural_stats = {}
+            try:
+                candidate = _optimize_pdf_structure(pdf_source, image_dpi, image_quality, analysis, structural_stats)
+            except pikepdf.PdfError:
+                if mode != "auto":
+                    raise
+                # pdfium can often render what qpdf can't rewrite
+                app.logger.warning("Structural PDF optimization failed; rasterizing instead", exc_info=True)
+                if compressed is not None:
+                    compressed.close()
+                return _compress_pdf_raster(pdf_source, target_size_kb, quality, stats)
+            size = _file_size(candidate)
+            if compressed is None or size < compressed_size:
+                if compressed is not None:
+                    compressed.close()
+                compressed, compressed_size = candidate, size
+                stats.clear()
+                stats.update(structural_stats, mode="structural" if image_quality else "lossless")
+            else:
+                candidate.close()
+            if not target_bytes or size <= target_bytes:
+                break
+
+        # Already as small as a lossless rewrite gets: keep the original bytes
+        if _pdf_source_size(pdf_source) <= compressed_size:
+            compressed.close()
+            compressed = _open_pdf_source(pdf_source)
+            compressed_size = _file_size(compressed)
+            stats.update(images_recompressed=0, objects_merged=0, unchanged=True)
+
+        if mode == "auto" and target_bytes and compressed_size > target_bytes:
+            raster_stats = {}
+            rasterized = _compress_pdf_raster(pdf_source, target_size_kb, quality, raster_stats)
+            if _file_size(rasterized) < compressed_size:
+                raster_stats["encodes"] += stats.get("encodes", 0)
+                stats.clear()
+                stats.update(raster_stats)
+                compressed.close()
+                compressed = rasterized
+            else:
+                rasterized.close()
+    except BaseException:
+        if compressed is not None:
+            compressed.close()
+        raise
+    return compressed
+
+
+def _compress_pdf_raster(pdf_source, target_size_kb: int, quality: int, stats: dict):
+    """
+    Compress a PDF by rasterizing each page to an image, compressing it,
+    and rebuilding a new PDF from the compressed images.
+    
+    This is how real PDF compressors (iLovePDF, SmallPDF, etc.) work for
+    image-heavy / scanned PDFs.
+    
+    With a target, a cheap low-res probe of every page estimates how many
+    bytes each page needs, and the budget is split so dense pages get more
+    than blank or text pages.
+
+    Fills *stats* with "mode" ("raster"), the (dpi, quality) used for each
+    page ("page_settings") and the full-size page encodes across all passes
+    ("encodes"). Returns the PDF as a spooled file, like _compress_pdf_file.
+    """
+    # Determine the rendering DPI. Higher DPI = better quality but bigger.
+    # Default 150 DPI is a good balance; drop to 100 or 72 for extreme compression.
+    dpi = 150
+    page_settings = None
+    n_pages = _pdf_page_count(pdf_source)
+    page_encodes = 0
+    compressed = None
+    
+    # With a target, give every page its own DPI and quality from its share of the budget
+    if target_size_kb > 0:
+        with _stage("pdf_probe", _pdf_source_size(pdf_source)):
+            probes = _map_page_ranges(pdf_source, _probe_page_range, [None] * n_pages)
+        page_settings = _allocate_page_settings(probes, target_size_kb * 1024)
+    
+    try:
+        if page_settings:
+            compressed = _render_pdf_to_compressed_pdf(pdf_source, page_settings=page_settings)
+            page_encodes += n_pages
+            # The allocator works from a low-res model; if it overshot, scale the
+            # budget by how far off it was and allocate once more
+            if _file_size(compressed) > target_size_kb * 1024:
+                corrected = _allocate_page_settings(
+                    probes, target_size_kb * 1024 * (target_size_kb * 1024) / _file_size(compressed))
+                if corrected != page_settings:
+                    page_settings = corrected
+                    compressed.close()
+                    compressed = _render_pdf_to_compressed_pdf(pdf_source, page_settings=page_settings)
+                    page_encodes += n_pages
+            dpi = max(d for d, _ in page_settings)
+            quality = max(q for _, q in page_settings)
+        else:
+            compressed = _render_pdf_to_compressed_pdf(pdf_source, dpi, quality)
+            page_settings = [(dpi, quality)] * n_pages
+            page_encodes += n_pages
+        
+        # If we have a target and we're still over, do a second pass with lower settings
+        if target_size_kb > 0 and _file_size(compressed) > target_size_kb * 1024:
+            # Only rungs that are smaller than the first pass in some way
+            ladder = [(d, q) for d, q in PDF_FALLBACK_LADDER if d < dpi or q < quality]
+            if ladder:
+                # Render once at the highest DPI the ladder needs; each rung then
+                # only resamples the cached bitmaps and re-encodes them
+                with _stage("pdf_fallback_render", _pdf_source_size(pdf_source)):
+                    cache = _PageBitmapCache(pdf_source, max(d for d, _ in ladder))
+                with cache:
+                    for fallback_dpi, fallback_q in ladder:
+                        with _stage("pdf_fallback_encode") as record:
+                            compressed.close()
+                            compressed = _encode_cached_pages(cache, fallback_dpi, fallback_q)
+                            record["bytes_out"] = _file_size(compressed)
+                            record["encodes"] = len(cache)
+                        page_settings = [(fallback_dpi, fallback_q)] * len(cache)
+                        page_encodes += len(cache)
+                        if _file_size(compressed) <= target_size_kb * 1024:
+                            break
+    except BaseException:
+        if compressed is not None:
+            compressed.close()
+        raise
+    
+    stats.update(mode="raster", page_settings=page_settings, encodes=page_encodes)
+    return compressed
+
+
+def _image_object_geometry(obj) -> tuple:
+    """
+    ((left, bottom, right, top) in points, (px_width, px_height)) of a
+    pdfium image object. pypdfium2 5 renamed get_pos() and get_size().
+    """
+    if hasattr(obj, "get_bounds"):
+        return obj.get_bounds(), obj.get_px_size()
+    return obj.get_pos(), obj.get_size()
+
+
+def _analyze_page_range(pdf_source, start: int, stop: int, page_args: list) -> list:
+    """
+    Inspect the page objects of pages [*start*, *stop*) with pdfium.
+
+    Returns one dict per page: "text" and "paths" (object counts),
+    "images" ([(px_width, px_height, shown_width_pt, shown_height_pt)] for
+    every placed image), "size" (page size in points) and "scan" (no text,
+    and images cover at least PDF_SCAN_COVERAGE of the page).
+    """
+    src_pdf = pdfium.PdfDocument(pdf_source)
+    pages = []
+    try:
+        for page_index in range(start, stop):
+            page = src_pdf[page_index]
+            width_pt, height_pt = page.get_size()
+            text = paths = 0
+            images = []
+            image_area = 0.0
+            for obj in page.get_objects(max_depth=4):
+                if obj.type == pdfium_c.FPDF_PAGEOBJ_TEXT:
+                    text += 1
+                elif obj.type == pdfium_c.FPDF_PAGEOBJ_PATH:
+                    paths += 1
+                elif obj.type == pdfium_c.FPDF_PAGEOBJ_IMAGE:
+                    (left, bottom, right, top), (px_width, px_height) = _image_object_geometry(obj)
+                    images.append((px_width, px_height, right - left, top - bottom))
+                    image_area += (min(right, width_pt) - max(left, 0)) * (min(top, height_pt) - max(bottom, 0))
+            coverage = image_area / max(width_pt * height_pt, 1)
+            pages.append({
+                "text": text,
+                "paths": paths,
+                "images": images,
+                "size": (width_pt, height_pt),
+                "scan": text == 0 and coverage >= PDF_SCAN_COVERAGE,
+            })
+    finally:
+        src_pdf.close()
+    return pages
+
+
+def _pdf_object_key(obj, memo: dict, active: set):
+    """
+    Hashable key of a PDF object's content, so identical objects stored
+    separately compare equal. Indirect objects are keyed by what they
+    contain, not where they live.
+    """
+    if isinstance(obj, (pikepdf.Dictionary, pikepdf.Array, pikepdf.Stream)) and obj.is_indirect:
+        objgen = obj.objgen
+        if objgen in memo:
+            return memo[objgen]
+        if objgen in active:
+            return ("ref", objgen)  # Cycle: fall back to identity
+        active.add(objgen)
+        key = _pdf_direct_object_key(obj, memo, active)
+        active.discard(objgen)
+        memo[objgen] = key
+        return key
+    return _pdf_direct_object_key(obj, memo, active)
+
+
+def _pdf_direct_object_key(obj, memo: dict, active: set):
+    if isinstance(obj, pikepdf.Stream):
+        items = tuple(sorted((str(k), _pdf_object_key(v, memo, active))
+                             for k, v in obj.items() if k != "/Length"))
+        return ("stream", hashlib.sha256(obj.read_raw_bytes()).hexdigest(), items)
+    if isinstance(obj, pikepdf.Dictionary):
+        return ("dict", tuple(sorted((str(k), _pdf_object_key(v, memo, active))
+                                     for k, v in obj.items() if k not in ("/Parent", "/P"))))
+    if isinstance(obj, pikepdf.Array):
+        return ("array", tuple(_pdf_object_key(v, memo, active) for v in obj))
+    return ("value", repr(obj))
+
+
+def _dedupe_pdf_resources(container, canonical: dict, memo: dict, merged: set, depth: int = 0) -> None:
+    """
+    Point every indirect object reachable from *container* (a page's
+    /Resources, at most a few levels deep) at the first identical object
+    seen, recording the objects made redundant in *merged*.
+    """
+    if depth > 6:
+        return
+    keys = range(len(container)) if isinstance(container, pikepdf.Array) else list(container.keys())
+    for k in keys:
+        if k in ("/Parent", "/P"):
+            continue
+        value = container[k]
+        if not isinstance(value, (pikepdf.Dictionary, pikepdf.Array, pikepdf.Stream)):
+            continue
+        if value.is_indirect:
+            first = canonical.setdefault(_pdf_object_key(value, memo, set()), value)
+            if first.objgen != value.objgen:
+                container[k] = first
+                merged.add(value.objgen)
+                continue
+        _dedupe_pdf_resources(value, canonical, memo, merged, depth + 1)
+
+
+def _recompress_pdf_image(image_obj, quality: int, max_size: tuple) -> bool:
+    """
+    Re-encode one image XObject as JPEG at *quality*, downsampled to fit
+    *max_size* pixels. Images JPEG can't represent faithfully (masks,
+    palettes, CMYK, bit depths other than 8, decode arrays) are left
+    alone, and so is any result that isn't smaller. Returns whether the
+    image was replaced.
+    """
+    if image_obj.get("/ImageMask", False) or "/Decode" in image_obj:
+        return False
+    if int(image_obj.get("/BitsPerComponent", 8)) != 8:
+        return False
+    filters = image_obj.get("/Filter")
+    filters = [str(f) for f in filters] if isinstance(filters, pikepdf.Array) else [str(filters)] if filters else []
+    if any(f in ("/JBIG2Decode", "/CCITTFaxDecode", "/JPXDecode") for f in filters):
+        return False
+
+    try:
+        pil_image = pikepdf.PdfImage(image_obj).as_pil_image()
+    except Exception:
+        return False  # Colour space or encoding Pillow can't take
+    if pil_image.mode not in ("RGB", "L"):
+        return False
+
+    scale = min(1.0, max_size[0] / pil_image.width, max_size[1] / pil_image.height)
+    if scale < 0.9:
+        pil_image = pil_image.resize((max(1, round(pil_image.width * scale)),
+                                      max(1, round(pil_image.height * scale))), Image.LANCZOS)
+    jpeg_bytes = _encode_image(pil_image, "jpg", quality)
+    if len(jpeg_bytes) >= len(image_obj.read_raw_bytes()):
+        return False
+
+    # Keep ICC profiles and other colour spaces with the right channel count
+    color_space = image_obj.get("/ColorSpace")
+    if str(color_space) not in ("/DeviceRGB", "/DeviceGray") and not (
+            isinstance(color_space, pikepdf.Array) and str(color_space[0]) == "/ICCBased"):
+        color_space = pikepdf.Name.DeviceRGB if pil_image.mode == "RGB" else pikepdf.Name.DeviceGray
+    image_obj.write(jpeg_bytes, filter=pikepdf.Name.DCTDecode)
+    image_obj.Width = pil_image.width
+    image_obj.Height = pil_image.height
+    image_obj.BitsPerComponent = 8
+    image_obj.ColorSpace = color_space
+    return True
+
+
+def _optimize_pdf_structure(pdf_source, image_dpi: int = None, image_quality: int = None,
+                            analysis: list = None, stats: dict = None):
+    """
+    Optimize a PDF without rasterizing it: text, vectors and fonts are kept.
+
+    Identical images, fonts and other resources stored more than once are
+    merged, and every stream is rewritten with maximum Flate compression in
+    object streams. With *image_quality*, embedded images are also
+    downsampled to *image_dpi* at the largest size they are shown (from
+    the page *analysis* of _analyze_page_range, or the page size) and
+    re-encoded as JPEG when that makes them smaller.
+
+    *stats*, if given, gets "objects_merged", "images_recompressed",
+    "encodes" and "image_settings" ((dpi, quality) or None). Returns the
+    PDF as a spooled file at its start, for the caller to close.
+    """
+    with _stage("pdf_structural", _pdf_source_size(pdf_source)) as record:
+        is_bytes = isinstance(pdf_source, (bytes, bytearray))
+        with pikepdf.open(io.BytesIO(pdf_source) if is_bytes else pdf_source) as pdf:
+            canonical, memo, merged = {}, {}, set()
+            for page in pdf.pages:
+                if "/Resources" in page.obj:
+                    _dedupe_pdf_resources(page.obj.Resources, canonical, memo, merged)
+
+            recompressed = set()
+            attempted = set()
+            if image_quality:
+                for page_index, page in enumerate(pdf.pages):
+                    placements = analysis[page_index]["images"] if analysis else []
+                    page_w, page_h = (analysis[page_index]["size"] if analysis
+                                      else (float(page.mediabox[2]) - float(page.mediabox[0]),
+                                            float(page.mediabox[3]) - float(page.mediabox[1])))
+                    for _, image_obj in page.images.items():
+                        if image_obj.objgen in attempted:
+                            continue
+                        attempted.add(image_obj.objgen)
+                        width, height = int(image_obj.Width), int(image_obj.Height)
+                        # Largest size this image is shown at on the page, in points
+                        shown = [(w, h) for px_w, px_h, w, h in placements if (px_w, px_h) == (width, height)]
+                        shown_w, shown_h = (max(w for w, _ in shown), max(h for _, h in shown)) if shown else (page_w, page_h)
+                        max_size = (math.ceil(shown_w / 72 * image_dpi), math.ceil(shown_h / 72 * image_dpi))
+                        if _recompress_pdf_image(image_obj, image_quality, max_size):
+                            recompressed.add(image_obj.objgen)
+
+            pikepdf.settings.set_flate_compression_level(9)
+            pdf.remove_unreferenced_resources()
+            out_file = tempfile.SpooledTemporaryFile(max_size=PDF_OUTPUT_SPOOL_MB * 1024 * 1024)
+            try:
+                pdf.save(out_file, compress_streams=True, recompress_flate=True,
+                         stream_decode_level=pikepdf.StreamDecodeLevel.generalized,
+                         object_stream_mode=pikepdf.ObjectStreamMode.generate)
+            except BaseException:
+                out_file.close()
+                raise
+        record["bytes_out"] = _file_size(out_file)
+        record["encodes"] = len(attempted)
+
+    if stats is not None:
+        stats.update(objects_merged=len(merged), images_recompressed=len(recompressed),
+                     encodes=len(attempted),
+                     image_settings=(image_dpi, image_quality) if image_quality else None)
+    return out_file
+
+
+def _describe_pdf_stats(stats: dict) -> str:
+    """One-line summary of how compress_pdf treated a document, for the notes."""
+    if stats["mode"] == "raster":
+        return f"rasterized, page settings {_format_page_settings(stats['page_settings'])}"
+    if stats.get("unchanged"):
+        return "already optimal, kept as is"
+    text = "text and vectors kept"
+    if stats["image_settings"] and stats["images_recompressed"]:
+        dpi, quality = stats["image_settings"]
+        text += f", {stats['images_recompressed']} images recompressed at {dpi}dpi/q{quality}"
+    elif stats["image_settings"]:
+        text += ", no images needed recompressing"
+    else:
+        text += ", images untouched (lossless)"
+    return text + f", {stats['objects_merged']} duplicate objects merged"
+
+
+def _predict_page_bytes(probe: dict, dpi: int, quality: int) -> float:
+    """Predicted size of a page rendered at *dpi* and *quality*, from its probe."""
+    return probe["sizes"][quality] * (dpi / PDF_PROBE_DPI) ** probe["exponent"] * PDF_IMAGE_OVERHEAD
+
+def _allocate_page_settings(probes: list, budget_bytes: float) -> list:
+    """
+    Split *budget_bytes* across pages and return a (dpi, quality) pair per page.
+
+    Every page starts on the lowest rung of PDF_PAGE_SETTINGS. Pages are then
+    raised one rung at a time, always lifting the page on the lowest rung
+    (cheapest first) while the predicted total stays within the budget. Pages
+    end up at similar visual settings: blank and text pages reach the top
+    rungs for a few KB while photo pages take the bytes they need.
+    """
+    top = len(PDF_PAGE_SETTINGS) - 1
+    predicted = [[_predict_page_bytes(p, d, q) for d, q in PDF_PAGE_SETTINGS] for p in probes]
+    rungs = [0] * len(probes)
+    total = PDF_FILE_OVERHEAD + sum(sizes[0] for sizes in predicted)
+
+    heap = [(0, sizes[1] - sizes[0], i) for i, sizes in enumerate(predicted) if top > 0]
+    heapq.heapify(heap)
+    while heap:
+        rung, delta, i = heapq.heappop(heap)
+        if total + delta > budget_bytes:
+            continue  # This page can't go higher; others still might
+        total += delta
+        rungs[i] = rung + 1
+        if rungs[i] < top:
+            heapq.heappush(heap, (rungs[i], predicted[i][rungs[i] + 1] - predicted[i][rungs[i]], i))
+
+    return [PDF_PAGE_SETTINGS[r] for r in rungs]
+
+def _format_page_settings(page_settings: list) -> str:
+    """Describe per-page settings compactly, e.g. "p1-3 150dpi/q75, p4 72dpi/q25"."""
+    parts = []
+    start = 0
+    for i in range(1, len(page_settings) + 1):
+        if i == len(page_settings) or page_settings[i] != page_settings[start]:
+            dpi, quality = page_settings[start]
+            pages = f"p{start + 1}" if i - start == 1 else f"p{start + 1}-{i}"
+            parts.append(f"{pages} {dpi}dpi/q{quality}")
+            start = i
+    return ", ".join(parts)
+
+
+class _PageBitmapCache:
+    """
+    RGBX bitmaps of every page of a PDF, rendered once at *dpi*.
+
+    Bitmaps are kept in memory up to *max_bytes* (PDF_BITMAP_CACHE_MB by
+    default); pages past the cap are spilled as raw pixel files to a temp
+    directory and read back on demand. Use as a context manager so spilled
+    files are removed.
+    """
+
+    def __init__(self, pdf_source, dpi: int, max_bytes: int = None):
+        self.dpi = dpi
+        self.max_bytes = PDF_BITMAP_CACHE_MB * 1024 * 1024 if max_bytes is None else max_bytes
+        self.memory_bytes = 0
+        self.page_sizes = []  # (width_pt, height_pt) per page
+        self._pages = []      # PIL image, or (path, mode, size) when spilled
+        self._spill_dir = None
+
+        src_pdf = pdfium.PdfDocument(pdf_source)
+        try:
+            for page_index in range(len(src_pdf)):
+                page = src_pdf[page_index]
+                self.page_sizes.append((page.get_width(), page.get_height()))
+                self._store(_render_page_rgb(page, dpi))
+        except Exception:
+            self.close()
+            raise
+        finally:
+            src_pdf.close()
+
+    def _store(self, pil_image) -> None:
+        # RGBX, and Pillow's RGB too, take 4 bytes per pixel
+        n_bytes = pil_image.width * pil_image.height * 4
+        if self.memory_bytes + n_bytes <= self.max_bytes:
+            self.memory_bytes += n_bytes
+            self._pages.append(pil_image)
+            return
+
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.TemporaryDirectory(prefix="pagecache_")
+        path = os.path.join(self._spill_dir.name, f"page_{len(self._pages)}.raw")
+        with open(path, "wb") as f:
+            f.write(pil_image.tobytes())
+        self._pages.append((path, pil_image.mode, pil_image.size))
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    @property
+    def spilled_pages(self) -> int:
+        return sum(1 for entry in self._pages if isinstance(entry, tuple))
+
+    def get(self, page_index: int):
+        """Return the bitmap of *page_index* as a PIL image."""
+        entry = self._pages[page_index]
+        if not isinstance(entry, tuple):
+            return entry
+        path, mode, size = entry
+        with open(path, "rb") as f:
+            return Image.frombytes(mode, size, f.read())
+
+    def close(self) -> None:
+        self._pages = []
+        if self._spill_dir is not None:
+            self._spill_dir.cleanup()
+            self._spill_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _encode_cached_page(cache: _PageBitmapCache, page_index: int, dpi: int, quality: int) -> tuple:
+    """
+    Resample one cached page bitmap to *dpi* and JPEG-encode it at *quality*.
+    Returns (jpeg_bytes, width_pt, height_pt).
+    """
+    width_pt, height_pt = cache.page_sizes[page_index]
+    pil_image = cache.get(page_index)
+    if dpi < cache.dpi:
+        size = (max(1, round(pil_image.width * dpi / cache.dpi)),
+                max(1, round(pil_image.height * dpi / cache.dpi)))
+        pil_image = pil_image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+
+    return _encode_image(pil_image, "jpg", quality), width_pt, height_pt
+
+
+def _encode_cached_pages(cache: _PageBitmapCache, dpi: int, quality: int, workers: int = None):
+    """
+    Build a compressed PDF (a spooled file, see _assemble_pdf_file) from
+    *cache* at *dpi* and *quality* without re-rendering. Pillow releases the GIL while resizing and encoding, so
+    pages are processed on a thread pool of *workers* (PDF_RENDER_WORKERS).
+    """
+    workers = PDF_RENDER_WORKERS if workers is None else workers
+    page_indexes = range(len(cache))
+    if workers <= 1:
+        return _assemble_pdf_file(_encode_cached_page(cache, i, dpi, quality) for i in page_indexes)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return _assemble_pdf_file(pool.map(_encode_cached_page, repeat(cache), page_indexes,
+                                      repeat(dpi), repeat(quality)))
+
+
+def _render_page_rgb(page, dpi: int):
+    """
+    Render a pdfium *page* at *dpi* onto white, as an RGBX PIL image that
+    shares the bitmap's buffer: the default BGR render is copied by
+    to_pil(), RGBX byte order is handed over as it is. pdfium fills the
+    background, so there is no alpha to flatten; JPEG, WebP and resampling
+    take RGBX as it is (PNG needs RGB).
+    """
+    scale = dpi / 72.0
+    bitmap = page.render(scale=scale, rotation=0, fill_color=(255, 255, 255, 255),
+                         rev_byteorder=True, prefer_bgrx=True)
+    return bitmap.to_pil()
+
+
+def _render_page_range(pdf_source, start: int, stop: int, page_settings: list) -> list:
+    """
+    Render pages [*start*, *stop*) of *pdf_source* (bytes or a file path) and
+    compress each one as JPEG, using the (dpi, quality) pair for that page
+    from *page_settings*.
+
+    Returns a list of (jpeg_bytes, width_pt, height_pt) in page order. This is
+    the unit of work handed to render pool processes, so each call opens its
+    own copy of the document.
+    """
+    src_pdf = pdfium.PdfDocument(pdf_source)
+    page_images = []
+    
+    try:
+        for page_index, (dpi, quality) in zip(range(start, stop), page_settings):
+            page = src_pdf[page_index]
+            
+            # Get the page size in points (1 point = 1/72 inch)
+            width_pt = page.get_width()
+            height_pt = page.get_height()
+            
+            pil_image = _render_page_rgb(page, dpi)
+            
+            # Compress to JPEG in memory
+            page_images.append((_encode_image(pil_image, "jpg", quality), width_pt, height_pt))
+    finally:
+        src_pdf.close()
+
+    return page_images
+
+
+def _export_page_range(pdf_source, start: int, stop: int, page_args: list) -> list:
+    """
+    Render pages [*start*, *stop*) of *pdf_source* and encode each one as an
+    image with the (dpi, target_format, quality, preset) entry for that page
+    from *page_args*; a None entry skips the page.
+
+    Returns the encoded bytes (or None) in page order. Like
+    _render_page_range, this is a render pool unit of work.
+    """
+    src_pdf = pdfium.PdfDocument(pdf_source)
+    page_files = []
+
+    try:
+        for page_index, args in zip(range(start, stop), page_args):
+            if args is None:
+                page_files.append(None)
+                continue
+            dpi, target_format, quality, preset = args
+            pil_image = _render_page_rgb(src_pdf[page_index], dpi)
+            if target_format == "png":
+                pil_image = pil_image.convert("RGB")
+            page_files.append(_encode_image(pil_image, target_format, quality, preset))
+    finally:
+        src_pdf.close()
+
+    return page_files
+
+
+def _probe_page_range(pdf_source, start: int, stop: int, page_args: list) -> list:
+    """
+    Cheap low-resolution look at pages [*start*, *stop*) for the page budget
+    allocator. Each page is rendered once at 2 x PDF_PROBE_DPI and JPEG
+    sizes are measured at PDF_PROBE_DPI for every quality in
+    PDF_PAGE_SETTINGS, plus one size at the higher resolution to tell how
+    fast the page grows with DPI.
+
+    Returns one dict per page: {"sizes": {quality: bytes}, "exponent": e},
+    where the page's size is expected to scale with dpi ** e.
+    """
+    src_pdf = pdfium.PdfDocument(pdf_source)
+    probes = []
+    qualities = sorted({q for _, q in PDF_PAGE_SETTINGS})
+    ref_quality = qualities[len(qualities) // 2]
+
+    try:
+        for page_index in range(start, stop):
+            large = _render_page_rgb(src_pdf[page_index], 2 * PDF_PROBE_DPI)
+            small = large.reduce(2)
+            sizes = {q: len(_encode_image(small, "jpg", q)) for q in qualities}
+            large_size = len(_encode_image(large, "jpg", ref_quality))
+            # Doubling the DPI multiplies the size by 2 ** exponent
+            exponent = math.log2(max(large_size, 1) / max(sizes[ref_quality], 1))
+            probes.append({"sizes": sizes, "exponent": min(2.0, max(1.0, exponent))})
+    finally:
+        src_pdf.close()
+
+    return probes
+
+
+def _get_render_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Return the shared page render pool, (re)creating it with *workers*
+    processes if needed. Workers are spawned rather than forked because the
+    server process is multi-threaded.
+    """
+    global _render_pool, _render_pool_workers
+    with _render_pool_lock:
+        if _render_pool is None or _render_pool_workers != workers:
+            if _render_pool is not None:
+                _render_pool.shutdown(wait=False)
+            _render_pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+            _render_pool_workers = workers
+        return _render_pool
+
+
+def _discard_render_pool(pool: ProcessPoolExecutor) -> None:
+    """Forget *pool* after it broke so the next call starts a fresh one."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False)
+
+
+def _map_page_ranges(pdf_source, func, page_args: list, workers: int = None,
+                     chunk_size: int = None) -> list:
+    """
+    Run func(pdf_source, start, stop, page_args[start:stop]) over every page
+    of *pdf_source* (one *page_args* entry per page) and return the
+    concatenated results in page order. See _iter_page_ranges.
+    """
+    return list(_iter_page_ranges(pdf_source, func, page_args, workers, chunk_size))
+
+
+def _iter_page_ranges(pdf_source, func, page_args: list, workers: int = None, chunk_size: int = None):
+    """
+    Yield the per-page results of func(pdf_source, start, stop,
+    page_args[start:stop]) over every page of *pdf_source* (bytes or a file
+    path; one *page_args* entry per page), in page order, chunk by chunk as
+    they are ready, so callers can consume pages without holding them all.
+
+    The page range is split into chunks of *chunk_size* pages spread over
+    *workers* processes. Runs in-process when only one worker is configured,
+    when the document fits in a single chunk, or from wherever the pool
+    broke, so every path produces the same results.
+    """
+    workers = PDF_RENDER_WORKERS if workers is None else workers
+    chunk_size = max(1, PDF_RENDER_CHUNK_PAGES if chunk_size is None else chunk_size)
+    n_pages = len(page_args)
+    starts = list(range(0, n_pages, chunk_size))
+    stops = [min(s + chunk_size, n_pages) for s in starts]
+
+    if workers <= 1 or n_pages <= chunk_size:
+        for start, stop in zip(starts, stops):
+            yield from func(pdf_source, start, stop, page_args[start:stop])
+        return
+
+    with contextlib.ExitStack() as stack:
+        # Hand workers a file path instead of pickling the document per chunk
+        path = pdf_source
+        if isinstance(pdf_source, (bytes, bytearray)):
+            tmp = stack.enter_context(tempfile.NamedTemporaryFile(prefix="render_", suffix=".pdf"))
+            tmp.write(pdf_source)
+            tmp.flush()
+            path = tmp.name
+
+        chunk_args = [page_args[s:e] for s, e in zip(starts, stops)]
+        pool = _get_render_pool(workers)
+        done = 0  # Chunks already yielded
+        try:
+            for chunk in pool.map(func, repeat(path), starts, stops, chunk_args):
+                yield from chunk
+                done += 1
+        except BrokenProcessPool:
+            _discard_render_pool(pool)
+            app.logger.warning("PDF render pool broke; rendering in-process instead")
+            for start, stop in zip(starts[done:], stops[done:]):
+                yield from func(pdf_source, start, stop, page_args[start:stop])
+
+
+def _pdf_source_size(pdf_source) -> int:
+    """Size in bytes of a PDF given as bytes or a file path."""
+    if isinstance(pdf_source, (bytes, bytearray)):
+        return len(pdf_source)
+    return os.path.getsize(pdf_source)
+
+
+def _open_pdf_source(pdf_source):
+    """A copy of *pdf_source* in a spooled file at its start, like the other compress_pdf results."""
+    pdf_file = tempfile.SpooledTemporaryFile(max_size=PDF_OUTPUT_SPOOL_MB * 1024 * 1024)
+    if isinstance(pdf_source, (bytes, bytearray)):
+        pdf_file.write(pdf_source)
+    else:
+        with open(pdf_source, "rb") as f:
+            shutil.copyfileobj(f, pdf_file)
+    pdf_file.seek(0)
+    return pdf_file
+
+
+def _file_size(f) -> int:
+    """Size of the file object *f*, which is left at its start."""
+    size = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    return size
+
+
+def _pdf_page_count(pdf_source) -> int:
+    src_pdf = pdfium.PdfDocument(pdf_source)
+    try:
+        return len(src_pdf)
+    finally:
+        src_pdf.close()
+
+
+def _render_pdf_pages(pdf_source, dpi: int, quality: int, workers: int = None,
+                      chunk_size: int = None, page_settings: list = None) -> list:
+    """
+    Render and JPEG-encode every page of *pdf_source* on the render pool,
+    yielding (jpeg_bytes, width_pt, height_pt) in page order.
+
+    Every page uses *dpi* and *quality* unless *page_settings* gives a
+    (dpi, quality) pair per page.
+    """
+    if page_settings is None:
+        page_settings = [(dpi, quality)] * _pdf_page_count(pdf_source)
+    return _iter_page_ranges(pdf_source, _render_page_range, page_settings, workers, chunk_size)
+
+
+def _render_pdf_to_compressed_pdf(pdf_source, dpi: int = 150, quality: int = 75,
+                                  workers: int = None, chunk_size: int = None,
+                                  page_settings: list = None):
+    """
+    Core routine: render every page of *pdf_source* at *dpi*, compress each
+    page image as JPEG at *quality*, and assemble a new PDF from the JPEGs.
+    Returns it as a spooled file at its start (see _assemble_pdf_file).
+
+    Pages are rendered in parallel on the render pool; *workers* and
+    *chunk_size* override PDF_RENDER_WORKERS and PDF_RENDER_CHUNK_PAGES.
+    *page_settings* optionally gives a (dpi, quality) pair per page.
+
+    Each page is appended to the output as soon as it is rendered, so only
+    a few pages are ever held in memory.
+    """
+    # pdfium rasterization, the page JPEG encodes and writing them out
+    with _stage("pdf_render", _pdf_source_size(pdf_source)) as record:
+        page_images = _render_pdf_pages(pdf_source, dpi, quality, workers, chunk_size, page_settings)
+        pdf_file = _assemble_pdf_file(page_images)
+        record["bytes_out"] = _file_size(pdf_file)
+        record["encodes"] = len(page_settings) if page_settings else _pdf_page_count(pdf_source)
+    return pdf_file
+
+
+def _assemble_pdf_file(page_images):
+    """
+    Build a PDF from (jpeg_bytes, width_pt, height_pt) pages, taken from any
+    iterable and written one at a time. Returns the finished PDF as a
+    spooled file positioned at its start, for the caller to close.
+    """
+    writer = _ImagePdfWriter()
+    seconds = 0.0
+    bytes_in = 0
+    try:
+        for jpeg_bytes, w_pt, h_pt in page_images:
+            start = time.perf_counter()
+            writer.add_page(jpeg_bytes, w_pt, h_pt)
+            seconds += time.perf_counter() - start
+            bytes_in += len(jpeg_bytes)
+        start = time.perf_counter()
+        pdf_file = writer.finish()
+        seconds += time.perf_counter() - start
+    except BaseException:
+        writer.close()
+        raise
+    bytes_out = _file_size(pdf_file)
+    # Pages arrive interleaved with rendering, so only time the writing itself
+    _stage_metrics.observe("pdf_assemble", seconds,
+                           {"bytes_in": bytes_in, "bytes_out": bytes_out, "encodes": 0}, 0)
+    return pdf_file
+
+
+def _jpeg_info(jpeg_bytes: bytes) -> tuple:
+    """(width, height, components) from a JPEG's start-of-frame marker."""
+    pos = 2
+    while pos + 9 < len(jpeg_bytes):
+        if jpeg_bytes[pos] != 0xFF:
+            raise ValueError("Corrupt JPEG marker")
+        marker = jpeg_bytes[pos + 1]
+        if marker == 0xFF:  # Fill byte
+            pos += 1
+            continue
+        length = int.from_bytes(jpeg_bytes[pos + 2:pos + 4], "big")
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(jpeg_bytes[pos + 5:pos + 7], "big")
+            width = int.from_bytes(jpeg_bytes[pos + 7:pos + 9], "big")
+            return width, height, jpeg_bytes[pos + 9]
+        pos += 2 + length
+    raise ValueError("No JPEG frame header found")
+
+
+def _pdf_number(value: float) -> str:
+    return f"{value:.4f}".rstrip("0").rstrip(".")
+
+
+class _ImagePdfWriter:
+    """
+    Write a PDF of full-page JPEG images one page at a time.
+
+    Each JPEG is embedded as-is (DCTDecode, no re-encoding or ASCII85), and
+    objects go straight to a spooled temp file that moves to disk past
+    PDF_OUTPUT_SPOOL_MB. finish() hands back that file, so a caller that
+    streams it on never holds more than the spool in memory. Output is
+    deterministic: no dates or document IDs.
+    """
+
+    def __init__(self, max_memory_bytes: int = None):
+        if max_memory_bytes is None:
+            max_memory_bytes = PDF_OUTPUT_SPOOL_MB * 1024 * 1024
+        self._out = tempfile.SpooledTemporaryFile(max_size=max_memory_bytes)
+        self._offsets = {}  # object number -> byte offset
+        self._pages = []    # page object numbers
+        self._next_object = 3  # 1 is the catalog, 2 the page tree
+        self._out.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write_object(self, number: int, header: str, stream: bytes = None) -> None:
+        self._offsets[number] = self._out.tell()
+        self._out.write(f"{number} 0 obj\n{header}\n".encode())
+        if stream is not None:
+            self._out.write(b"stream\n")
+            self._out.write(stream)
+            self._out.write(b"\nendstream\n")
+        self._out.write(b"endobj\n")
+
+    def add_page(self, jpeg_bytes: bytes, width_pt: float, height_pt: float) -> None:
+        """Append a page of *width_pt* x *height_pt* filled by the JPEG."""
+        width_px, height_px, components = _jpeg_info(jpeg_bytes)
+        color_space = {1: "/DeviceGray", 3: "/DeviceRGB"}.get(components)
+        if color_space is None:
+            raise ValueError(f"Unsupported JPEG with {components} components")
+
+        image, content, page = self._next_object, self._next_object + 1, self._next_object + 2
+        self._next_object += 3
+        w, h = _pdf_number(width_pt), _pdf_number(height_pt)
+        self._write_object(
+            image,
+            f"<< /Type /XObject /Subtype /Image /Width {width_px} /Height {height_px} "
+            f"/ColorSpace {color_space} /BitsPerComponent 8 /Filter /DCTDecode /Length {len(jpeg_bytes)} >>",
+            jpeg_bytes)
+        drawing = f"q {w} 0 0 {h} 0 0 cm /Im0 Do Q".encode()
+        self._write_object(content, f"<< /Length {len(drawing)} >>", drawing)
+        self._write_object(
+            page,
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {w} {h}] "
+            f"/Resources << /XObject << /Im0 {image} 0 R >> >> /Contents {content} 0 R >>")
+        self._pages.append(page)
+
+    def finish(self):
+        """
+        Write the page tree, cross-reference table and trailer, and return
+        the PDF as a file object positioned at its start. It stays open
+        until close().
+        """
+        kids = " ".join(f"{page} 0 R" for page in self._pages)
+        self._write_object(1, "<< /Type /Catalog /Pages 2 0 R >>")
+        self._write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self._pages)} >>")
+
+        xref_offset = self._out.tell()
+        lines = [f"xref\n0 {self._next_object}\n", "0000000000 65535 f \n"]
+        lines.extend(f"{self._offsets[number]:010d} 00000 n \n" for number in range(1, self._next_object))
+        lines.append(f"trailer\n<< /Size {self._next_object} /Root 1 0 R >>\n"
+                     f"startxref\n{xref_offset}\n%%EOF\n")
+        self._out.write("".join(lines).encode())
+        self._out.seek(0)
+        return self._out
+
+    def close(self) -> None:
+        self._out.close()
+
+
+class _ResultCache:
+    """
+    Content-addressed cache of conversion results (bytes), safe to share
+    between threads.
+
+    Entries live in an LRU capped at *max_bytes*. With *disk_dir*, every
+    entry is also written there (one file per key, oldest evicted past
+    *max_disk_bytes*), so results survive memory eviction and restarts.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: str = "", max_disk_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = collections.OrderedDict()  # key -> bytes, least recent first
+        self._bytes = 0
+        self._disk_entries = collections.OrderedDict()  # key -> size on disk
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            found = []
+            for entry in os.scandir(disk_dir):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.name, stat.st_size))
+            for _, key, size in sorted(found):
+                self._disk_entries[key] = size
+                self._disk_bytes += size
+
+    def get(self, key: str):
+        """Cached bytes for *key*, or None."""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return data
+            on_disk = key in self._disk_entries
+
+        if on_disk:
+            try:
+                with open(os.path.join(self.disk_dir, key), "rb") as f:
+                    data = f.read()
+            except OSError:
+                data = None
+            if data is not None:
+                with self._lock:
+                    if key in self._disk_entries:
+                        self._disk_entries.move_to_end(key)
+                    self.counters["disk_hits"] += 1
+                    self._store_in_memory(key, data)
+                return data
+
+        with self._lock:
+            self.counters["misses"] += 1
+        return None
+
+    def put(self, key: str, data: bytes) -> None:
+        with self._lock:
+            self.counters["stores"] += 1
+            self._store_in_memory(key, data)
+            write_to_disk = bool(self.disk_dir) and key not in self._disk_entries
+
+        if write_to_disk and len(data) <= self.max_disk_bytes:
+            path = os.path.join(self.disk_dir, key)
+            try:
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+            except OSError:
+                return
+            evicted = []
+            with self._lock:
+                if key not in self._disk_entries:
+                    self._disk_entries[key] = len(data)
+                    self._disk_bytes += len(data)
+                    while self._disk_bytes > self.max_disk_bytes:
+                        old_key, old_size = self._disk_entries.popitem(last=False)
+                        self._disk_bytes -= old_size
+                        evicted.append(old_key)
+            for old_key in evicted:
+                try:
+                    os.remove(os.path.join(self.disk_dir, old_key))
+                except OSError:
+                    pass
+
+    def _store_in_memory(self, key: str, data: bytes) -> None:
+        # Caller holds the lock
+        if len(data) > self.max_bytes or key in self._entries:
+            return
+        self._entries[key] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, old = self._entries.popitem(last=False)
+            self._bytes -= len(old)
+            self.counters["evictions"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = self.counters["hits"] + self.counters["disk_hits"]
+            return dict(
+                self.counters,
+                hit_rate=hits / lookups if lookups else 0.0,
+                entries=len(self._entries),
+                bytes=self._bytes,
+                max_bytes=self.max_bytes,
+                disk_entries=len(self._disk_entries),
+                disk_bytes=self._disk_bytes,
+            )
+
+_result_cache = _ResultCache(RESULT_CACHE_MB * 1024 * 1024, RESULT_CACHE_DIR,
+                             RESULT_CACHE_DISK_MB * 1024 * 1024)
+
+def _upload_digest(stream) -> str:
+    """SHA-256 of an upload's bytes; leaves the stream rewound."""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for block in iter(lambda: stream.read(1024 * 1024), b""):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def _cache_key(kind: str, digest: str, *params) -> str:
+    """Cache key for a *kind* of result of the input *digest* under *params*."""
+    return hashlib.sha256(repr((RESULT_CACHE_VERSION, kind, digest) + params).encode()).hexdigest()
+
+def _parse_convert_options(form) -> dict:
+    """Read and sanitise the conversion settings from a submitted form."""
+    # Get image parameters
+    img_format = form.get("img_format", "").lower()
+    img_quality = form.get("img_quality", 85)
+    img_target_size = form.get("img_target_size", 0)
+    img_max_dimension = form.get("img_max_dimension", 0)
+    img_target_ssim = form.get("img_target_ssim", 0)
+    img_preset = form.get("img_preset", DEFAULT_PRESET).lower()
+    if img_preset not in ENCODER_PRESETS:
+        img_preset = DEFAULT_PRESET
+    img_combine_pdf = form.get("img_combine_pdf", "") in ("1", "on", "true")
+    stage_breakdown = form.get("stage_breakdown", "") in ("1", "on", "true")
+    
+    # Get PDF parameters
+    pdf_target_size = form.get("pdf_target_size", 0)
+    pdf_mode = form.get("pdf_mode", "auto").lower()
+    if pdf_mode not in ("auto", "lossless", "raster"):
+        pdf_mode = "auto"
+    pdf_export_format = form.get("pdf_export_format", "").lower()
+    if pdf_export_format == "jpeg":
+        pdf_export_format = "jpg"
+    if pdf_export_format not in PDF_EXPORT_FORMATS:
+        pdf_export_format = ""  # Compress the PDF instead
+    pdf_export_dpi = form.get("pdf_export_dpi", PDF_EXPORT_DPI)
+    
+    # Parse image quality
+    try:
+        img_quality = int(img_quality)
+        if img_quality < 1 or img_quality > 100:
+            img_quality = 85
+    except Exception:
+        img_quality = 85
+    
+    # Parse image target size
+    try:
+        img_target_size = int(img_target_size)
+        if img_target_size < 50:
+            img_target_size = 0  # Disable target size
+    except Exception:
+        img_target_size = 0
+    
+    # Parse image SSIM target (0 disables the perceptual mode)
+    try:
+        img_target_ssim = float(img_target_ssim or 0)
+        if not SSIM_TARGET_RANGE[0] <= img_target_ssim <= SSIM_TARGET_RANGE[1]:
+            img_target_ssim = 0.0
+    except Exception:
+        img_target_ssim = 0.0
+    
+    # Parse image max dimension (0 keeps the original size)
+    try:
+        img_max_dimension = int(img_max_dimension or 0)
+        if img_max_dimension < 16:
+            img_max_dimension = 0
+    except Exception:
+        img_max_dimension = 0
+    
+    # Parse PDF target size
+    try:
+        pdf_target_size = int(pdf_target_size)
+        if pdf_target_size < 100:
+            pdf_target_size = 0  # Disable target size
+    except Exception:
+        pdf_target_size = 0
+    
+    # Parse the page export resolution
+    try:
+        pdf_export_dpi = int(pdf_export_dpi or PDF_EXPORT_DPI)
+        if not PDF_EXPORT_DPI_RANGE[0] <= pdf_export_dpi <= PDF_EXPORT_DPI_RANGE[1]:
+            pdf_export_dpi = PDF_EXPORT_DPI
+    except Exception:
+        pdf_export_dpi = PDF_EXPORT_DPI
+
+    return {
+        "img_format": img_format,
+        "img_quality": img_quality,
+        "img_target_size": img_target_size,
+        "img_max_dimension": img_max_dimension,
+        "img_target_ssim": img_target_ssim,
+        "img_preset": img_preset,
+        "img_combine_pdf": img_combine_pdf,
+        "pdf_target_size": pdf_target_size,
+        "pdf_mode": pdf_mode,
+        "pdf_export_format": pdf_export_format,
+        "pdf_export_dpi": pdf_export_dpi,
+        "stage_breakdown": stage_breakdown,
+    }
+
+def _spool_upload(storage: FileStorage) -> FileStorage:
+    """
+    Copy an uploaded file into a private spooled temp file (kept in memory up
+    to UPLOAD_SPOOL_BYTES, on disk beyond) that outlives the request.
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    storage.stream.seek(0)
+    shutil.copyfileobj(storage.stream, spooled)
+    spooled.seek(0)
+    return FileStorage(stream=spooled, filename=storage.filename, name=storage.name,
+                       content_type=storage.content_type)
+
+def _close_uploads(files: list) -> None:
+    for storage in files:
+        storage.close()
+
+def _new_summary(progress=None) -> dict:
+    """
+    Running totals and notes shared by the conversion stages of one batch.
+    *progress*, if given, is called as progress(filename, status, detail)
+    whenever a file starts ("running"), finishes ("done") or fails ("failed").
+    """
+    return {
+        "files": 0,
+        "total_image_size": 0,
+        "total_pdf_size": 0,
+        "image_encodes": 0,  # Full-size encodes across all images
+        "image_probe_encodes": 0,  # Proxy encodes spent measuring size curves
+        "cache_hits": 0,  # Files served from the result cache
+        "passed_through": [],  # Names of JPEGs used as they are, without re-encoding
+        "ssim_results": [],  # (out_name, quality, ssim) per file in perceptual mode
+        "stages": {},  # Per-stage totals for this batch, see _stage
+        "errors": [],
+        "progress": progress,
+    }
+
+def _report_progress(summary: dict, filename: str, status: str, detail: str = "") -> None:
+    if summary["progress"] is not None:
+        summary["progress"](filename, status, detail)
+
+def _measure_image_curve(storage, digest: str, out_ext: str, max_quality: int,
+                         max_dimension: int = 0, preset: str = DEFAULT_PRESET) -> dict:
+    """
+    Budget phase one for a single upload: predict its encoded size across
+    qualities from cheap encodes of its size proxy.
+
+    Returns {"qualities": [...], "sizes": [...], "probe_encodes": n}. PNG
+    output doesn't depend on quality, so it is encoded for real once and
+    returned as {"data": bytes, "encodes": n} to be reused as the final
+    output. Both come from the result cache when this upload was seen
+    before, with no encodes counted.
+    """
+    if out_ext == "png":
+        key = _cache_key("image", digest, out_ext, 0, max_dimension, preset)
+        data = _result_cache.get(key)
+        if data is not None:
+            return {"data": data, "encodes": 0}
+        image = _open_image(storage.stream, max_dimension)
+        data = _encode_image(_prepare_image_for_format(image, out_ext), out_ext, 0, preset)
+        _result_cache.put(key, data)
+        return {"data": data, "encodes": 1}
+
+    key = _cache_key("curve", digest, out_ext, max_quality, max_dimension, preset)
+    cached = _result_cache.get(key)
+    if cached is not None:
+        return dict(json.loads(cached), probe_encodes=0)
+
+    image = _open_image(storage.stream, max_dimension, keep_frames=out_ext in ANIMATION_FORMATS)
+    image = _prepare_image_for_format(image, out_ext)
+    with _stage("image_size_probe", _pixel_bytes(image)) as record:
+        proxy, pixel_ratio = _size_proxy(image)
+        qualities = sorted({q for q in IMAGE_CURVE_QUALITIES if q < max_quality} | {max_quality})
+        sizes = [_proxy_to_full_size(len(_encode_image(proxy, out_ext, q, preset)), pixel_ratio)
+                 for q in qualities]
+        record["encodes"] = len(qualities)
+    _result_cache.put(key, json.dumps({"qualities": qualities, "sizes": sizes}).encode())
+    return {"qualities": qualities, "sizes": sizes, "probe_encodes": len(qualities)}
+
+def _curve_size(curve: dict, quality: int) -> float:
+    """Predicted bytes at *quality*, interpolating the sampled curve in model space."""
+    qualities, sizes = curve["qualities"], curve["sizes"]
+    if quality <= qualities[0]:
+        return sizes[0]
+    for i in range(1, len(qualities)):
+        if quality <= qualities[i]:
+            x0, x1 = _size_model_x(qualities[i - 1]), _size_model_x(qualities[i])
+            s0, s1 = math.log(max(sizes[i - 1], 1)), math.log(max(sizes[i], 1))
+            return math.exp(s0 + (s1 - s0) * (_size_model_x(quality) - x0) / (x1 - x0))
+    return sizes[-1]
+
+def _allocate_image_qualities(curves: list, budget_bytes: float) -> list:
+    """
+    Budget phase two: pick a quality per image so the predicted total fits
+    *budget_bytes*.
+
+    Every image starts at its lowest sampled quality and images are raised
+    one quality point at a time, always lifting the image with the lowest
+    quality (cheapest first), so the batch ends up at an even quality rather
+    than early files taking more than their share. Fixed-size (PNG) entries
+    just use up their bytes and get None.
+    """
+    qualities = [None] * len(curves)
+    total = 0.0
+    heap = []
+    for i, curve in enumerate(curves):
+        if "data" in curve:
+            total += len(curve["data"])
+            continue
+        q = curve["qualities"][0]
+        qualities[i] = q
+        total += _curve_size(curve, q)
+        if q < curve["qualities"][-1]:
+            heap.append((q, _curve_size(curve, q + 1) - _curve_size(curve, q), i))
+
+    heapq.heapify(heap)
+    while heap:
+        q, delta, i = heapq.heappop(heap)
+        if total + delta > budget_bytes:
+            continue  # This image can't go higher; others still might
+        total += delta
+        qualities[i] = q + 1
+        curve = curves[i]
+        if q + 1 < curve["qualities"][-1]:
+            heapq.heappush(heap, (q + 1, _curve_size(curve, q + 2) - _curve_size(curve, q + 1), i))
+
+    return qualities
+
+def _convert_one_image(storage, digest: str, filename: str, out_ext: str, quality: int,
+                       max_dimension: int, preset: str, target_ssim: float, summary: dict) -> tuple:
+    """
+    Image stage worker: convert one upload at *quality*, or at the lowest
+    quality meeting *target_ssim* when that is set, or fetch it from the
+    result cache. Runs on the image pool, so it touches nothing shared but
+    the (thread-safe) progress callback.
+
+    Returns (file_bytes, encodes, ssim_stats, source): ssim_stats is the
+    compress_to_target_ssim stats dict or None, and source is "encoded",
+    "cached" or "passed through" (a JPEG kept as it is, see
+    _jpeg_passthrough).
+    """
+    _report_progress(summary, filename, "running")
+    if target_ssim:
+        key = _cache_key("image-ssim", digest, out_ext, target_ssim, max_dimension, preset)
+        stats_key = _cache_key("image-ssim-stats", digest, out_ext, target_ssim, max_dimension, preset)
+        file_bytes, cached_stats = _result_cache.get(key), _result_cache.get(stats_key)
+        if file_bytes is not None and cached_stats is not None:
+            return file_bytes, 0, dict(json.loads(cached_stats), probe_encodes=0), "cached"
+        image = _open_image(storage.stream, max_dimension, keep_frames=out_ext in ANIMATION_FORMATS)
+        ssim_stats = {}
+        file_bytes = compress_to_target_ssim(image, out_ext, target_ssim, ssim_stats, preset)
+        _result_cache.put(key, file_bytes)
+        _result_cache.put(stats_key, json.dumps({"quality": ssim_stats["quality"],
+                                                 "ssim": ssim_stats["ssim"]}).encode())
+        return file_bytes, ssim_stats["encodes"], ssim_stats, "encoded"
+    key = _cache_key("image", digest, out_ext, 0 if out_ext == "png" else quality, max_dimension, preset)
+    file_bytes = _result_cache.get(key)
+    if file_bytes is not None:
+        return file_bytes, 0, None, "cached"
+    stats = {}
+    file_bytes = convert_image_to(storage.stream, out_ext, quality, 0, max_dimension, preset, stats)
+    _result_cache.put(key, file_bytes)
+    return file_bytes, stats["encodes"], None, "passed through" if stats["passed_through"] else "encoded"
+
+def _image_pdf_page(storage, digest: str, filename: str, quality: int, max_dimension: int,
+                    preset: str, summary: dict) -> tuple:
+    """
+    Combined-PDF stage worker: turn one upload into a page for
+    _ImagePdfWriter. An RGB or greyscale JPEG that needs no shrinking goes
+    in byte for byte; anything else is flattened and encoded as JPEG at
+    *quality* (or fetched from the result cache). Images with an EXIF
+    orientation are turned upright, so they are always re-encoded. The page
+    is sized from the image's DPI. Runs on the image pool.
+
+    Returns (jpeg_bytes, width_pt, height_pt, source), source being
+    "passed through", "cached" or "encoded".
+    """
+    _report_progress(summary, filename, "running")
+    storage.stream.seek(0)
+    with Image.open(storage.stream) as probe:  # Header only
+        source_format, mode, size = probe.format, probe.mode, probe.size
+        dpi = probe.info.get("dpi")
+        transpose = ORIENTATION_TRANSPOSES.get(probe.getexif().get(EXIF_ORIENTATION))
+    try:
+        dpi_x, dpi_y = (float(value) for value in dpi)
+    except (TypeError, ValueError):
+        dpi_x = dpi_y = 0
+    if min(dpi_x, dpi_y) < 10:
+        dpi_x = dpi_y = IMAGE_PDF_DEFAULT_DPI
+    if transpose in (Image.Transpose.TRANSPOSE, Image.Transpose.ROTATE_270,
+                     Image.Transpose.TRANSVERSE, Image.Transpose.ROTATE_90):
+        size, dpi_x, dpi_y = size[::-1], dpi_y, dpi_x
+    width_pt, height_pt = size[0] * 72 / dpi_x, size[1] * 72 / dpi_y
+    scale = min(1.0, PDF_MAX_PAGE_POINTS / max(width_pt, height_pt))
+    width_pt, height_pt = width_pt * scale, height_pt * scale
+
+    if (source_format == "JPEG" and mode in ("L", "RGB") and transpose is None
+            and not (max_dimension and max(size) > max_dimension)):
+        storage.stream.seek(0)
+        data = storage.stream.read()
+        try:
+            components = _jpeg_info(data)[2]
+        except ValueError:
+            components = None
+        if components in (1, 3):
+            return data, width_pt, height_pt, "passed through"
+
+    key = _cache_key("pdf-page", digest, quality, max_dimension, preset)
+    data = _result_cache.get(key)
+    if data is not None:
+        return data, width_pt, height_pt, "cached"
+    image = _open_image(storage.stream, max_dimension)
+    if transpose is not None:
+        # From the header read above: a strip-decoded image has no EXIF left
+        image = image.transpose(transpose)
+    image = _prepare_image_for_format(image, "jpg")
+    data = _encode_image(image, "jpg", quality, preset)
+    _result_cache.put(key, data)
+    return data, width_pt, height_pt, "encoded"
+
+def _pool_for_upload(pool, storage):
+    """*pool*, or _large_image_pool for an upload of LARGE_IMAGE_MEGAPIXELS or more."""
+    return _large_image_pool if _estimate_image_cost(storage) >= LARGE_IMAGE_MEGAPIXELS else pool
+
+@contextlib.contextmanager
+def _image_pool_for(workers: int):
+    """The shared image pool, or a private one for a non-default *workers*."""
+    if workers == IMAGE_WORKERS:
+        yield _image_pool
+        return
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="image") as pool:
+        yield pool
+
+def _iter_converted_images(image_files: list, options: dict, summary: dict, workers: int = None):
+    """
+    Convert uploaded images on the image pool (*workers* threads, default
+    IMAGE_WORKERS) and yield (out_name, bytes) in upload order as soon as
+    each file and every file before it are done. Failures and totals are
+    recorded in *summary* in upload order too.
+
+    With a combined target size the budget is solved for the whole batch
+    first: phase one measures each image's size-vs-quality curve from a
+    small proxy (in parallel), phase two picks per-file qualities that
+    keep the predicted total within the target, and each file is then
+    encoded once. Only a file whose real size would still push the running
+    total over the target is re-compressed.
+
+    With options["img_combine_pdf"] the batch becomes a single PDF instead,
+    see _iter_images_to_pdf.
+    """
+    if options["img_combine_pdf"]:
+        yield from _iter_images_to_pdf(image_files, options, summary, workers)
+        return
+    img_format = options["img_format"]
+    img_quality = options["img_quality"]
+    img_target_size = options["img_target_size"]
+    max_dimension = options["img_max_dimension"]
+    preset = options["img_preset"]
+    # A combined size target decides the qualities itself
+    target_ssim = 0.0 if img_target_size > 50 else options["img_target_ssim"]
+    errors = summary["errors"]
+    workers = IMAGE_WORKERS if workers is None else workers
+
+    # PROCESS IMAGES with total size tracking
+    img_target_bytes = img_target_size * 1024 if img_target_size > 50 else 0
+    
+    # Work out names and formats up front, keeping skipped files in order
+    tasks = []
+    for storage in image_files:
+        if not storage or not storage.filename:
+            continue
+            
+        filename = secure_filename(storage.filename)
+        if not filename:
+            continue
         
-        # PROCESS PDFs with total size tracking and real compression
-        total_pdf_size = 0
-        pdf_target_bytes = pdf_target_size * 1024 if pdf_target_size > 100 else 0
+        base, ext = os.path.splitext(filename)
         
-        # First pass: read all PDFs into memory so we can count them
-        pdf_items = []
-        for storage in pdf_files:
-            if not storage or not storage.filename:
-                continue
-            filename = secure_filename(storage.filename)
-            if not filename:
-                continue
-            base, ext = os.path.splitext(filename)
-            if ext.lower() != ".pdf":
-                errors.append(f"Skipped non-PDF file: {filename}")
-                continue
-            storage.stream.seek(0)
-            pdf_items.append((filename, base, storage.stream.read()))
+        # Check if it's a valid image extension
+        if ext.lower() not in IMAGE_EXTS:
+            tasks.append((storage, filename, None, None))
+            continue
         
-        n_pdfs = len(pdf_items)
+        # Determine output format
+        if img_format and img_format in IMAGE_OUTPUT_FORMATS:
+            out_ext = img_format
+        else:
+            out_ext = ext.lstrip('.').lower()
+            if out_ext == "jpeg":
+                out_ext = "jpg"
         
-        for filename, base, raw_bytes in pdf_items:
-            out_name = f"{base}_compressed.pdf"
-            
-            try:
-                original_kb = len(raw_bytes) / 1024
-                
-                if pdf_target_bytes > 0:
-                    remaining_budget_bytes = pdf_target_bytes - total_pdf_size
-                    remaining_pdfs = n_pdfs - len([f for f in converted_files if f[0].endswith('_compressed.pdf')])
-                    per_file_budget_kb = max(20, (remaining_budget_bytes / 1024) / max(remaining_pdfs, 1))
-                    
-                    file_bytes = compress_pdf(raw_bytes, int(per_file_budget_kb))
+        tasks.append((storage, filename, out_ext, _upload_digest(storage.stream)))
+
+    with _image_pool_for(workers) as pool:
+        qualities = [img_quality] * len(tasks)
+        predicted = [0.0] * len(tasks)
+        ready = {}  # task index -> final bytes already produced in phase one
+        if img_target_bytes > 0:
+            valid = [i for i, task in enumerate(tasks) if task[2]]
+            futures = [_pool_for_upload(pool, tasks[i][0]).submit(
+                           _run_collecting_stages, summary["stages"], _measure_image_curve,
+                           tasks[i][0], tasks[i][3], tasks[i][2], img_quality, max_dimension, preset)
+                       for i in valid]
+            curves = {}
+            for i, future in zip(valid, futures):
+                try:
+                    curves[i] = future.result()
+                except Exception:
+                    pass  # The final encode hits the same error and reports it in order
+            allocated = _allocate_image_qualities(list(curves.values()),
+                                                  img_target_bytes * IMAGE_BUDGET_HEADROOM)
+            for i, quality in zip(curves, allocated):
+                curve = curves[i]
+                if "data" in curve:
+                    ready[i] = (curve["data"], curve["encodes"], None, "encoded" if curve["encodes"] else "cached")
+                    predicted[i] = len(curve["data"])
                 else:
-                    # No target — light compression at quality 80
-                    file_bytes = compress_pdf(raw_bytes, 0, 80)
+                    qualities[i] = quality
+                    predicted[i] = _curve_size(curve, quality)
+                    summary["image_probe_encodes"] += curve["probe_encodes"]
+
+        # Keep a bounded window of conversions in flight ahead of the consumer
+        pending = collections.deque()
+        task_iter = iter(enumerate(tasks))
+
+        def submit_next():
+            for i, (storage, filename, out_ext, digest) in task_iter:
+                future = None
+                if i in ready:
+                    future = Future()
+                    future.set_result(ready.pop(i))
+                elif out_ext:
+                    future = _pool_for_upload(pool, storage).submit(
+                        _run_collecting_stages, summary["stages"], _convert_one_image,
+                        storage, digest, filename, out_ext, qualities[i],
+                        max_dimension, preset, target_ssim, summary)
+                pending.append((i, storage, filename, out_ext, digest, future))
+                if future is not None:
+                    return
+
+        for _ in range(2 * max(1, workers)):
+            submit_next()
+
+        # The pool outlives this batch: drop queued work if the client goes away
+        try:
+            while pending:
+                i, storage, filename, out_ext, digest, future = pending.popleft()
+                if future is None:
+                    errors.append(f"Skipped invalid image: {filename}")
+                    _report_progress(summary, filename, "failed", "Not a supported image type")
+                    continue
+                submit_next()
+
+                base = os.path.splitext(filename)[0]
+                out_name = f"{base}.{out_ext}"
+                try:
+                    file_bytes, encodes, ssim_stats, source = future.result()
+                    summary["image_encodes"] += encodes
+                    cache_hit = source == "cached"
+                    passed_through = source == "passed through"
+                    if ssim_stats is not None:
+                        summary["image_probe_encodes"] += ssim_stats["probe_encodes"]
+                        summary["ssim_results"].append((out_name, ssim_stats["quality"], ssim_stats["ssim"]))
+                    file_size = len(file_bytes)
                 
-                file_size = len(file_bytes)
-                compressed_kb = file_size / 1024
-                total_pdf_size += file_size
+                    # The size model was off: squeeze this file into what the
+                    # budget has left after the predicted sizes of later files
+                    if img_target_bytes > 0 and (summary["total_image_size"] + file_size) > img_target_bytes:
+                        remaining = img_target_bytes - summary["total_image_size"] - sum(predicted[i + 1:])
+                        remaining_kb = max(10, int(remaining / 1024))
+                        key = _cache_key("image-target", digest, out_ext, remaining_kb, qualities[i],
+                                         max_dimension, preset)
+                        file_bytes = _result_cache.get(key)
+                        cache_hit = file_bytes is not None
+                        passed_through = False
+                        if file_bytes is None:
+                            search_stats = {}
+                            with _collect_stages(summary["stages"]):
+                                img = _open_image(storage.stream, max_dimension,
+                                                  keep_frames=out_ext in ANIMATION_FORMATS)
+                                file_bytes = compress_to_target_size(img, out_ext, remaining_kb,
+                                                                     qualities[i], stats=search_stats,
+                                                                     preset=preset)
+                            summary["image_encodes"] += search_stats["encodes"]
+                            _result_cache.put(key, file_bytes)
+                        file_size = len(file_bytes)
                 
-                out_path = os.path.join(tmpdir, out_name)
-                with open(out_path, "wb") as f:
-                    f.write(file_bytes)
-                converted_files.append((out_name, out_path))
+                    if cache_hit:
+                        summary["cache_hits"] += 1
+                    if passed_through:
+                        summary["passed_through"].append(out_name)
                 
-                # Log compression ratio
-                ratio = (1 - compressed_kb / original_kb) * 100 if original_kb > 0 else 0
-                errors.append(f"PDF {filename}: {original_kb:.0f}KB → {compressed_kb:.0f}KB ({ratio:.0f}% reduction)")
+                    summary["total_image_size"] += file_size
+                    summary["files"] += 1
+                    _report_progress(summary, filename, "done", out_name)
+                    if img_target_bytes > 0:
+                        app.logger.info("Image %s: quality %s, %d bytes", filename, qualities[i], file_size)
+                    yield out_name, file_bytes
                 
+                except UnidentifiedImageError:
+                    errors.append(f"Cannot identify image file: {filename}")
+                    _report_progress(summary, filename, "failed", "Cannot identify image file")
+                except Exception as e:
+                    errors.append(f"Error converting {filename}: {str(e)}")
+                    _report_progress(summary, filename, "failed", str(e))
+        finally:
+            for *_, future in pending:
+                if future is not None:
+                    future.cancel()
+
+def _iter_images_to_pdf(image_files: list, options: dict, summary: dict, workers: int = None):
+    """
+    Combine uploaded images into one PDF, a page per image in upload order,
+    and yield ("combined_images.pdf", bytes) once it is written.
+
+    Pages are prepared on the image pool (*workers* threads, default
+    IMAGE_WORKERS) by _image_pdf_page, keeping a bounded window in flight,
+    and written to the PDF as soon as each page and every page before it
+    are ready. JPEG uploads are embedded without re-encoding. Size and SSIM
+    targets don't apply: other images are encoded at options["img_quality"].
+    """
+    quality = options["img_quality"]
+    max_dimension = options["img_max_dimension"]
+    preset = options["img_preset"]
+    errors = summary["errors"]
+    workers = IMAGE_WORKERS if workers is None else workers
+    out_name = "combined_images.pdf"
+
+    tasks = []
+    for storage in image_files:
+        if not storage or not storage.filename:
+            continue
+        filename = secure_filename(storage.filename)
+        if not filename:
+            continue
+        if os.path.splitext(filename)[1].lower() not in IMAGE_EXTS:
+            errors.append(f"Skipped invalid image: {filename}")
+            _report_progress(summary, filename, "failed", "Not a supported image type")
+            continue
+        tasks.append((storage, filename, _upload_digest(storage.stream)))
+
+    added = []  # Files on a page, reported done once the PDF is complete
+    passed = 0
+
+    def pages(pool):
+        nonlocal passed
+        pending = collections.deque()
+        task_iter = iter(tasks)
+
+        def submit_next():
+            for storage, filename, digest in task_iter:
+                future = _pool_for_upload(pool, storage).submit(
+                    _run_collecting_stages, summary["stages"], _image_pdf_page,
+                    storage, digest, filename, quality, max_dimension, preset, summary)
+                pending.append((filename, future))
+                return
+
+        for _ in range(2 * max(1, workers)):
+            submit_next()
+        try:
+            while pending:
+                filename, future = pending.popleft()
+                submit_next()
+                try:
+                    jpeg_bytes, width_pt, height_pt, source = future.result()
+                except UnidentifiedImageError:
+                    errors.append(f"Cannot identify image file: {filename}")
+                    _report_progress(summary, filename, "failed", "Cannot identify image file")
+                    continue
+                except Exception as e:
+                    errors.append(f"Error converting {filename}: {str(e)}")
+                    _report_progress(summary, filename, "failed", str(e))
+                    continue
+                if source == "encoded":
+                    summary["image_encodes"] += 1
+                elif source == "cached":
+                    summary["cache_hits"] += 1
+                else:
+                    summary["passed_through"].append(filename)
+                    passed += 1
+                added.append(filename)
+                yield jpeg_bytes, width_pt, height_pt
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    with _image_pool_for(workers) as pool, _collect_stages(summary["stages"]):
+        pdf_file = _assemble_pdf_file(pages(pool))
+    if not added:
+        pdf_file.close()
+        return
+    summary["total_pdf_size"] += _file_size(pdf_file)
+    summary["files"] += 1
+    errors.append(f"Combined {len(added)} image(s) into {out_name} "
+                  f"({passed} JPEG(s) passed through without re-encoding)")
+    for filename in added:
+        _report_progress(summary, filename, "done", out_name)
+    # Streamed into the ZIP from the spool rather than read into memory
+    with pdf_file:
+        yield out_name, pdf_file
+
+def _iter_exported_pdf_pages(storage, filename: str, digest: str, options: dict, summary: dict):
+    """
+    Export every page of one uploaded PDF as an image, yielding
+    (out_name, bytes) per page in page order.
+
+    Pages are rendered by pdfium on the render pool at
+    options["pdf_export_dpi"] and encoded as options["pdf_export_format"]
+    with the image quality and encoder preset. Each page is cached on its
+    own, so a repeat upload only renders the pages missing from the cache.
+    """
+    target_format = options["pdf_export_format"]
+    page_args = (options["pdf_export_dpi"], target_format, options["img_quality"], options["img_preset"])
+    base = os.path.splitext(filename)[0]
+
+    with tempfile.NamedTemporaryFile(prefix="upload_", suffix=".pdf") as pdf_file:
+        storage.stream.seek(0)
+        shutil.copyfileobj(storage.stream, pdf_file)
+        pdf_file.flush()
+        n_pages = _pdf_page_count(pdf_file.name)
+        keys = [_cache_key("pdf-export-page", digest, *page_args, i) for i in range(n_pages)]
+        cached = {i: data for i, key in enumerate(keys) if (data := _result_cache.get(key)) is not None}
+        if len(cached) == n_pages:
+            results = repeat(None, n_pages)
+            summary["cache_hits"] += 1
+        else:
+            results = _iter_page_ranges(pdf_file.name, _export_page_range,
+                                        [None if i in cached else page_args for i in range(n_pages)])
+
+        digits = max(3, len(str(n_pages)))
+        with _collect_stages(summary["stages"]):
+            for i, data in enumerate(results):
+                if data is None:
+                    data = cached.pop(i)
+                else:
+                    _result_cache.put(keys[i], data)
+                    summary["image_encodes"] += 1
+                summary["total_image_size"] += len(data)
+                summary["files"] += 1
+                yield f"{base}_page{i + 1:0{digits}d}.{target_format}", data
+
+    summary["errors"].append(f"PDF {filename}: exported {n_pages} page(s) as {target_format.upper()} "
+                             f"at {page_args[0]} dpi")
+    _report_progress(summary, filename, "done", f"{n_pages} page images")
+
+def _iter_compressed_pdfs(pdf_files: list, options: dict, summary: dict):
+    """
+    Compress uploaded PDFs one at a time, yielding (out_name, data) as each
+    file is done. Failures, ratios and totals are recorded in *summary*.
+
+    Uploads are never read whole: each one is copied to a named temp file
+    in blocks and the PDF pipeline works from that path. Results come back
+    as spooled files; those that still fit in PDF_OUTPUT_SPOOL_MB are read
+    into bytes and cached, bigger ones are yielded as the file (and not
+    cached) so they stream into the ZIP.
+
+    With options["pdf_export_format"] each PDF's pages are exported as
+    images instead, see _iter_exported_pdf_pages.
+    """
+    pdf_target_size = options["pdf_target_size"]
+    pdf_mode = options["pdf_mode"]
+    errors = summary["errors"]
+
+    # PROCESS PDFs with total size tracking and real compression
+    pdf_target_bytes = pdf_target_size * 1024 if pdf_target_size > 100 else 0
+    
+    # First pass: count the PDFs and hash them for the result cache
+    pdf_items = []
+    for storage in pdf_files:
+        if not storage or not storage.filename:
+            continue
+        filename = secure_filename(storage.filename)
+        if not filename:
+            continue
+        base, ext = os.path.splitext(filename)
+        if ext.lower() != ".pdf":
+            errors.append(f"Skipped non-PDF file: {filename}")
+            _report_progress(summary, filename, "failed", "Not a PDF")
+            continue
+        pdf_items.append((storage, filename, base, _upload_digest(storage.stream)))
+    
+    n_pdfs = len(pdf_items)
+    n_done = 0
+    
+    for storage, filename, base, digest in pdf_items:
+        out_name = f"{base}_compressed.pdf"
+        _report_progress(summary, filename, "running")
+        
+        if options["pdf_export_format"]:
+            try:
+                yield from _iter_exported_pdf_pages(storage, filename, digest, options, summary)
             except Exception as e:
-                errors.append(f"Error compressing PDF {filename}: {str(e)}")
-
-        if not converted_files:
-            error_msg = "No files were successfully processed."
-            if errors:
-                error_msg += " Errors: " + "; ".join(errors)
-            flash(error_msg)
-            return redirect(url_for("index"))
-
-        # Create ZIP in-memory and send as response
-        zip_io = io.BytesIO()
-        with zipfile.ZipFile(zip_io, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-            # Put files into zip
-            for name, path in converted_files:
-                zf.write(path, arcname=name)
+                errors.append(f"Error exporting PDF {filename}: {str(e)}")
+                _report_progress(summary, filename, "failed", str(e))
+            continue
+        
+        try:
+            original_kb = storage.stream.seek(0, os.SEEK_END) / 1024
+            pdf_stats = {}
+            
+            if pdf_target_bytes > 0:
+                remaining_budget_bytes = pdf_target_bytes - summary["total_pdf_size"]
+                remaining_pdfs = n_pdfs - n_done
+                per_file_budget_kb = max(20, (remaining_budget_bytes / 1024) / max(remaining_pdfs, 1))
+                target_kb, quality = int(per_file_budget_kb), 80
+            else:
+                # No target — light compression at quality 80
+                target_kb, quality = 0, 80
+            
+            # The compression stats are cached next to the PDF, so a hit needs both
+            key = _cache_key("pdf", digest, target_kb, quality, pdf_mode)
+            stats_key = _cache_key("pdf-stats", digest, target_kb, quality, pdf_mode)
+            output = _result_cache.get(key)
+            cached_stats = _result_cache.get(stats_key) if output is not None else None
+            if cached_stats is not None:
+                pdf_stats = json.loads(cached_stats)
+                summary["cache_hits"] += 1
+                file_size = len(output)
+            else:
+                with _collect_stages(summary["stages"]), \
+                        tempfile.NamedTemporaryFile(prefix="upload_", suffix=".pdf") as pdf_file:
+                    storage.stream.seek(0)
+                    shutil.copyfileobj(storage.stream, pdf_file)
+                    pdf_file.flush()
+                    output = _compress_pdf_file(pdf_file.name, target_kb, quality, stats=pdf_stats, mode=pdf_mode)
+                file_size = _file_size(output)
+                if file_size <= PDF_OUTPUT_SPOOL_MB * 1024 * 1024:
+                    with output:
+                        output = output.read()
+                    _result_cache.put(key, output)
+                    _result_cache.put(stats_key, json.dumps(pdf_stats).encode())
             
-            # Add metadata file
-            meta_lines = [
-                f"Processed on {datetime.utcnow().isoformat()} UTC",
-                f"Total files processed: {len(converted_files)}",
-                f"Total images size: {total_image_size/1024:.2f} KB" if total_image_size > 0 else "Total images size: 0 KB",
-                f"Total PDFs size: {total_pdf_size/1024:.2f} KB" if total_pdf_size > 0 else "Total PDFs size: 0 KB",
-                f"Image format: {img_format or 'Original'}",
-                f"Image quality: {img_quality}",
-                f"Image target size: {img_target_size} KB (combined)" if img_target_size > 0 else "Image target size: No limit",
-                f"PDF target size: {pdf_target_size} KB (combined)" if pdf_target_size > 0 else "PDF target size: No limit",
-            ]
+            compressed_kb = file_size / 1024
+            summary["total_pdf_size"] += file_size
+            summary["files"] += 1
+            n_done += 1
             
-            if errors:
-                meta_lines.append("\nNotes/Errors encountered:")
-                meta_lines.extend(errors)
+            # Log compression ratio
+            ratio = (1 - compressed_kb / original_kb) * 100 if original_kb > 0 else 0
+            errors.append(f"PDF {filename}: {original_kb:.0f}KB → {compressed_kb:.0f}KB ({ratio:.0f}% reduction)")
+            errors.append(f"PDF {filename}: {_describe_pdf_stats(pdf_stats)}")
+            _report_progress(summary, filename, "done", out_name)
+            if isinstance(output, bytes):
+                yield out_name, output
+            else:
+                with output:
+                    yield out_name, output
             
-            zf.writestr("conversion_info.txt", "\n".join(meta_lines))
+        except Exception as e:
+            errors.append(f"Error compressing PDF {filename}: {str(e)}")
+            _report_progress(summary, filename, "failed", str(e))
+
+def _conversion_info(options: dict, summary: dict) -> str:
+    """Text of the conversion_info.txt entry closing every ZIP."""
+    total_image_size = summary["total_image_size"]
+    total_pdf_size = summary["total_pdf_size"]
+    img_target_size = options["img_target_size"]
+    pdf_target_size = options["pdf_target_size"]
+    errors = summary["errors"]
+
+    meta_lines = [
+        f"Processed on {datetime.utcnow().isoformat()} UTC",
+        f"Total files processed: {summary['files']}",
+        f"Total images size: {total_image_size/1024:.2f} KB" if total_image_size > 0 else "Total images size: 0 KB",
+        f"Total PDFs size: {total_pdf_size/1024:.2f} KB" if total_pdf_size > 0 else "Total PDFs size: 0 KB",
+        f"Image format: {options['img_format'] or 'Original'}",
+        f"Image quality: {options['img_quality']}",
+        f"Image max dimension: {options['img_max_dimension']} px" if options["img_max_dimension"] else "Image max dimension: Original size",
+        f"Encoder preset: {options['img_preset']}",
+        f"Image target size: {img_target_size} KB (combined)" if img_target_size > 0 else "Image target size: No limit",
+        (f"Image target SSIM: {options['img_target_ssim']}"
+         + (" (ignored: the combined target size sets the qualities)" if img_target_size > 0 else ""))
+        if options["img_target_ssim"] else None,
+        f"Image encodes: {summary['image_encodes']}",
+        f"Image probe encodes: {summary['image_probe_encodes']}" if summary["image_probe_encodes"] else None,
+        f"Served from cache: {summary['cache_hits']} file(s)" if summary["cache_hits"] else None,
+        f"PDF target size: {pdf_target_size} KB (combined)" if pdf_target_size > 0 else "PDF target size: No limit",
+        f"PDF mode: {options['pdf_mode']}",
+        f"PDF export: pages as {options['pdf_export_format'].upper()} at {options['pdf_export_dpi']} dpi"
+        if options["pdf_export_format"] else None,
+        "Images combined into one PDF (size and SSIM targets don't apply)" if options["img_combine_pdf"] else None,
+        f"Passed through without re-encoding: {len(summary['passed_through'])} file(s) "
+        f"({', '.join(summary['passed_through'])})" if summary["passed_through"] else None,
+    ]
+    
+    meta_lines = [line for line in meta_lines if line is not None]
+    if summary["ssim_results"]:
+        meta_lines.append("\nPerceptual targets (quality picked, SSIM on the size proxy):")
+        for out_name, quality, score in summary["ssim_results"]:
+            meta_lines.append(f"{out_name}: quality {quality if quality is not None else 'lossless'}, "
+                              f"SSIM {score:.4f}")
+    if options["stage_breakdown"] and summary["stages"]:
+        meta_lines.append("\nStage breakdown (stages nest, so times overlap):")
+        for stage, entry in sorted(summary["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            meta_lines.append(
+                f"{stage}: {entry['calls']} calls, {entry['seconds']:.3f} s, "
+                f"{entry['bytes_in'] / 1024:.0f} KB in, {entry['bytes_out'] / 1024:.0f} KB out"
+                + (f", {entry['encodes']} encodes" if entry["encodes"] else ""))
+    if errors:
+        meta_lines.append("\nNotes/Errors encountered:")
+        meta_lines.extend(errors)
+    
+    return "\n".join(meta_lines)
+
+class _ZipStreamSink:
+    """
+    Write-only, non-seekable file object for zipfile. Because it can't seek,
+    zipfile writes each entry's sizes in a data descriptor after its data, so
+    every finished entry can be sent to the client straight away.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        """Return and forget everything written since the last drain."""
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def _stream_zip(entries, info_text, stages=None):
+    """
+    Yield a ZIP archive chunk by chunk: one chunk per (name, data) in
+    *entries* as soon as it is available, then conversion_info.txt built by
+    calling *info_text* once the entries are exhausted. *data* is bytes, or
+    a file object at its start, which is copied a block at a time. Time
+    spent zipping is also added to the *stages* breakdown, if given.
+    """
+    sink = _ZipStreamSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, data in entries:
+            if isinstance(data, bytes):
+                with _collect_stages(stages), _stage("zip_build", len(data)) as record:
+                    zf.writestr(name, data)
+                    chunk = sink.drain()
+                    record["bytes_out"] = len(chunk)
+                yield chunk
+                continue
+            # Chunks go out between blocks, so time only the zipping itself
+            record = {"bytes_in": 0, "bytes_out": 0, "encodes": 0}
+            seconds = 0.0
+            start = time.perf_counter()
+            size = data.seek(0, os.SEEK_END)
+            data.seek(0)
+            with zf.open(name, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+                for block in iter(lambda: data.read(1024 * 1024), b""):
+                    member.write(block)
+                    record["bytes_in"] += len(block)
+                    chunk = sink.drain()
+                    record["bytes_out"] += len(chunk)
+                    seconds += time.perf_counter() - start
+                    if chunk:
+                        yield chunk
+                    start = time.perf_counter()
+            chunk = sink.drain()
+            record["bytes_out"] += len(chunk)
+            seconds += time.perf_counter() - start
+            with _collect_stages(stages):
+                _stage_metrics.observe("zip_build", seconds, record, 0)
+            yield chunk
         
-        zip_io.seek(0)
-
-        send_name = f"converted_files_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.zip"
-        response = send_file(
-            zip_io,
-            as_attachment=True,
-            download_name=send_name,
-            mimetype="application/zip"
+        # Add metadata file
+        zf.writestr("conversion_info.txt", info_text())
+    # Central directory
+    yield sink.drain()
+
+@app.route("/", methods=["GET"])
+def index():
+    return render_template_string(INDEX_HTML, output_formats=IMAGE_OUTPUT_FORMATS)
+
+@app.route("/convert", methods=["POST"])
+def convert():
+    # Get files from both sections
+    image_files = request.files.getlist("images")
+    pdf_files = request.files.getlist("pdfs")
+    options = _parse_convert_options(request.form)
+
+    # Check if any files were uploaded
+    if not image_files and not pdf_files:
+        flash("No files uploaded. Please select at least one image or PDF.")
+        return redirect(url_for("index"))
+    
+    # Check if all uploaded files are empty
+    has_valid_files = False
+    for f in image_files:
+        if f and f.filename:
+            has_valid_files = True
+            break
+    if not has_valid_files:
+        for f in pdf_files:
+            if f and f.filename:
+                has_valid_files = True
+                break
+    
+    if not has_valid_files:
+        flash("No valid files uploaded.")
+        return redirect(url_for("index"))
+
+    # Reject oversize, mislabelled and bomb-like uploads before copying them
+    rejected = []
+    image_files = _screen_uploads([f for f in image_files if f and f.filename], "image", rejected)
+    pdf_files = _screen_uploads([f for f in pdf_files if f and f.filename], "pdf", rejected)
+    if not image_files and not pdf_files:
+        flash("No files were accepted. " + "; ".join(rejected))
+        return redirect(url_for("index"))
+
+    # Flask closes request files when the view returns, but the streamed
+    # response keeps converting after that, so work on private copies
+    image_files = [_spool_upload(f) for f in image_files]
+    pdf_files = [_spool_upload(f) for f in pdf_files]
+
+    # Turn the batch away now rather than let it wait behind a full queue
+    try:
+        tickets = _admit_batch(image_files, pdf_files)
+    except _LaneSaturated as e:
+        _close_uploads(image_files + pdf_files)
+        return Response(f"Server busy: {e}.\n", status=503, mimetype="text/plain",
+                        headers={"Retry-After": str(e.retry_after)})
+
+    def finish():
+        _release_tickets(tickets)
+        _close_uploads(image_files + pdf_files)
+
+    summary = _new_summary()
+    summary["errors"].extend(rejected)
+    entries = itertools.chain(
+        _run_in_lane(tickets.get("image"), _iter_converted_images(image_files, options, summary)),
+        _run_in_lane(tickets.get("pdf"), _iter_compressed_pdfs(pdf_files, options, summary)),
+    )
+
+    # Convert up to the first successful file before committing to a ZIP
+    # response, so a batch where everything fails still redirects back
+    first = next(entries, None)
+    if first is None:
+        finish()
+        error_msg = "No files were successfully processed."
+        if summary["errors"]:
+            error_msg += " Errors: " + "; ".join(summary["errors"])
+        flash(error_msg)
+        return redirect(url_for("index"))
+
+    # Stream the ZIP: each file goes out as soon as it is converted
+    body = _stream_zip(itertools.chain([first], entries), lambda: _conversion_info(options, summary),
+                       summary["stages"])
+    send_name = f"converted_files_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.zip"
+    response = Response(body, mimetype="application/zip")
+    response.call_on_close(finish)
+    response.headers['Content-Disposition'] = f'attachment; filename="{send_name}"'
+    
+    # Add headers for better compatibility
+    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '0'
+    
+    return response
+
+def _purge_expired_jobs() -> None:
+    """Drop finished jobs older than JOB_TTL_SECONDS along with their files."""
+    cutoff = time.time() - JOB_TTL_SECONDS
+    with _jobs_lock:
+        expired = [job for job in _jobs.values()
+                   if job["finished"] is not None and job["finished"] < cutoff]
+        for job in expired:
+            del _jobs[job["id"]]
+    for job in expired:
+        shutil.rmtree(job["dir"], ignore_errors=True)
+
+def _update_job_file(job: dict, filename: str, status: str, detail: str) -> None:
+    """Progress callback: record the state of *filename* within *job*."""
+    with _jobs_lock:
+        for entry in job["files"]:
+            # Names can repeat within a batch; move the first one not yet finished
+            if entry["name"] == filename and entry["status"] in ("pending", "running"):
+                entry["status"] = status
+                if status == "done":
+                    entry["output"] = detail
+                elif detail:
+                    entry["detail"] = detail
+                break
+
+def _run_job(job: dict, image_files: list, pdf_files: list, options: dict, tickets: dict) -> None:
+    """Worker pool entry point: run the pipelines and write the job's ZIP."""
+    with _jobs_lock:
+        job["status"] = "running"
+        job["started"] = time.time()
+
+    summary = _new_summary(progress=lambda *args: _update_job_file(job, *args))
+    entries = itertools.chain(
+        _run_in_lane(tickets.get("image"), _iter_converted_images(image_files, options, summary)),
+        _run_in_lane(tickets.get("pdf"), _iter_compressed_pdfs(pdf_files, options, summary)),
+    )
+    result_path = os.path.join(job["dir"], "result.zip")
+    try:
+        with open(result_path, "wb") as f:
+            for chunk in _stream_zip(entries, lambda: _conversion_info(options, summary), summary["stages"]):
+                f.write(chunk)
+        status = "done" if summary["files"] else "failed"
+        error = None if summary["files"] else "No files were successfully processed."
+    except Exception as e:
+        app.logger.exception("Job %s failed", job["id"])
+        status, error = "failed", str(e)
+    finally:
+        _release_tickets(tickets)
+        _close_uploads(image_files + pdf_files)
+
+    with _jobs_lock:
+        job["status"] = status
+        job["error"] = error
+        job["notes"] = job["notes"] + summary["errors"]
+        job["total_image_size"] = summary["total_image_size"]
+        job["total_pdf_size"] = summary["total_pdf_size"]
+        job["result_path"] = result_path if status == "done" else None
+        job["finished"] = time.time()
+
+def _job_status(job: dict) -> dict:
+    """JSON-ready view of a job for GET /jobs/<id>."""
+    def timestamp(t):
+        return datetime.utcfromtimestamp(t).isoformat() + "Z" if t else None
+
+    files = [dict(entry) for entry in job["files"]]
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "created": timestamp(job["created"]),
+        "started": timestamp(job["started"]),
+        "finished": timestamp(job["finished"]),
+        "progress": {
+            "total": len(files),
+            "done": sum(1 for f in files if f["status"] == "done"),
+            "failed": sum(1 for f in files if f["status"] == "failed"),
+        },
+        "files": files,
+        "total_image_size": job["total_image_size"],
+        "total_pdf_size": job["total_pdf_size"],
+        "notes": job["notes"],
+        "error": job["error"],
+        "result_url": url_for("job_result", job_id=job["id"]) if job["status"] == "done" else None,
+    }
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """
+    Queue a conversion and return its id straight away. Accepts the same
+    form fields as /convert; poll GET /jobs/<id> and fetch the ZIP from
+    GET /jobs/<id>/result once it is done.
+    """
+    _purge_expired_jobs()
+
+    image_files = [f for f in request.files.getlist("images") if f and f.filename]
+    pdf_files = [f for f in request.files.getlist("pdfs") if f and f.filename]
+    if not image_files and not pdf_files:
+        return jsonify(error="No files uploaded. Please select at least one image or PDF."), 400
+    rejected = []
+    image_files = _screen_uploads(image_files, "image", rejected)
+    pdf_files = _screen_uploads(pdf_files, "pdf", rejected)
+    if not image_files and not pdf_files:
+        return jsonify(error="No files were accepted.", notes=rejected), 400
+
+    options = _parse_convert_options(request.form)
+    job_id = uuid.uuid4().hex
+    job = {
+        "id": job_id,
+        "status": "queued",
+        "created": time.time(),
+        "started": None,
+        "finished": None,
+        "dir": tempfile.mkdtemp(prefix=f"job_{job_id}_"),
+        "files": [
+            {"name": secure_filename(f.filename), "kind": kind, "status": "pending"}
+            for kind, files in (("image", image_files), ("pdf", pdf_files)) for f in files
+        ],
+        "total_image_size": 0,
+        "total_pdf_size": 0,
+        "notes": rejected,
+        "error": None,
+        "result_path": None,
+    }
+    # Request files are closed when this view returns; the job reads copies
+    image_files = [_spool_upload(f) for f in image_files]
+    pdf_files = [_spool_upload(f) for f in pdf_files]
+    try:
+        tickets = _admit_batch(image_files, pdf_files)
+    except _LaneSaturated as e:
+        _close_uploads(image_files + pdf_files)
+        shutil.rmtree(job["dir"], ignore_errors=True)
+        response = jsonify(error=str(e), lane=e.lane, retry_after=e.retry_after)
+        response.status_code = 503
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response
+
+    with _jobs_lock:
+        _jobs[job_id] = job
+    _job_executor.submit(_run_job, job, image_files, pdf_files, options, tickets)
+
+    status_url = url_for("job_status", job_id=job_id)
+    response = jsonify(id=job_id, status="queued", status_url=status_url,
+                       result_url=url_for("job_result", job_id=job_id))
+    response.status_code = 202
+    response.headers["Location"] = status_url
+    return response
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return jsonify(error="Unknown job"), 404
+        return jsonify(_job_status(job))
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return jsonify(error="Unknown job"), 404
+        status, result_path, error = job["status"], job["result_path"], job["error"]
+        created = job["created"]
+
+    if status in ("queued", "running"):
+        return jsonify(error="Job is not finished yet", status=status), 409
+    if status == "failed":
+        return jsonify(error=error or "Job failed", status=status), 410
+
+    send_name = f"converted_files_{datetime.utcfromtimestamp(created).strftime('%Y%m%d_%H%M%S')}.zip"
+    return send_file(result_path, as_attachment=True, download_name=send_name,
+                     mimetype="application/zip")
+
+# Content types of converted files served raw by /api/v1/convert
+OUTPUT_MIME_TYPES = {
+    "webp": "image/webp",
+    "jpg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+    "avif": "image/avif",
+    "jxl": "image/jxl",
+    "pdf": "application/pdf",
+}
+
+def _api_error(status: int, code: str, message: str, **extra):
+    """JSON error response for the API: {"error": {"code", "message", ...}}."""
+    response = jsonify(error=dict(extra, code=code, message=message))
+    response.status_code = status
+    return response
+
+def _api_file_params(raw: str, filenames: list) -> list:
+    """
+    Per-file option overrides from the API's JSON "params" field: either a
+    list in upload order or an object keyed by upload filename. Returns one
+    dict per upload; raises ValueError if the field is malformed.
+    """
+    if not raw:
+        return [{} for _ in filenames]
+    try:
+        params = json.loads(raw)
+    except ValueError:
+        raise ValueError("'params' is not valid JSON")
+    if isinstance(params, dict):
+        params = [params.get(name, {}) for name in filenames]
+    if not isinstance(params, list) or len(params) != len(filenames):
+        raise ValueError("'params' must be an object keyed by filename or a list with one entry per file")
+    if not all(isinstance(entry, dict) for entry in params):
+        raise ValueError("Every 'params' entry must be an object of form fields")
+    return params
+
+def _api_run_group(items: list, kind: str, options: dict) -> list:
+    """
+    Run one group of API uploads that share *options* through the image or
+    PDF pipeline. Fills in each item's "stats" and "data"; returns the
+    group's notes.
+    """
+    by_name = collections.defaultdict(collections.deque)
+    for item in items:
+        by_name[secure_filename(item["storage"].filename)].append(item)
+    finished = collections.deque()
+
+    def progress(filename, status, detail):
+        # Names can repeat within a group; uploads finish in order
+        queue = by_name[filename]
+        if status == "running" or not queue:
+            return
+        item = queue.popleft()
+        item["stats"]["status"] = status
+        if status == "done":
+            item["stats"]["output"] = detail
+            finished.append(item)
+        else:
+            item["stats"]["error"] = detail
+
+    summary = _new_summary(progress=progress)
+    storages = [item["storage"] for item in items]
+    if kind == "image":
+        entries = _iter_converted_images(storages, options, summary)
+    else:
+        entries = _iter_compressed_pdfs(storages, options, summary)
+    for out_name, file_bytes in entries:
+        if not isinstance(file_bytes, bytes):
+            file_bytes = file_bytes.read()  # A large PDF; API responses are built in memory
+        item = finished.popleft()
+        item["data"] = file_bytes
+        item["stats"].update(
+            output_bytes=len(file_bytes),
+            content_type=OUTPUT_MIME_TYPES.get(out_name.rsplit(".", 1)[-1], "application/octet-stream"),
         )
-        
-        # Add headers for better compatibility
-        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '0'
-        
+    for out_name, quality, score in summary["ssim_results"]:
+        for item in items:
+            if item["stats"].get("output") == out_name:
+                item["stats"].update(quality=quality, ssim=round(score, 4))
+    for item in items:
+        if item["stats"].get("output") in summary["passed_through"]:
+            item["stats"]["passed_through"] = True
+    return summary["errors"]
+
+@app.route("/api/v1/convert", methods=["POST"])
+def api_convert():
+    """
+    Programmatic conversion of one file or a batch, without the ZIP.
+
+    Upload files as "file" or "files" (images and PDFs alike, told apart by
+    extension) with the /convert form fields as defaults; the optional JSON
+    "params" field overrides them per file. A single file comes back raw
+    with its stats in the X-Conversion-Stats header; a batch comes back as
+    multipart/mixed, a JSON part with per-file stats first and then one part
+    per converted file. Errors are JSON: {"error": {"code", "message"}}.
+    """
+    uploads = [f for f in request.files.getlist("file") + request.files.getlist("files") if f and f.filename]
+    if not uploads:
+        return _api_error(400, "no_files", "Upload one or more files as 'file' or 'files'.")
+    try:
+        overrides = _api_file_params(request.form.get("params", ""), [f.filename for f in uploads])
+    except ValueError as e:
+        return _api_error(400, "bad_params", str(e))
+
+    items = []
+    for storage, override in zip(uploads, overrides):
+        fields = request.form.to_dict()
+        fields.update({key: str(value) for key, value in override.items()})
+        options = _parse_convert_options(fields)
+        if options["img_combine_pdf"] or options["pdf_export_format"]:
+            _close_uploads([item["storage"] for item in items])
+            return _api_error(400, "unsupported_option",
+                              "img_combine_pdf and pdf_export_format don't produce one output per upload; "
+                              "use /convert or /jobs for them.")
+        kind = "pdf" if os.path.splitext(storage.filename)[1].lower() == ".pdf" else "image"
+        reason = _check_upload(storage, kind)
+        if not reason:
+            storage = _spool_upload(storage)
+        stats = {
+            "name": storage.filename,
+            "kind": kind,
+            "status": "pending",
+            "input_bytes": storage.stream.seek(0, os.SEEK_END),
+            "options": {key: value for key, value in options.items()
+                        if key.startswith("pdf_" if kind == "pdf" else "img_")},
+        }
+        storage.stream.seek(0)
+        if not secure_filename(storage.filename):
+            stats.update(status="failed", error="Invalid filename")
+        elif reason:
+            stats.update(status="failed", error=f"Rejected: {reason}")
+        items.append({"storage": storage, "kind": kind, "options": options, "stats": stats, "data": None})
+
+    runnable = [item for item in items if item["stats"]["status"] == "pending"]
+    try:
+        tickets = _admit_batch([item["storage"] for item in runnable if item["kind"] == "image"],
+                               [item["storage"] for item in runnable if item["kind"] == "pdf"])
+    except _LaneSaturated as e:
+        _close_uploads([item["storage"] for item in items])
+        response = _api_error(503, "busy", str(e), lane=e.lane, retry_after=e.retry_after)
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response
+
+    notes = []
+    try:
+        for kind in ("image", "pdf"):
+            if kind not in tickets:
+                continue
+            tickets[kind].wait()
+            # Files with the same settings share a run (and any combined target
+            # size); only the img_* or pdf_* settings for their kind count
+            groups = collections.OrderedDict()
+            for item in runnable:
+                if item["kind"] == kind:
+                    key = json.dumps(item["stats"]["options"], sort_keys=True)
+                    groups.setdefault(key, []).append(item)
+            for group in groups.values():
+                notes.extend(_api_run_group(group, kind, group[0]["options"]))
+            tickets[kind].release()
+    finally:
+        _release_tickets(tickets)
+        _close_uploads([item["storage"] for item in items])
+
+    for item in items:
+        if item["stats"]["status"] == "pending":
+            item["stats"].update(status="failed", error="Not converted")
+    converted = [item for item in items if item["data"] is not None]
+    stats = [item["stats"] for item in items]
+    if not converted:
+        return _api_error(422, "conversion_failed", "No file could be converted.", files=stats, notes=notes)
+
+    if len(items) == 1:
+        item = converted[0]
+        response = Response(item["data"], mimetype=item["stats"]["content_type"])
+        response.headers["Content-Disposition"] = f'attachment; filename="{item["stats"]["output"]}"'
+        response.headers["X-Conversion-Stats"] = json.dumps(item["stats"], separators=(",", ":"))
         return response
 
+    boundary = uuid.uuid4().hex
+    parts = [
+        f"--{boundary}\r\nContent-Type: application/json\r\n\r\n".encode()
+        + json.dumps({"files": stats, "notes": notes}).encode() + b"\r\n"
+    ]
+    for item in converted:
+        parts.append(
+            (f"--{boundary}\r\nContent-Type: {item['stats']['content_type']}\r\n"
+             f'Content-Disposition: attachment; filename="{item["stats"]["output"]}"\r\n\r\n').encode()
+            + item["data"] + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return Response(b"".join(parts), content_type=f"multipart/mixed; boundary={boundary}")
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(_stage_metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/queue", methods=["GET"])
+def queue_status():
+    return jsonify({name: lane.stats() for name, lane in _admission_lanes.items()})
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify(_result_cache.stats())
+
 if __name__ == "__main__":
     # Get port from environment variable or default to 5000
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+
+import image_converter_flask as app
+
+
+def _start_in_thread(ticket):
+    started = threading.Event()
+
+    def run():
+        ticket.wait()
+        started.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    return started
+
+
+def test_tickets_start_in_fifo_order_when_slots_are_full():
+    lane = app._AdmissionLane("test", slots=1, max_queued=4, max_queued_cost=100)
+    first = lane.enqueue(1)
+    first.wait()
+    second = lane.enqueue(1)
+    third = lane.enqueue(1)
+    third_started = _start_in_thread(third)
+    second_started = _start_in_thread(second)
+    assert not second_started.wait(0.2)
+    first.release()
+    assert second_started.wait(2)
+    assert not third_started.is_set()
+    second.release()
+    assert third_started.wait(2)
+    third.release()
+    assert lane.stats()["active"] == 0 and lane.stats()["queued"] == 0
+
+
+def test_dormant_ticket_does_not_block_lane():
+    # The PDF half of a mixed batch is admitted up front but only waits once
+    # the image half is done; a later PDF-only request must not queue behind it.
+    lane = app._AdmissionLane("pdf", slots=2, max_queued=4, max_queued_cost=100)
+    dormant = lane.enqueue(10)
+    later = lane.enqueue(1)
+    assert _start_in_thread(later).wait(2)
+    assert lane.stats()["active"] == 1
+    later.release()
+    dormant.wait()
+    assert lane.stats()["active"] == 1
+    dormant.release()
+
+
+def test_mixed_batch_pdf_ticket_does_not_block_pdf_only_batch(monkeypatch):
+    lanes = {
+        "image": app._AdmissionLane("image", slots=1, max_queued=4, max_queued_cost=100),
+        "pdf": app._AdmissionLane("pdf", slots=1, max_queued=4, max_queued_cost=100),
+    }
+    monkeypatch.setattr(app, "_admission_lanes", lanes)
+    monkeypatch.setattr(app, "_estimate_image_cost", lambda storage: 1.0)
+    monkeypatch.setattr(app, "_estimate_pdf_cost", lambda storage: 3)
+
+    mixed = app._admit_batch(["photo"], ["doc"])
+    image_phase = app._run_in_lane(mixed["image"], iter(["photo"]))
+    assert next(image_phase) == "photo"  # Image half running, PDF half dormant
+
+    pdf_only = app._admit_batch([], ["other"])
+    assert list(app._run_in_lane(pdf_only["pdf"], iter(["other"]))) == ["other"]
+
+    assert list(image_phase) == []
+    assert list(app._run_in_lane(mixed["pdf"], iter(["doc"]))) == ["doc"]
+    assert lanes["pdf"].stats()["queued"] == 0
+
+
+def test_dormant_tickets_still_count_against_queue_bounds():
+    lane = app._AdmissionLane("test", slots=1, max_queued=1, max_queued_cost=100)
+    running = lane.enqueue(1)
+    running.wait()
+    lane.enqueue(1)  # Admitted but not yet waiting
+    with pytest.raises(app._LaneSaturated):
+        lane.enqueue(1)
+    running.release()
+
+
+def test_release_before_start_leaves_the_queue():
+    lane = app._AdmissionLane("test", slots=1, max_queued=4, max_queued_cost=100)
+    ticket = lane.enqueue(5)
+    ticket.release()
+    assert lane.stats()["queued"] == 0
+    ticket.wait()  # Returns at once for a released ticket
+    assert lane.stats()["active"] == 0
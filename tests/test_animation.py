@@ -0,0 +1,47 @@
+import io
+
+import pytest
+from PIL import Image
+
+import image_converter_flask as app
+
+
+def _animation(colors, size=(64, 48), duration=40, fmt="GIF"):
+    frames = [Image.new("RGB", size, color) for color in colors]
+    buf = io.BytesIO()
+    frames[0].save(buf, fmt, save_all=True, append_images=frames[1:], duration=duration, loop=0)
+    buf.seek(0)
+    return Image.open(buf)
+
+
+def test_identical_frames_are_merged_with_their_durations():
+    red, blue = (255, 0, 0), (0, 0, 255)
+    # Pillow merges identical neighbours itself when saving GIFs, so use WebP
+    image = _animation([red, red, blue, blue, blue, red], fmt="WEBP")
+    animation = app._read_animation(image)
+    assert len(animation.frames) == 3
+    assert animation.durations == [80, 120, 40]
+    assert animation.loop == 0
+    assert all(frame.mode == "RGBA" for frame in animation.frames)
+
+
+def test_frames_are_resized_to_max_dimension():
+    image = _animation([(255, 0, 0), (0, 255, 0)], size=(400, 200))
+    animation = app._read_animation(image, max_dimension=100)
+    assert [frame.size for frame in animation.frames] == [(100, 50), (100, 50)]
+
+
+def test_single_distinct_frame_comes_back_as_an_image():
+    image = _animation([(9, 9, 9)] * 3, fmt="WEBP")
+    result = app._read_animation(image)
+    assert isinstance(result, Image.Image) and result.mode == "RGBA"
+
+
+def test_frame_pixel_budget_counts_resized_distinct_frames(monkeypatch):
+    monkeypatch.setattr(app, "MAX_ANIMATION_MEGAPIXELS", 1)
+    colors = [(i * 20, 0, 0) for i in range(6)]
+    with pytest.raises(ValueError, match="more than 1 megapixels"):
+        app._read_animation(_animation(colors, size=(500, 500)))
+    # The same frames fit once shrunk
+    animation = app._read_animation(_animation(colors, size=(500, 500)), max_dimension=200)
+    assert len(animation.frames) == 6
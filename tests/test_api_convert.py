@@ -0,0 +1,47 @@
+import io
+import json
+
+from PIL import Image
+
+import image_converter_flask as app
+
+
+def _png(color):
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 48), color).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def _post(params, **form):
+    client = app.app.test_client()
+    files = [(io.BytesIO(_png(color)), name)
+             for name, color in (("a.png", (255, 0, 0)), ("b.png", (0, 0, 255)))]
+    data = dict(form, files=files, params=json.dumps(params))
+    return client.post("/api/v1/convert", data=data, content_type="multipart/form-data")
+
+
+def _record_groups(monkeypatch):
+    groups = []
+    run_group = app._api_run_group
+
+    def record(items, kind, options):
+        groups.append([item["stats"]["name"] for item in items])
+        return run_group(items, kind, options)
+
+    monkeypatch.setattr(app, "_api_run_group", record)
+    return groups
+
+
+def test_images_differing_only_in_pdf_settings_share_a_run(monkeypatch):
+    groups = _record_groups(monkeypatch)
+    response = _post({"a.png": {"pdf_mode": "raster"}, "b.png": {"pdf_target_size": 500}},
+                     img_format="jpg", img_target_size=60)
+    assert response.status_code == 200
+    assert groups == [["a.png", "b.png"]]
+
+
+def test_images_with_different_image_settings_run_apart(monkeypatch):
+    groups = _record_groups(monkeypatch)
+    response = _post({"a.png": {"img_quality": 50}, "b.png": {"img_quality": 90}}, img_format="jpg")
+    assert response.status_code == 200
+    assert groups == [["a.png"], ["b.png"]]
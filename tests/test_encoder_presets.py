@@ -0,0 +1,14 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+import image_converter_flask as app
+
+
+def test_balanced_png_matches_plain_pillow_save():
+    rng = np.random.default_rng(3)
+    image = Image.fromarray(rng.integers(0, 255, (60, 80, 3), dtype=np.uint8))
+    plain = io.BytesIO()
+    image.save(plain, "PNG")
+    assert app._encode_image(image, "png", 85, "balanced") == plain.getvalue()
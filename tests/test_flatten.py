@@ -0,0 +1,48 @@
+from PIL import Image
+
+import image_converter_flask as app
+
+
+def _half_transparent(mode):
+    # Opaque red on the left half, fully transparent on the right
+    image = Image.new("RGBA", (4, 2), (0, 0, 0, 0))
+    image.paste((255, 0, 0, 255), (0, 0, 2, 2))
+    return image.convert(mode)
+
+
+def test_rgb_is_returned_as_is():
+    image = Image.new("RGB", (4, 2), (1, 2, 3))
+    assert app._flatten_to_rgb(image) is image
+
+
+def test_transparency_is_composited_over_white():
+    flattened = app._flatten_to_rgb(_half_transparent("RGBA"))
+    assert flattened.mode == "RGB"
+    assert flattened.getpixel((0, 0)) == (255, 0, 0)
+    assert flattened.getpixel((3, 1)) == (255, 255, 255)
+
+
+def test_partial_alpha_blends_with_white():
+    image = Image.new("RGBA", (2, 2), (0, 0, 0, 128))
+    assert app._flatten_to_rgb(image).getpixel((0, 0)) == (127, 127, 127)
+
+
+def test_grey_alpha_is_composited():
+    image = Image.new("LA", (2, 2), (0, 0))
+    image.putpixel((0, 0), (0, 255))
+    flattened = app._flatten_to_rgb(image)
+    assert flattened.getpixel((0, 0)) == (0, 0, 0)
+    assert flattened.getpixel((1, 1)) == (255, 255, 255)
+
+
+def test_palette_transparency_is_composited():
+    image = _half_transparent("RGBA").convert("P")
+    image.info["transparency"] = image.getpixel((3, 1))
+    flattened = app._flatten_to_rgb(image)
+    assert flattened.getpixel((0, 0)) == (255, 0, 0)
+    assert flattened.getpixel((3, 1)) == (255, 255, 255)
+
+
+def test_opaque_alpha_matches_plain_conversion():
+    image = Image.new("RGBA", (3, 3), (10, 20, 30, 255))
+    assert app._flatten_to_rgb(image).tobytes() == image.convert("RGB").tobytes()
@@ -0,0 +1,49 @@
+import io
+
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+import image_converter_flask as app
+
+
+def _jpeg(orientation=None, size=(120, 80)):
+    # Red on the left half, blue on the right
+    image = Image.new("RGB", size, (0, 0, 255))
+    image.paste((255, 0, 0), (0, 0, size[0] // 2, size[1]))
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[app.EXIF_ORIENTATION] = orientation
+    buf = io.BytesIO()
+    image.save(buf, "JPEG", quality=90, dpi=(144, 144), exif=exif.tobytes())
+    return buf.getvalue()
+
+
+def _page(data, max_dimension=0):
+    storage = FileStorage(io.BytesIO(data), filename="photo.jpg")
+    digest = app._upload_digest(storage.stream)
+    return app._image_pdf_page(storage, digest, "photo.jpg", 80, max_dimension,
+                               app.DEFAULT_PRESET, app._new_summary())
+
+
+def test_upright_jpeg_passes_through():
+    data = _jpeg(orientation=1)
+    assert _page(data) == (data, 60, 40, "passed through")
+
+
+def test_rotated_jpeg_is_turned_upright():
+    jpeg_bytes, width_pt, height_pt, source = _page(_jpeg(orientation=6))
+    assert source in ("encoded", "cached")
+    assert (width_pt, height_pt) == (40, 60)
+    with Image.open(io.BytesIO(jpeg_bytes)) as page:
+        assert page.size == (80, 120)
+        top, bottom = page.getpixel((40, 10)), page.getpixel((40, 110))
+    # Orientation 6 is displayed turned 90 degrees clockwise: left goes to the top
+    assert top[0] > 200 and top[2] < 60
+    assert bottom[2] > 200 and bottom[0] < 60
+
+
+def test_mirrored_jpeg_keeps_its_page_size():
+    jpeg_bytes, width_pt, height_pt, _ = _page(_jpeg(orientation=2))
+    assert (width_pt, height_pt) == (60, 40)
+    with Image.open(io.BytesIO(jpeg_bytes)) as page:
+        assert page.getpixel((10, 40))[2] > 200
@@ -0,0 +1,71 @@
+import io
+
+import pytest
+from PIL import Image
+
+import image_converter_flask as app
+
+
+def _jpeg(quality=70, mode="RGB", orientation=None, comment=None, icc=None):
+    image = Image.new(mode, (64, 48), 128 if mode == "L" else (90, 140, 200))
+    exif = Image.Exif()
+    exif[0x010F] = "Camera"  # Make
+    if orientation is not None:
+        exif[app.EXIF_ORIENTATION] = orientation
+    kwargs = {"quality": quality, "exif": exif.tobytes()}
+    if comment:
+        kwargs["comment"] = comment
+    if icc:
+        kwargs["icc_profile"] = icc
+    buf = io.BytesIO()
+    image.save(buf, "JPEG", **kwargs)
+    return buf.getvalue()
+
+
+def _segments(jpeg_bytes):
+    """(marker, payload prefix) of every segment before the scan."""
+    found, pos = [], 2
+    while jpeg_bytes[pos + 1] != 0xDA:
+        length = int.from_bytes(jpeg_bytes[pos + 2:pos + 4], "big")
+        found.append((jpeg_bytes[pos + 1], jpeg_bytes[pos + 4:pos + 16]))
+        pos += 2 + length
+    return found
+
+
+def test_strip_keeps_image_data_and_drops_metadata():
+    data = _jpeg(comment=b"hello", icc=b"\0" * 200)
+    stripped = app._strip_jpeg_metadata(data)
+    markers = [marker for marker, _ in _segments(stripped)]
+    assert 0xE1 not in markers and 0xFE not in markers  # EXIF and comment gone
+    assert 0xE0 in markers and 0xE2 in markers  # JFIF and ICC kept
+    assert stripped.endswith(data[data.index(b"\xff\xda"):])
+    with Image.open(io.BytesIO(stripped)) as image, Image.open(io.BytesIO(data)) as original:
+        assert image.tobytes() == original.tobytes()
+
+
+def test_strip_rejects_corrupt_markers():
+    data = _jpeg()
+    with pytest.raises(ValueError, match="Corrupt JPEG marker"):
+        app._strip_jpeg_metadata(data[:2] + b"\x00" + data[3:])
+
+
+def test_source_quality_estimate():
+    with Image.open(io.BytesIO(_jpeg(quality=70))) as image:
+        assert app._jpeg_source_quality(image) == 70
+
+
+@pytest.mark.parametrize("mode", ["RGB", "L"])
+def test_low_quality_upright_jpeg_passes_through(mode):
+    data = _jpeg(quality=60, mode=mode, orientation=1)
+    result = app._jpeg_passthrough(io.BytesIO(data), 80)
+    assert result is not None and len(result) < len(data)
+
+
+def test_higher_quality_or_oversize_jpeg_is_reencoded():
+    assert app._jpeg_passthrough(io.BytesIO(_jpeg(quality=95)), 80) is None
+    assert app._jpeg_passthrough(io.BytesIO(_jpeg(quality=60)), 80, max_dimension=32) is None
+
+
+def test_rotated_jpeg_is_not_passed_through():
+    # Stripping EXIF would drop the tag without rotating the pixels
+    assert app._jpeg_passthrough(io.BytesIO(_jpeg(quality=60, orientation=6)), 80) is None
@@ -0,0 +1,93 @@
+import io
+
+import numpy as np
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+import image_converter_flask as app
+
+
+def _photo_pdf():
+    pixels = np.random.default_rng(0).integers(0, 255, (300, 400, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels)
+    buf = io.BytesIO()
+    image.save(buf, "PDF", resolution=72)
+    return buf.getvalue()
+
+
+class _PdfiumFourImage:
+    """An image object as pypdfium2 4.x exposes it."""
+
+    def get_pos(self):
+        return (10.0, 20.0, 110.0, 95.0)
+
+    def get_size(self):
+        return (400, 300)
+
+
+def test_image_geometry_on_pypdfium2_4():
+    assert app._image_object_geometry(_PdfiumFourImage()) == ((10.0, 20.0, 110.0, 95.0), (400, 300))
+
+
+def test_page_analysis_finds_placed_images():
+    page = app._analyze_page_range(_photo_pdf(), 0, 1, [None])[0]
+    assert page["images"] == [(400, 300, 400, 300)] and page["scan"]
+
+
+def test_auto_mode_rasterizes_when_page_analysis_fails(monkeypatch):
+    def fail(*args):
+        raise AttributeError("no page objects here")
+
+    monkeypatch.setattr(app, "_map_page_ranges", fail)
+    stats = {}
+    data = app.compress_pdf(_photo_pdf(), 0, 80, stats)
+    assert data.startswith(b"%PDF-") and stats["mode"] == "raster"
+
+
+
+def test_large_outputs_stream_from_a_file_and_skip_the_cache(monkeypatch):
+    monkeypatch.setattr(app, "PDF_OUTPUT_SPOOL_MB", 0)
+    monkeypatch.setattr(app, "_result_cache", app._ResultCache(64 * 1024 * 1024))
+    summary = app._new_summary()
+    storage = FileStorage(io.BytesIO(_photo_pdf()), filename="photo.pdf")
+    entries = app._iter_compressed_pdfs([storage], app._parse_convert_options({"pdf_mode": "raster"}), summary)
+    name, output = next(entries)
+    assert name == "photo_compressed.pdf" and not isinstance(output, bytes)
+    assert output.read(5) == b"%PDF-"
+    assert list(entries) == [] and output.closed
+    assert app._result_cache.stats()["stores"] == 0
+
+
+def test_small_outputs_are_cached_as_bytes(monkeypatch):
+    monkeypatch.setattr(app, "_result_cache", app._ResultCache(64 * 1024 * 1024))
+    summary = app._new_summary()
+    outputs = []
+    for _ in range(2):
+        storage = FileStorage(io.BytesIO(_photo_pdf()), filename="photo.pdf")
+        options = app._parse_convert_options({"pdf_mode": "raster"})
+        outputs += list(app._iter_compressed_pdfs([storage], options, summary))
+    assert all(isinstance(data, bytes) for _, data in outputs)
+    assert outputs[0] == outputs[1] and summary["cache_hits"] == 1
+
+
+def _structural_stats(**overrides):
+    stats = {"mode": "structural", "image_settings": (150, 80),
+             "images_recompressed": 3, "objects_merged": 2}
+    stats.update(overrides)
+    return stats
+
+
+def test_stats_name_image_settings_when_images_were_recompressed():
+    text = app._describe_pdf_stats(_structural_stats())
+    assert "3 images recompressed at 150dpi/q80" in text
+
+
+def test_stats_skip_image_settings_when_nothing_was_recompressed():
+    text = app._describe_pdf_stats(_structural_stats(images_recompressed=0))
+    assert "dpi" not in text
+    assert "no images needed recompressing" in text
+
+
+def test_stats_for_lossless_runs():
+    text = app._describe_pdf_stats(_structural_stats(image_settings=None, images_recompressed=0))
+    assert "images untouched (lossless)" in text
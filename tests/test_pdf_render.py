@@ -0,0 +1,56 @@
+import io
+
+import pypdfium2 as pdfium
+from PIL import Image
+
+import image_converter_flask as app
+
+
+def _pdf(pages=3, size=(300, 200)):
+    images = [Image.new("RGB", size, (40 * i, 90, 160)) for i in range(pages)]
+    buf = io.BytesIO()
+    images[0].save(buf, "PDF", save_all=True, append_images=images[1:], resolution=72)
+    return buf.getvalue()
+
+
+def test_rendered_page_shares_pdfium_buffer():
+    document = pdfium.PdfDocument(_pdf(pages=1))
+    try:
+        page = document[0]
+        bitmaps = []
+        render = page.render
+
+        def capture(*args, **kwargs):
+            bitmaps.append(render(*args, **kwargs))
+            return bitmaps[-1]
+
+        page.render = capture
+        image = app._render_page_rgb(page, 144)
+        assert image.mode == "RGBX" and image.size == (600, 400)
+        assert image.getpixel((0, 0))[3] == 255
+
+        # Writing to pdfium's buffer shows up in the image: no copy was made
+        bitmaps[0].buffer[0] = 7
+        assert image.getpixel((0, 0))[0] == 7
+    finally:
+        document.close()
+
+
+def test_png_page_export_is_rgb():
+    data = app._export_page_range(_pdf(pages=1), 0, 1, [(72, "png", 80, app.DEFAULT_PRESET)])[0]
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.mode == "RGB" and image.size == (300, 200)
+
+
+def test_bitmap_cache_counts_four_bytes_per_pixel():
+    page_bytes = 300 * 200 * 4
+    data = _pdf()
+    with app._PageBitmapCache(data, 72, max_bytes=2 * page_bytes) as cache:
+        assert cache.memory_bytes == 2 * page_bytes
+        assert cache.spilled_pages == 1
+        spilled = cache.get(2)
+    document = pdfium.PdfDocument(data)
+    try:
+        assert spilled.tobytes() == app._render_page_rgb(document[2], 72).tobytes()
+    finally:
+        document.close()
@@ -0,0 +1,87 @@
+import io
+import zipfile
+
+import pikepdf
+import pypdfium2 as pdfium
+import pytest
+from PIL import Image
+
+import image_converter_flask as app
+
+
+def _jpeg(mode="RGB", size=(120, 80), color=(200, 40, 40)):
+    if mode == "L":
+        color = color[0]
+    elif mode == "CMYK":
+        color = color + (0,)
+    buf = io.BytesIO()
+    Image.new(mode, size, color).save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+
+def _build(pages, **kwargs):
+    writer = app._ImagePdfWriter(**kwargs)
+    try:
+        for page in pages:
+            writer.add_page(*page)
+        return writer.finish().read()
+    finally:
+        writer.close()
+
+
+def test_pages_embed_jpegs_unchanged():
+    rgb, grey = _jpeg(), _jpeg("L", (60, 90))
+    data = _build([(rgb, 90, 60), (grey, 45.5, 67.25)])
+
+    document = pdfium.PdfDocument(data)
+    assert [page.get_size() for page in document] == [(90, 60), (45.5, 67.25)]
+    document.close()
+    with pikepdf.open(io.BytesIO(data)) as pdf:
+        raw = [page.Resources.XObject.Im0.read_raw_bytes() for page in pdf.pages]
+    assert raw == [rgb, grey]
+
+
+def test_output_is_deterministic():
+    pages = [(_jpeg(), 90, 60)]
+    assert _build(pages) == _build(pages)
+
+
+def test_finish_returns_file_at_start_even_after_spilling_to_disk():
+    writer = app._ImagePdfWriter(max_memory_bytes=1024)
+    try:
+        for _ in range(3):
+            writer.add_page(_jpeg(size=(400, 300)), 300, 225)
+        pdf_file = writer.finish()
+        assert pdf_file._rolled
+        assert pdf_file.read(5) == b"%PDF-"
+    finally:
+        writer.close()
+
+
+def test_unsupported_jpeg_is_rejected():
+    writer = app._ImagePdfWriter()
+    with pytest.raises(ValueError, match="4 components"):
+        writer.add_page(_jpeg("CMYK"), 10, 10)
+    writer.close()
+
+
+def test_jpeg_info_reads_frame_header():
+    assert app._jpeg_info(_jpeg("L", (33, 17))) == (33, 17, 1)
+    with pytest.raises(ValueError):
+        app._jpeg_info(b"\xff\xd8\x00\x00garbage-without-markers")
+
+
+def test_stream_zip_copies_file_entries():
+    pdf_file = app._assemble_pdf_file(iter([(_jpeg(), 90, 60), (_jpeg(), 90, 60)]))
+    with pdf_file:
+        expected = pdf_file.read()
+        pdf_file.seek(0)
+        stages = {}
+        archive = b"".join(app._stream_zip(iter([("a.bin", b"bytes"), ("c.pdf", pdf_file)]),
+                                           lambda: "info", stages))
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        assert zf.read("a.bin") == b"bytes"
+        assert zf.read("c.pdf") == expected
+        assert zf.read("conversion_info.txt") == b"info"
+    assert stages["zip_build"]["calls"] == 2
+    assert stages["zip_build"]["bytes_in"] == 5 + len(expected)
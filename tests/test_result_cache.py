@@ -0,0 +1,80 @@
+import os
+import threading
+
+import image_converter_flask as app
+
+
+def test_memory_lru_evicts_least_recently_used():
+    cache = app._ResultCache(max_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"  # "b" is now the oldest
+    cache.put("c", b"cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa" and cache.get("c") == b"cccc"
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["bytes"] == 8 and stats["entries"] == 2
+    assert stats["hits"] == 3 and stats["misses"] == 1 and stats["hit_rate"] == 0.75
+
+
+def test_entries_larger_than_the_cache_are_not_kept():
+    cache = app._ResultCache(max_bytes=4)
+    cache.put("big", b"12345")
+    assert cache.get("big") is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_disk_entries_survive_a_restart(tmp_path):
+    cache = app._ResultCache(4, str(tmp_path), 100)
+    cache.put("k1", b"first")  # Too big for memory, fine on disk
+    assert sorted(os.listdir(tmp_path)) == ["k1"]
+
+    restarted = app._ResultCache(100, str(tmp_path), 100)
+    assert restarted.stats()["disk_entries"] == 1
+    assert restarted.get("k1") == b"first"
+    assert restarted.get("k1") == b"first"
+    assert restarted.counters["disk_hits"] == 1 and restarted.counters["hits"] == 1
+
+
+def test_disk_eviction_removes_oldest_files(tmp_path):
+    cache = app._ResultCache(0, str(tmp_path), 10)
+    cache.put("old", b"xxxxx")
+    cache.put("mid", b"yyyyy")
+    cache.get("old")  # Disk hits count as use
+    cache.put("new", b"zzzzz")
+    assert sorted(os.listdir(tmp_path)) == ["new", "old"]
+    assert cache.stats()["disk_bytes"] == 10
+
+
+def test_missing_disk_file_is_a_miss(tmp_path):
+    cache = app._ResultCache(0, str(tmp_path), 100)
+    cache.put("gone", b"data")
+    os.remove(tmp_path / "gone")
+    assert cache.get("gone") is None
+    assert cache.counters["misses"] == 1
+
+
+def test_cache_key_depends_on_every_parameter():
+    base = app._cache_key("image", "digest", "webp", 80)
+    assert base == app._cache_key("image", "digest", "webp", 80)
+    assert len({base, app._cache_key("image", "digest", "webp", 81),
+                app._cache_key("image", "other", "webp", 80),
+                app._cache_key("pdf", "digest", "webp", 80)}) == 4
+
+
+def test_concurrent_use_keeps_the_byte_count_consistent():
+    cache = app._ResultCache(max_bytes=1000)
+
+    def worker(n):
+        for i in range(200):
+            key = f"{n}-{i % 30}"
+            if cache.get(key) is None:
+                cache.put(key, bytes(10 + i % 7))
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats["bytes"] == sum(len(data) for data in cache._entries.values()) <= 1000
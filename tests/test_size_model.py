@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import image_converter_flask as app
+
+
+def _palette_photo(size=(2000, 1500), seed=1):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size[1], 0:size[0]]
+    pixels = np.stack([x * 255 // size[0], y * 255 // size[1], (x + y) % 256], -1)
+    pixels = pixels + rng.integers(-40, 40, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).quantize(256)
+
+
+@pytest.mark.parametrize("target_format", ["webp", "png"])
+def test_palette_proxy_predicts_full_encode(target_format):
+    image = _palette_photo()
+    proxy, pixel_ratio = app._size_proxy(image)
+    assert proxy is not image and proxy.mode == "P"
+    predicted = app._proxy_to_full_size(len(app._encode_image(proxy, target_format, 80)), pixel_ratio)
+    actual = len(app._encode_image(image, target_format, 80))
+    assert 0.5 < predicted / actual < 2
+
+
+def test_palette_proxy_keeps_transparency():
+    image = _palette_photo()
+    image.info["transparency"] = 0
+    proxy, _ = app._size_proxy(image)
+    assert proxy.getpalette() == image.getpalette()
+    assert proxy.info["transparency"] == 0
+
+
+def test_small_image_is_its_own_proxy():
+    image = Image.new("RGB", (100, 100))
+    assert app._size_proxy(image) == (image, 1.0)
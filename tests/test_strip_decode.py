@@ -0,0 +1,159 @@
+import io
+import zlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import image_converter_flask as app
+
+
+def _source(mode, size=(600, 401)):
+    # Smooth noise, so every filter type and compressor has something to do
+    rng = np.random.default_rng(0)
+    coarse = rng.integers(0, 255, (size[1] // 8 + 1, size[0] // 8 + 1, 4), dtype=np.uint8)
+    image = Image.fromarray(coarse, "RGBA").resize(size, Image.BICUBIC)
+    if mode == "P":
+        return image.convert("RGB").quantize(200)
+    if mode == "PA":  # Palette with a transparent entry
+        image = image.convert("RGB").quantize(200)
+        image.info["transparency"] = 0
+        return image
+    return image.convert(mode)
+
+
+def _encode(image, fmt, **kwargs):
+    buf = io.BytesIO()
+    image.save(buf, fmt, **kwargs)
+    return buf.getvalue()
+
+
+def _whole(data):
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        return app._reducible(image.copy())
+
+
+def _assemble(strips, reference):
+    canvas = None
+    for y, strip in strips:
+        strip = app._reducible(strip)
+        if canvas is None:
+            canvas = Image.new(strip.mode, reference.size)
+        canvas.paste(strip, (0, y))
+    return canvas
+
+
+def _same(a, b):
+    return a.mode == b.mode and a.size == b.size and np.array_equal(np.asarray(a), np.asarray(b))
+
+
+@pytest.fixture
+def tiny_strips(monkeypatch):
+    monkeypatch.setattr(app, "TILED_DECODE_MEGAPIXELS", 0)
+    monkeypatch.setattr(app, "STRIP_DECODE_MEGAPIXELS", 0)  # Strips of *factor* rows
+
+
+PNG_MODES = ["RGB", "RGBA", "L", "LA", "P", "PA"]
+TIFF_CASES = [(mode, compression) for mode in ["RGB", "RGBA", "L", "CMYK", "1"]
+              for compression in [None, "tiff_lzw", "tiff_adobe_deflate", "packbits"]]
+
+
+@pytest.mark.parametrize("mode", PNG_MODES)
+@pytest.mark.parametrize("rows", [1, 7, 64])
+def test_png_strips_match_whole_decode(mode, rows):
+    data = _encode(_source(mode), "PNG")
+    reference = _whole(data)
+    strips = app._png_strip_reader(io.BytesIO(data), rows)
+    assert strips is not None
+    assert _same(_assemble(strips, reference), reference)
+
+
+@pytest.mark.parametrize("mode,compression", TIFF_CASES)
+def test_tiff_strips_match_whole_decode(mode, compression):
+    data = _encode(_source(mode), "TIFF", compression=compression, strip_size=8192)
+    reference = _whole(data)
+    with Image.open(io.BytesIO(data)) as image:
+        strips = app._tiff_strip_reader(io.BytesIO(data), image, 50)
+        assert strips is not None
+        assert _same(_assemble(strips, reference), reference)
+
+
+@pytest.mark.parametrize("fmt,mode,compression",
+                         [("PNG", mode, None) for mode in PNG_MODES]
+                         + [("TIFF", mode, compression) for mode, compression in TIFF_CASES])
+@pytest.mark.parametrize("max_dimension", [100, 200])
+def test_open_image_in_strips_matches_whole_decode(tiny_strips, fmt, mode, compression, max_dimension):
+    kwargs = {"compression": compression, "strip_size": 8192} if fmt == "TIFF" else {}
+    data = _encode(_source(mode), fmt, **kwargs)
+    reference = _whole(data)
+    reference = reference.reduce(int(max(reference.size) / max_dimension))
+    reference.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+    with Image.open(io.BytesIO(data)) as image:
+        assert app._decode_in_strips(io.BytesIO(data), image, max_dimension) is not None
+    assert _same(app._open_image(io.BytesIO(data), max_dimension), reference)
+
+
+def _interlaced_png(image):
+    """An Adam7-interlaced PNG of an RGB *image*, which Pillow can't write."""
+    pixels = np.asarray(image)
+    raw = bytearray()
+    for x0, y0, dx, dy in [(0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4),
+                           (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2)]:
+        for row in pixels[y0::dy, x0::dx]:
+            if row.size:
+                raw += b"\0" + row.tobytes()
+    ihdr = image.width.to_bytes(4, "big") + image.height.to_bytes(4, "big") + bytes([8, 2, 0, 0, 1])
+    return (app.PNG_SIGNATURE + app._png_chunk(b"IHDR", ihdr)
+            + app._png_chunk(b"IDAT", zlib.compress(bytes(raw))) + app._png_chunk(b"IEND", b""))
+
+
+def _four_bit_png():
+    return _encode(_source("RGB").quantize(16), "PNG", bits=4)
+
+
+@pytest.mark.parametrize("make_png", [lambda: _interlaced_png(_source("RGB")), _four_bit_png])
+def test_unsupported_pngs_fall_back_to_whole_decode(tiny_strips, make_png):
+    data = make_png()
+    assert app._png_strip_reader(io.BytesIO(data), 8) is None
+    with Image.open(io.BytesIO(data)) as image:
+        assert app._decode_in_strips(io.BytesIO(data), image, 200) is None
+
+    reference = _whole(data).reduce(3)
+    reference.thumbnail((200, 200), Image.LANCZOS)
+    assert _same(app._open_image(io.BytesIO(data), 200), reference)
+
+
+def test_sixteen_bit_png_is_not_read_in_strips():
+    image = Image.fromarray(np.asarray(_source("L")).astype(np.uint16) * 257)
+    assert app._png_strip_reader(io.BytesIO(_encode(image, "PNG")), 8) is None
+
+
+def test_truncated_png_raises_cleanly(tiny_strips):
+    data = _encode(_source("RGB"), "PNG")
+    for cut in (60, len(data) // 2):
+        with pytest.raises(ValueError, match="Truncated PNG"):
+            app._open_image(io.BytesIO(data[:cut]), 200)
+
+
+def test_corrupt_png_data_raises_cleanly(tiny_strips):
+    data = _encode(_source("RGB"), "PNG")
+    idat = data.index(b"IDAT") + 4
+    bad_stream = data[:idat] + b"\xff\xff" + data[idat + 2:]
+    with pytest.raises(ValueError, match="Corrupt PNG image data"):
+        app._open_image(io.BytesIO(bad_stream), 200)
+
+    bad_rows = bytearray(data)
+    middle = len(data) // 2
+    bad_rows[middle:middle + 64] = bytes(64)
+    with pytest.raises((ValueError, OSError)):
+        app._open_image(io.BytesIO(bytes(bad_rows)), 200)
+
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+@pytest.mark.parametrize("compression", [None, "tiff_lzw"])
+def test_truncated_tiff_raises_cleanly(tiny_strips, compression):
+    data = _encode(_source("RGB"), "TIFF", compression=compression, strip_size=8192)
+    with pytest.raises(OSError):
+        app._open_image(io.BytesIO(data[:len(data) // 2]), 200)
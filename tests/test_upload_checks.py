@@ -0,0 +1,31 @@
+import io
+
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+import image_converter_flask as app
+
+
+def _gif(frames, size=(600, 600)):
+    images = [Image.new("P", size, i) for i in range(frames)]
+    buf = io.BytesIO()
+    images[0].save(buf, "GIF", save_all=True, append_images=images[1:])
+    return FileStorage(io.BytesIO(buf.getvalue()), filename="anim.gif")
+
+
+def test_still_image_within_pixel_limit_is_accepted(monkeypatch):
+    monkeypatch.setattr(app, "MAX_IMAGE_MEGAPIXELS", 1)
+    assert app._check_upload(_gif(1), "image") is None
+
+
+def test_animation_frames_count_toward_pixel_limit(monkeypatch):
+    monkeypatch.setattr(app, "MAX_IMAGE_MEGAPIXELS", 1)
+    storage = _gif(5)
+    reason = app._check_upload(storage, "image")
+    assert reason == "5 frames of 600x600 is more than 1 megapixels"
+    assert storage.stream.tell() == 0
+
+
+def test_unreadable_image_is_rejected():
+    storage = FileStorage(io.BytesIO(b"not an image at all"), filename="x.png")
+    assert app._check_upload(storage, "image") == "not a recognised image"